@@ -1,64 +1,160 @@
 import numpy as np
 from camera import Camera
-import rospy
 from collections import namedtuple, deque
-from matchedFilters import MatchedFilter
-from avoidance_functions import get_activation
+from matchedFilters import (MatchedFilter, get_matched_filter, filter_cache,
+                            load_filter_bank, FILTER_ANGLES, DUAL_OFFSET)
+from avoidance_functions import (get_activation, ActivationEngine,
+                                 SectorActivation, sector_edges)
+from timing import NullTimer
 
 
 
 class AvoidanceBehaviour(object):
 
-    def __init__(self, camera, num_filters=5, dual=False):
+    def __init__(self, camera, num_filters=5, dual=False, filter_bank='',
+                 rank=None, sectors=None):
         self.flow = None
         self.num_filters = num_filters
         self.cam = camera
         self.dual = dual
+        # Separable (low-rank) filter approximation, None for exact
+        self.rank = rank
+
+        # Number of horizontal sectors per camera, None to disable
+        self.sectors = sectors
+        self._sector_modules = None
+        self._sector_edges = None
+        # (height, width) of the flows the sector modules are built for
+        self._sector_shape = None
+        self.sector_activations = [None] * 3
+
+        # Memory-map the precomputed filters instead of generating them
+        if filter_bank:
+            load_filter_bank(filter_bank)
 
         self.activations = [deque([], maxlen=10) for _ in range(3)]
 
+        # Built on the first flows, once their shape is known
+        self._engine = None
+
+        # Times the activation and decision stages when replaced by a
+        # StageTimer
+        self.timer = NullTimer()
+
         self._start = False
             
-    def get_matched_filters(self, flows):
+    def get_matched_filters(self, flows, dtype=np.float64):
         # Needed for the MF functions
         height, width, _ = flows[0].shape
-        # FOV of a single filter
-        original_fov = self.cam.fovx_deg
-        fov = int(original_fov / self.num_filters)
-        
-        filter_angles = [-45, 0, 45]
+        return self.camera_filters(width, height, len(flows), dtype)
+
+    def camera_filters(self, width, height, num_cameras=3,
+                       dtype=np.float64):
+        """The matched filter of each camera (a pair in dual mode), for
+        flows of this size
+        """
+        # The filters never change during a flight, so they come from
+        # the shared cache instead of being generated on every frame
+        filters = [tuple(get_matched_filter(width, height, fov,
+                                            orientation=orientation,
+                                            axis=axis, dtype=dtype)
+                         for fov, orientation, axis in specs)
+                   for specs in self._filter_specs(num_cameras)]
+        return filters if self.dual else [pair[0] for pair in filters]
+
+    def camera_filter_stack(self, width, height, num_cameras=3,
+                            dtype=np.float32):
+        """The filters of camera_filters as a (C, K, H, W, 2) view of the
+        filter bank, or None if no loaded bank stores them in that order
+        """
+        specs = self._filter_specs(num_cameras)
+        stack = filter_cache.get_stack(
+            width, height, [spec for cam in specs for spec in cam], dtype)
+        if stack is None:
+            return None
+        return stack.reshape((num_cameras, len(specs[0])) + stack.shape[1:])
+
+    @property
+    def filter_fov(self):
+        """FOV of a single filter in degrees, (x, y)
+        """
+        fov = int(self.cam.fovx_deg / self.num_filters)
+        return (fov, fov)
+
+    def _filter_specs(self, num_cameras):
+        """(fov, orientation, axis) of the filters of each camera, in the
+        order of avoidance_filter_specs
+        """
+        filter_angles = FILTER_ANGLES
         #filter_angles = [-48, -24, 0, 24, 48]
 
-        if self.dual:
-            offset = 10
-            return [(MatchedFilter(
-                flow.shape[1], flow.shape[0], (fov, fov), 
-                orientation=[0, 0, offset],
-                axis=[0, 0, filter_angles[i]]
-                ).matched_filter, 
-                     MatchedFilter(
-                flow.shape[1], flow.shape[0], (fov, fov), 
-                orientation=[0, 0, -offset],
-                axis=[0, 0, filter_angles[i]]
-                ).matched_filter)
-                     for i, flow in enumerate(flows)]
-
-        return [MatchedFilter(
-            flow.shape[1], flow.shape[0], (fov, fov), 
-            axis=[0, 0, filter_angles[i]]
-            ).matched_filter for i, flow in enumerate(flows)]
+        yaws = (DUAL_OFFSET, -DUAL_OFFSET) if self.dual else (0,)
+        return [[(self.filter_fov, [0, 0, yaw], [0, 0, filter_angles[i]])
+                 for yaw in yaws]
+                for i in range(num_cameras)]
+
+    @staticmethod
+    def filter_cache_info():
+        """Hit and miss counters of the matched filter cache shared
+        by all the behaviours.
+        """
+        return filter_cache.info()
+
+    def get_engine(self, flows):
+        """Activation engine for all the cameras and filters, rebuilt
+        only if the shape of the flows changes.
+        """
+        shape = (len(flows),) + flows[0].shape
+        if self._engine is None or self._engine.shape != shape:
+            height, width, _ = flows[0].shape
+            # The bank's pages as they are, when it stores these filters
+            filters = self.camera_filter_stack(width, height, len(flows))
+            if filters is None:
+                filters = self.get_matched_filters(flows, dtype=np.float32)
+            self._engine = ActivationEngine(filters, rank=self.rank)
+        return self._engine
+
+    @property
+    def approximation_error(self):
+        """Largest error of the separable filters of the engine (0 with
+        exact filters), None before the engine is built
+        """
+        if self._engine is None:
+            return None
+        return float(self._engine.approximation_error.max())
+
+    def get_sector_modules(self, flows):
+        """One SectorActivation per camera, with the same filter FOV
+        as the camera filters, rebuilt only if the shape of the flows
+        changes.
+        """
+        height, width, _ = flows[0].shape
+        if (self._sector_modules is None or
+                self._sector_shape != (height, width) or
+                len(self._sector_modules) != len(flows)):
+            self._sector_shape = (height, width)
+            self._sector_modules = [SectorActivation(width, height,
+                                                     self.filter_fov)
+                                    for _ in flows]
+            self._sector_edges = sector_edges(width, self.sectors)
+        return self._sector_modules
+
+    def _add_sector_activations(self, flows):
+        """Activations of self.sectors equal sectors of each camera, all
+        with the axis of the camera filter.
+        """
+        for i, module in enumerate(self.get_sector_modules(flows)):
+            module.update(flows[i])
+            self.sector_activations[i] = module.get_activations(
+                self._sector_edges, FILTER_ANGLES[i])
 
     def _add_new_activations(self, flows):
-        matched_filters = self.get_matched_filters(flows)
-        if self.dual:
-            activations = [np.mean([
-                get_activation(flow, matched_filters[i][0]),
-                get_activation(flow, matched_filters[i][1])
-                ]) for i, flow in enumerate(flows)]
-    
-        else:
-            activations = [get_activation(flow, matched_filters[i]) 
-                        for i, flow in enumerate(flows)]
+        # Every camera and filter in one call, the mean of the
+        # dual filters is taken by the engine
+        activations = self.get_engine(flows).compute(flows)
+
+        if self.sectors:
+            self._add_sector_activations(flows)
 
         # Append to instance variable
         for i, act in enumerate(activations):
@@ -71,6 +167,17 @@ class AvoidanceBehaviour(object):
         return list(map(lambda x: x if x >= threshold else 0,
                         activations))
 
+    def estimate(self, flows):
+        """Normalised activation of each camera on these flows alone, not
+        added to the activations (e.g. on coarse flows, to decide which
+        cameras need the full resolution flow)
+
+        Returns:
+            list: activation / normalise of each camera
+        """
+        activations = self.get_engine(flows).compute(flows)
+        return [act / self.normalise[i] for i, act in enumerate(activations)]
+
     def reset(self):
         #self._reset = 0
         self.activations = [deque([0,] * 10, maxlen=10) for _ in range(3)]
@@ -80,8 +187,12 @@ class AvoidanceBehaviour(object):
 
     def step(self, flows):
         if self._start:
+            start = self.timer.start()
             self._add_new_activations(flows)
+            self.timer.stop('activation', start)
+            start = self.timer.start()
             direction = self._get_direction()
+            self.timer.stop('behaviour', start)
             return self.activations, direction
         return None, None
  
@@ -90,9 +201,11 @@ class AvoidanceBehaviour(object):
 class TunnelCenteringBehaviour(AvoidanceBehaviour):
 
     def __init__(self, camera, threshold=1.6, normalise=[5000, 110, 5800], 
-                 num_filters=5, dual=False):
+                 num_filters=5, dual=False, filter_bank='', rank=None,
+                 sectors=None):
         super(TunnelCenteringBehaviour, self).__init__(
-            camera, num_filters=num_filters, dual=dual
+            camera, num_filters=num_filters, dual=dual,
+            filter_bank=filter_bank, rank=rank, sectors=sectors
             )
 
         self.threshold = threshold
@@ -117,9 +230,11 @@ class TunnelCenteringBehaviour(AvoidanceBehaviour):
 class SaccadeBehaviour(AvoidanceBehaviour):
 
     def __init__(self, camera, threshold=1.65, normalise=[4000, 85, 4500], 
-                 num_filters=5, dual=False):
+                 num_filters=5, dual=False, filter_bank='', rank=None,
+                 sectors=None):
         super(SaccadeBehaviour, self).__init__(
-            camera, num_filters=num_filters, dual=dual
+            camera, num_filters=num_filters, dual=dual,
+            filter_bank=filter_bank, rank=rank, sectors=sectors
             )
 
         self.threshold = threshold
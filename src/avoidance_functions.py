@@ -1,7 +1,7 @@
 from __future__ import division
 import numpy as np
 from camera_labels import *
-from matchedFilters import MatchedFilter
+from matchedFilters import MatchedFilter, separable_factors, get_matched_filter
 
 
 def get_activation(flow, mf):
@@ -52,5 +52,212 @@ def report_direction(dir, num_left, num_right, left_act, right_act):
         # print('  - Left  activation: ' + str(round(sum(left_act), 2)))
         # print('  - Right activation: ' + str(round(sum(right_act), 2)) + '\n')
 
-        
-        
\ No newline at end of file
+
+class ActivationEngine(object):
+    """Compute the activations of every camera and matched filter at once.
+
+    The camera flows are copied into one preallocated (C, H, W, 2) buffer
+    and every filter is evaluated with a single einsum into a reused
+    output array, so no arrays are allocated per frame.
+
+    With a rank, each filter component is replaced by its separable
+    approximation (see separable_factors), and the activation becomes a
+    column-weighted reduction of the flow followed by a row-weighted one.
+    The flow is still read once, but as BLAS matrix products instead of
+    an elementwise product, and each filter is stored in (H + W) * rank
+    values instead of H * W.
+
+    Args:
+        filters (list): for each camera, a matched filter array (H, W, 2)
+                        or a tuple of them (dual mode), or all of them
+                        stacked in a (C, K, H, W, 2) array, used without
+                        a copy if it has the dtype (e.g. a view of a
+                        memory-mapped filter bank)
+        dtype (numpy dtype): dtype of the buffers. Defaults to np.float32.
+        rank (int, optional): use the separable approximation with this
+                              rank. Defaults to None (exact filters).
+    """
+
+    def __init__(self, filters, dtype=np.float32, rank=None):
+        if isinstance(filters, np.ndarray):
+            num_cams, num_filters, height, width, _ = filters.shape
+        else:
+            filters = [f if isinstance(f, tuple) else (f,) for f in filters]
+            num_cams, num_filters = len(filters), len(filters[0])
+            height, width, _ = filters[0][0].shape
+        self._shape = (num_cams, height, width, 2)
+        self.rank = rank
+
+        self.responses = np.zeros((num_cams, num_filters), dtype=dtype)
+        self.activations = np.zeros(num_cams, dtype=np.float64)
+
+        if rank:
+            self._init_separable(filters, dtype, rank)
+        else:
+            # (C, K, H, W, 2): K filters per camera
+            self.filters = np.asarray(filters, dtype=dtype)
+            self.flows = np.zeros(self._shape, dtype=dtype)
+            # Exact filters
+            self.approximation_error = np.zeros((num_cams, num_filters))
+
+    def _init_separable(self, filters, dtype, rank):
+        """Factorise the filters and allocate the low-rank buffers.
+        """
+        num_cams, num_filters = len(filters), len(filters[0])
+        _, height, width, _ = self._shape
+
+        # The flows keep their interleaved (H, W * 2) rows, so the column
+        # weights of component d go to the d-th entry of each pixel:
+        # (C, K, W * 2, 2 * r) and the row weights (C, K, H, 2 * r)
+        self.columns = np.zeros((num_cams, num_filters, width * 2, 2 * rank),
+                                dtype=dtype)
+        self.rows = np.zeros((num_cams, num_filters, height, 2 * rank),
+                             dtype=dtype)
+        self.approximation_error = np.zeros((num_cams, num_filters))
+        for c, camera_filters in enumerate(filters):
+            for k, mf in enumerate(camera_filters):
+                U, V, error = separable_factors(np.asarray(mf), rank)
+                for d in range(2):
+                    self.columns[c, k, d::2, d * rank:(d + 1) * rank] = V[d]
+                    self.rows[c, k, :, d * rank:(d + 1) * rank] = U[d]
+                self.approximation_error[c, k] = error
+
+        self.flows = np.zeros((num_cams, 1, height, width * 2), dtype=dtype)
+        self._partial = np.zeros((num_cams, num_filters, height, 2 * rank),
+                                 dtype=dtype)
+
+    @property
+    def shape(self):
+        """(C, H, W, 2) shape of the flows the engine expects.
+        """
+        return self._shape
+
+    def compute(self, flows):
+        """Get the activation of every camera.
+
+        With several filters per camera the activation is the mean of the
+        absolute responses, as with get_activation on each filter.
+
+        Args:
+            flows (list): optic flow arrays, one per camera
+
+        Returns:
+            np.ndarray: activations, reused on the next call
+        """
+        if self.rank:
+            self._compute_separable(flows)
+        else:
+            for i, flow in enumerate(flows):
+                self.flows[i] = flow
+
+            np.einsum('chwd,ckhwd->ck', self.flows, self.filters,
+                      out=self.responses)
+        np.abs(self.responses, out=self.responses)
+        np.mean(self.responses, axis=1, out=self.activations)
+        return self.activations
+
+    def _compute_separable(self, flows):
+        """Responses of the separable filters into self.responses.
+        """
+        _, height, _, _ = self._shape
+        for i, flow in enumerate(flows):
+            self.flows[i, 0] = flow.reshape(height, -1)
+
+        # Column-weighted reduction of each row, then row-weighted sum
+        np.matmul(self.flows, self.columns, out=self._partial)
+        np.einsum('ckhq,ckhq->ck', self._partial, self.rows,
+                  out=self.responses)
+
+
+def sector_edges(width, num_sectors):
+    """Column edges splitting a camera into equal contiguous sectors.
+
+    Args:
+        width (int): camera width in pixels
+        num_sectors (int): number of sectors
+
+    Returns:
+        np.ndarray: num_sectors + 1 column indices
+    """
+    return np.linspace(0, width, num_sectors + 1).astype(int)
+
+
+class SectorActivation(object):
+    """Activations of any contiguous horizontal sectors of a camera from
+    a single pass over the flow.
+
+    A translational matched filter is linear in its axis, so the filter of
+    a horizontal axis at angle a is cos(a) * Fx + sin(a) * Fy, with Fx and
+    Fy the filters of the 0 and 90 degree axes. The flow is projected onto
+    both basis filters once, summed over the rows and accumulated along
+    the columns. The activation of the sector [start, end) is then read
+    in O(1) from the cumulative sums.
+
+    Args:
+        width (int): camera width in pixels
+        height (int): camera height in pixels
+        fov (list): fov x and fov y of the filters in degrees
+        orientation (list, optional): orientation of the filters.
+                                      Defaults to [0.0, 0.0, 0.0].
+        dtype (numpy dtype): dtype of the basis. Defaults to np.float32.
+    """
+
+    def __init__(self, width, height, fov, orientation=[0.0, 0.0, 0.0],
+                 dtype=np.float32):
+        # (2, H, W, 2): basis filters of the 0 and 90 degree axes
+        self.basis = np.array([
+            get_matched_filter(width, height, fov, orientation=orientation,
+                               axis=[0, 0, yaw], dtype=dtype)
+            for yaw in (0, 90)])
+        self._product = np.zeros((2, height, width * 2), dtype=dtype)
+        self._ones = np.ones(height, dtype=dtype)
+        self._interleaved = np.zeros((2, width * 2), dtype=dtype)
+        self._columns = np.zeros((2, width), dtype=dtype)
+        # Leading zero so that sector [start, end) is cum[end] - cum[start]
+        self.cumulative = np.zeros((2, width + 1), dtype=np.float64)
+
+    def update(self, flow):
+        """Project a new flow onto the basis and accumulate the columns.
+
+        Args:
+            flow (np.ndarray): optic flow array
+        """
+        height = len(self._ones)
+        np.multiply(flow.reshape(height, -1),
+                    self.basis.reshape(self._product.shape),
+                    out=self._product)
+        # Row sums as a matmul, then add the two components of each column
+        np.matmul(self._ones, self._product, out=self._interleaved)
+        self._interleaved.reshape(2, -1, 2).sum(axis=2, out=self._columns)
+        np.cumsum(self._columns, axis=1, out=self.cumulative[:, 1:])
+
+    def get_activation(self, start, end, angle):
+        """Activation of one sector of the last flow.
+
+        Args:
+            start (int): first column of the sector
+            end (int): column after the last one of the sector
+            angle (float): yaw of the filter axis in degrees
+
+        Returns:
+            float: activation
+        """
+        x, y = self.cumulative[:, end] - self.cumulative[:, start]
+        angle = np.deg2rad(angle)
+        return abs(np.cos(angle) * x + np.sin(angle) * y)
+
+    def get_activations(self, edges, angles):
+        """Activations of the contiguous sectors between edges.
+
+        Args:
+            edges (list): num_sectors + 1 column edges (see sector_edges)
+            angles (list or float): filter axis yaw of each sector,
+                                    or one for all of them
+
+        Returns:
+            np.ndarray: activation of each sector
+        """
+        edges = np.asarray(edges)
+        angles = np.deg2rad(np.broadcast_to(angles, (len(edges) - 1,)))
+        x, y = self.cumulative[:, edges[1:]] - self.cumulative[:, edges[:-1]]
+        return np.abs(np.cos(angles) * x + np.sin(angles) * y)
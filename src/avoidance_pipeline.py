@@ -0,0 +1,289 @@
+#!/usr/bin/env python2
+from __future__ import division
+import time
+from collections import namedtuple
+import numpy as np
+from camera_labels import *
+from matchedFilters import filter_support
+from opticFlow import OpticFlow
+from flow_backends import make_backend, GradientBackend
+from flow_workers import make_flow_workers
+from quality_control import QualityController
+from avoidance_behaviours import TunnelCenteringBehaviour, SaccadeBehaviour
+from timing import NullTimer
+
+BEHAVIOURS = {
+    'tunnel-centering': TunnelCenteringBehaviour,
+    'saccade': SaccadeBehaviour,
+}
+
+# Flows of the cameras (left, centre, right), the activations, the
+# direction decided (None if no decision) and the quality rungs of the
+# flows (0 is the best)
+PipelineResult = namedtuple('PipelineResult',
+                            'flows activations direction quality')
+
+
+class AvoidancePipeline(object):
+    """Optic flow, activations and avoidance decisions for the three
+    cameras, without ROS: frame-sets in, decisions out. OpticFlowROS is an
+    adapter around it, and the same code runs offline (replay, benchmarks,
+    parameter sweeps).
+
+    Times are the frame stamps, in seconds. After start, and after each
+    decision, the behaviour is paused for a while (the vehicle turns),
+    measured on the stamps of the frames.
+
+    Args:
+        camera (Camera): the camera model (all three cameras are the same)
+        avoidance_type (str): tunnel-centering or saccade. Defaults to
+                              'tunnel-centering'.
+        filter_bank (str, optional): precomputed matched filters
+        flow_backend (str): optic flow backend name. Defaults to
+                            'farneback'.
+        flow_backend_params (dict): parameters of the backend
+        camera_backends (dict): camera -> (backend name, parameters) of
+                                the cameras that use another backend
+        warm_start (bool): start each flow from the previous one
+        gate_threshold (float): frame difference below which the flow is
+                                not computed, 0 disables the gating (see
+                                OpticFlow). Defaults to 0.
+        gate_level (int): downsampling octaves of the gate. Defaults to 3.
+        gate_mode (str): flow of the static frames, hold or zero.
+                         Defaults to 'hold'.
+        cascade_level (int): coarse to fine cascade, the flows are
+                             computed on the frames downsampled by
+                             2**cascade_level, and at full resolution for
+                             the cameras whose coarse activation is within
+                             cascade_margin of the behaviour threshold.
+                             Defaults to 0 (always full resolution).
+        cascade_margin (float): refine the cameras whose normalised coarse
+                                activation is above
+                                (1 - cascade_margin) * threshold. Defaults
+                                to 0.5.
+        rois (dict): camera -> (x, y, w, h) region the full resolution
+                     flow is computed in (see OpticFlow)
+        roi_threshold (float): for the cameras without a roi, the roi
+                               where their filter weighs at least this
+                               fraction of its largest weight (see
+                               filter_support). Defaults to 0 (no roi).
+        roi_margin (int): pixels added around the rois. Defaults to 8.
+        quality_deadline (float): flow time of a frame-set in seconds that
+                                  the QualityController keeps under by
+                                  lowering the flow quality, 0 disables it.
+                                  Defaults to 0.
+        quality_priorities (dict): camera -> priority, the cameras of
+                                   lower priority are degraded first.
+                                   Defaults to the centre camera last.
+        workers (str): serial, threads or processes. Defaults to 'serial'.
+        cv_threads (int, optional): OpenCV threads per worker
+        react (bool): pause and reset after a decision. Defaults to True,
+                      False only records (data collection).
+        timer (StageTimer, optional): times the flow, activation and
+                                      behaviour stages
+    """
+    # seconds before the first decision
+    START_DELAY = 4
+    # pause after a decision, and of the centre camera after a large turn
+    PAUSE_LARGE_TURN = 3
+    PAUSE_SACCADE = 2
+    PAUSE = 1
+    CENTRE_PAUSE = 5
+    LARGE_TURN = 45
+
+    def __init__(self, camera, avoidance_type='tunnel-centering',
+                 filter_bank='', flow_backend='farneback',
+                 flow_backend_params={}, camera_backends={},
+                 warm_start=False, gate_threshold=0.0,
+                 gate_level=3, gate_mode='hold', cascade_level=0,
+                 cascade_margin=0.5, rois={}, roi_threshold=0.0,
+                 roi_margin=8, quality_deadline=0.0,
+                 quality_priorities={C0: 1}, workers='serial',
+                 cv_threads=None, react=True, timer=None):
+        if avoidance_type not in BEHAVIOURS:
+            raise ValueError('Unknown avoidance type {}, use one of {}'.format(
+                avoidance_type, ', '.join(sorted(BEHAVIOURS))))
+        self.cam = camera
+        self.avoidance_type = avoidance_type
+        self.react = react
+        self.timer = timer or NullTimer()
+
+        # left, centre, right
+        self.cameras = [C45, C0, CN45]
+
+        self.behaviour = BEHAVIOURS[avoidance_type](camera,
+                                                    filter_bank=filter_bank)
+        self.behaviour.timer = self.timer
+        self.cascade = cascade_level > 0
+        self.refine_above = (1 - cascade_margin) * self.behaviour.threshold
+
+        rois = dict(rois)
+        if roi_threshold > 0:
+            filters = self.behaviour.camera_filters(camera.w, camera.h)
+            for cam, mf in zip(self.cameras, filters):
+                rois.setdefault(cam, filter_support(mf, roi_threshold))
+
+        # Optic flow, one backend instance per camera
+        backends = {cam: camera_backends.get(
+                        cam, (flow_backend, flow_backend_params))
+                    for cam in self.cameras}
+        for cam, (name, params) in backends.items():
+            if name == GradientBackend.name:
+                # the basis must span the behaviour's filters
+                backends[cam] = (name, dict({'fov': self.behaviour.filter_fov},
+                                            **params))
+        self.modules = {
+            cam: OpticFlow(camera_instance=camera,
+                           backend=make_backend(backends[cam][0],
+                                                **backends[cam][1]),
+                           warm_start=warm_start,
+                           gate_threshold=gate_threshold,
+                           gate_level=gate_level, gate_mode=gate_mode,
+                           cascade_level=cascade_level,
+                           roi=rois.get(cam), roi_margin=roi_margin,
+                           adaptive=quality_deadline > 0)
+            for cam in self.cameras
+        }
+        self.flow_workers = make_flow_workers(self.modules, workers,
+                                              cv_threads)
+        self.quality_controller = None
+        if quality_deadline > 0:
+            self.quality_controller = QualityController(
+                {cam: len(module.ladder)
+                 for cam, module in self.modules.items()},
+                quality_deadline, quality_priorities)
+
+        self.initial_times = {cam: 0.0 for cam in self.cameras}
+        self.last_flows = {cam: [] for cam in self.cameras}
+
+        # stamp from which decisions are made, None until started
+        self.ready_time = None
+        # stamp until which the centre flow is ignored
+        self.centre_paused_until = 0.0
+
+    def start(self, this_time):
+        """Start the behaviour, deciding from START_DELAY seconds after
+        the first start. Starting again (e.g. on every flight state
+        message) neither delays the decisions nor ends a pause.
+
+        Args:
+            this_time (float): current time, in the clock of the stamps
+        """
+        self.behaviour.start()
+        if self.ready_time is None:
+            self.ready_time = this_time + self.START_DELAY
+
+    def is_ready(self, this_time):
+        return self.ready_time is not None and this_time >= self.ready_time
+
+    def get_flows(self, frame_set, refine=False):
+        """Step the optic flow of the cameras in a frame-set
+
+        Args:
+            frame_set (dict): camera -> (image, stamp). Cameras missing
+                              from the set reuse their last flow.
+            refine (bool): refine the coarse flows of the cascade that are
+                           close to the threshold. Defaults to False.
+
+        Returns:
+            list: flows of the cameras (left, centre, right), or None until
+                  every camera has a flow
+        """
+        frames = {}
+        for cam, (image, stamp) in frame_set.items():
+            # if we don't subtract the initial camera time
+            # the frame difference can be 0.0 due to precision errors
+            if not self.initial_times[cam]:
+                self.initial_times[cam] = stamp
+            frames[cam] = (image, stamp - self.initial_times[cam])
+
+        start = self.timer.start()
+        wall_start = time.time()
+        new_flows = self.flow_workers.step(frames)
+
+        flows = []
+        for cam in self.cameras:
+            if cam in new_flows:
+                if new_flows[cam] is None:
+                    return None
+                self.last_flows[cam] = new_flows[cam]
+            elif len(self.last_flows[cam]) == 0:
+                return None
+            flows.append(self.last_flows[cam])
+
+        if refine:
+            self._refine(flows, new_flows)
+        self.timer.stop('flow', start)
+        if self.quality_controller is not None:
+            changes = self.quality_controller.update(time.time() - wall_start)
+            if changes:
+                self.flow_workers.set_quality(changes)
+        return flows
+
+    def quality(self):
+        """Quality rungs of the next flows of the cameras (left, centre,
+        right), 0 is the best
+        """
+        if self.quality_controller is None:
+            return [0] * len(self.cameras)
+        return [self.quality_controller.levels[cam] for cam in self.cameras]
+
+    def _refine(self, flows, new_flows):
+        """Replace the coarse flows close to the threshold by the full
+        resolution ones, except those of gated (static) frames, which are
+        held
+        """
+        estimates = self.behaviour.estimate(flows)
+        stats = self.flow_workers.step_stats()
+        cams = [cam for cam, estimate in zip(self.cameras, estimates)
+                if cam in new_flows and not stats[cam]['gated']
+                and estimate >= self.refine_above]
+        for cam, flow in self.flow_workers.refine(cams).items():
+            self.last_flows[cam] = flow
+            flows[self.cameras.index(cam)] = flow
+
+    def step(self, frame_set):
+        """Process a frame-set
+
+        Args:
+            frame_set (dict): camera -> (image, stamp), see get_flows
+
+        Returns:
+            PipelineResult: the flows, activations, direction and quality,
+                            or None until every camera has a flow
+        """
+        quality = self.quality()
+        this_time = max(stamp for _, stamp in frame_set.values())
+        flows = self.get_flows(frame_set,
+                               refine=self.cascade and self.is_ready(this_time))
+        if flows is None:
+            return None
+
+        if this_time < self.centre_paused_until:
+            # Not in place: the flow buffer is the next warm start
+            flows[1] = np.zeros_like(flows[1])
+
+        activations, direction = None, None
+        if self.is_ready(this_time):
+            activations, direction = self.behaviour.step(flows)
+            if direction and self.react:
+                self._pause(direction, this_time)
+        return PipelineResult(flows, activations, direction, quality)
+
+    def _pause(self, direction, this_time):
+        """Reset and wait for the turn after a decision
+        """
+        self.behaviour.reset()
+        # The flow field changes after the turn, cold start
+        self.flow_workers.reset()
+        if abs(direction) > self.LARGE_TURN:
+            self.centre_paused_until = this_time + self.CENTRE_PAUSE
+            pause = self.PAUSE_LARGE_TURN
+        elif self.avoidance_type == 'saccade':
+            pause = self.PAUSE_SACCADE
+        else:
+            pause = self.PAUSE
+        self.ready_time = this_time + pause
+
+    def close(self):
+        self.flow_workers.close()
@@ -0,0 +1,1024 @@
+#!/usr/bin/env python2
+"""Benchmarks for the avoidance pipeline, without ROS.
+
+Run from this directory, e.g.:
+    python benchmark.py filters
+    python benchmark.py --json run.json
+    python benchmark.py --json new.json --baseline run.json --max_regression 0.2
+"""
+from __future__ import division
+import json
+import os
+import platform
+import sys
+import time
+from collections import namedtuple, deque
+import numpy as np
+import cv2
+from matchedFilters import (MatchedFilter, matched_filter_bank,
+                            camera_rays, rotation_matrix, get_matched_filter,
+                            filter_support, FILTER_ANGLES)
+from avoidance_functions import (get_activation, ActivationEngine,
+                                 SectorActivation, sector_edges)
+import activation
+from avoidance_behaviours import TunnelCenteringBehaviour, SaccadeBehaviour
+from obstacleFinder import ActivationDecisionMaker
+from flow_backends import make_backend
+from flow_workers import make_flow_workers
+from camera import Camera
+from opticFlow import OpticFlow, FrameRing, FrameGate
+from image_ingest import ImageIngest
+from preprocess import Preprocessor
+from timing import StageTimer, NullTimer
+
+# Stand-in for sensor_msgs/CameraInfo
+CameraInfo = namedtuple('CameraInfo', 'height width')
+ImageMsg = namedtuple('ImageMsg', 'height width step encoding data')
+
+
+# (width, height) used in the launch files
+LAUNCH_RESOLUTIONS = [(135, 40), (235, 150), (240, 135)]
+
+
+def time_call(fn, repeat=5, number=1):
+    """Time a function call.
+
+    Args:
+        fn (callable): function to time, called with no arguments
+        repeat (int): number of timing runs
+        number (int): calls per timing run
+
+    Returns:
+        dict: best and mean milliseconds per call
+    """
+    times = []
+    for _ in range(repeat):
+        start = time.time()
+        for _ in range(number):
+            fn()
+        times.append((time.time() - start) / number)
+    return {'best_ms': 1000 * min(times), 'mean_ms': 1000 * np.mean(times)}
+
+
+def loop_rotate_viewing_directions(D, rot):
+    """Reference per-pixel rotation loop (the original implementation).
+    """
+    for ii in range(D.shape[0]):
+        for jj in range(D.shape[1]):
+            D[ii, jj, :] = np.matmul(rot, D[ii, jj, :])
+    return D
+
+
+def bench_filters(resolutions=LAUNCH_RESOLUTIONS, repeat=3):
+    """Compare the per-pixel rotation loop with the vectorized ray table,
+    and a bank of three filters built one by one against a single call.
+    """
+    fov = (9, 9)
+    axes = [[0, 0, -45], [0, 0, 0], [0, 0, 45]]
+    orientations = [[0, 0, 0]] * 3
+    rot = rotation_matrix([0.0, 0.0, 10.0])
+    fovx, fovy = MatchedFilter._get_fov(fov)
+
+    results = []
+    for w, h in resolutions:
+        rays = camera_rays(w, h, fovx, fovy)
+        loop = time_call(
+            lambda: loop_rotate_viewing_directions(rays.copy(), rot),
+            repeat=repeat)
+        vectorized = time_call(
+            lambda: MatchedFilter(w, h, fov, orientation=[0, 0, 10]),
+            repeat=repeat)
+        single = time_call(
+            lambda: [MatchedFilter(w, h, fov, orientation=o, axis=a)
+                     for o, a in zip(orientations, axes)],
+            repeat=repeat)
+        bank = time_call(
+            lambda: matched_filter_bank(w, h, fov, orientations, axes),
+            repeat=repeat)
+        results.append({'resolution': '{}x{}'.format(w, h),
+                        'loop_rotation_ms': loop['best_ms'],
+                        'matched_filter_ms': vectorized['best_ms'],
+                        'filters_one_by_one_ms': single['best_ms'],
+                        'filter_bank_ms': bank['best_ms']})
+    return results
+
+
+def synthetic_flows(width, height, num_cams=3, seed=0):
+    """Smooth random flows, one per camera.
+    """
+    rng = np.random.RandomState(seed)
+    y, x = np.mgrid[0:height, 0:width] / float(max(width, height))
+    flows = []
+    for _ in range(num_cams):
+        a = rng.randn(6)
+        flow = np.dstack([a[0] + a[1] * x + a[2] * y,
+                          a[3] + a[4] * x + a[5] * y])
+        flow += 0.1 * rng.randn(height, width, 2)
+        flows.append(flow.astype(np.float32))
+    return flows
+
+
+def bench_activation(resolutions=LAUNCH_RESOLUTIONS, repeat=20, number=10):
+    """Per-filter get_activation against the fused engine, exact and with
+    the separable (low-rank) filters, with the relative activation error.
+    """
+    results = []
+    for w, h in resolutions:
+        flows = synthetic_flows(w, h)
+        filters = [get_matched_filter(w, h, (9, 9), axis=[0, 0, a],
+                                      dtype=np.float32)
+                   for a in FILTER_ANGLES]
+        exact = np.array([get_activation(f, mf)
+                          for f, mf in zip(flows, filters)])
+        row = {'resolution': '{}x{}'.format(w, h),
+               'get_activation_ms': time_call(
+                   lambda: [get_activation(f, mf)
+                            for f, mf in zip(flows, filters)],
+                   repeat=repeat, number=number)['best_ms'],
+               # the normalised variant of the activation module
+               'normalised_activation_ms': time_call(
+                   lambda: [activation.get_activation(f, mf)
+                            for f, mf in zip(flows, filters)],
+                   repeat=repeat, number=number)['best_ms']}
+        for rank in (None, 1, 2):
+            engine = ActivationEngine(filters, rank=rank)
+            name = 'rank_{}'.format(rank) if rank else 'engine'
+            row[name + '_ms'] = time_call(lambda: engine.compute(flows),
+                                          repeat=repeat,
+                                          number=number)['best_ms']
+            error = np.abs(engine.compute(flows) - exact) / exact
+            row[name + '_error'] = float(error.max())
+        results.append(row)
+    return results
+
+
+def bench_sectors(resolutions=LAUNCH_RESOLUTIONS, repeat=20, number=10):
+    """One camera split into 5, 9 and 15 sectors, each with its own
+    filter axis: a full-frame get_activation pass with a masked filter per
+    sector against one SectorActivation pass.
+    """
+    results = []
+    for w, h in resolutions:
+        flow = synthetic_flows(w, h, num_cams=1)[0]
+        module = SectorActivation(w, h, (9, 9))
+        row = {'resolution': '{}x{}'.format(w, h)}
+        for n in (5, 9, 15):
+            edges = sector_edges(w, n)
+            angles = np.linspace(-48, 48, n)
+            masked = []
+            for a, b, angle in zip(edges[:-1], edges[1:], angles):
+                mf = np.zeros((h, w, 2), dtype=np.float32)
+                mf[:, a:b] = get_matched_filter(
+                    w, h, (9, 9), axis=[0, 0, angle])[:, a:b]
+                masked.append(mf)
+
+            def per_sector():
+                return [get_activation(flow, mf) for mf in masked]
+
+            def integral():
+                module.update(flow)
+                return module.get_activations(edges, angles)
+
+            row['{}_passes_ms'.format(n)] = time_call(
+                per_sector, repeat=repeat, number=number)['best_ms']
+            row['{}_integral_ms'.format(n)] = time_call(
+                integral, repeat=repeat, number=number)['best_ms']
+        results.append(row)
+    return results
+
+
+def synthetic_frames(width, height, num_frames=20, seed=0):
+    """Frames of a smooth random texture that looms and drifts sideways,
+    roughly what the cameras see when flying towards an obstacle.
+    """
+    rng = np.random.RandomState(seed)
+    texture = rng.rand(2 * height, 2 * width).astype(np.float32)
+    texture = cv2.GaussianBlur(texture, (0, 0), 3)
+    texture = cv2.normalize(texture, None, 0, 255, cv2.NORM_MINMAX)
+    centre = (width, height)
+    frames = []
+    for t in range(num_frames):
+        warp = cv2.getRotationMatrix2D(centre, 0, 1 + 0.01 * t)
+        warp[:, 2] += (0.5 * t - width / 2.0, -height / 2.0)
+        frames.append(cv2.warpAffine(texture, warp, (width, height))
+                      .astype(np.uint8))
+    return np.array(frames)
+
+
+def load_frames(path):
+    """Recorded black and white frames, from a (N, H, W) .npy file or a
+    directory of images (sorted by name).
+    """
+    if os.path.isdir(path):
+        names = sorted(os.listdir(path))
+        return np.array([cv2.imread(os.path.join(path, name),
+                                    cv2.IMREAD_GRAYSCALE) for name in names])
+    return np.load(path)
+
+
+FLOW_BACKENDS = [('farneback', {}),
+                 ('dis', {'preset': 'ultrafast'}),
+                 ('dis', {'preset': 'fast'}),
+                 ('dis', {'preset': 'medium'}),
+                 ('lk', {})]
+
+
+def bench_flow_backends(resolutions=LAUNCH_RESOLUTIONS, frames=None,
+                        backends=FLOW_BACKENDS):
+    """Milliseconds per frame of each optic flow backend, and how well the
+    centre camera activations agree with Farneback on the same frames
+    (correlation and median relative error over the sequence).
+
+    Args:
+        frames (np.ndarray, optional): recorded (N, H, W) frames. Defaults
+                                       to synthetic frames at each
+                                       resolution.
+    """
+    sequences = ([frames] if frames is not None else
+                 [synthetic_frames(w, h) for w, h in resolutions])
+    results = []
+    for seq in sequences:
+        h, w = seq.shape[1:]
+        mf = get_matched_filter(w, h, (9, 9))
+        reference = None
+        for name, params in backends:
+            backend = make_backend(name, **params)
+            activations, times = [], []
+            for prev, nxt in zip(seq[:-1], seq[1:]):
+                start = time.time()
+                flow = backend.compute(prev, nxt)
+                times.append(time.time() - start)
+                activations.append(get_activation(flow, mf))
+            activations = np.array(activations)
+            if reference is None:
+                reference = activations
+            label = name + ('-' + params['preset'] if 'preset' in params
+                            else '')
+            results.append({
+                'resolution': '{}x{}'.format(w, h),
+                'backend': label,
+                'ms_per_frame': 1000 * float(np.median(times)),
+                'correlation': float(np.corrcoef(activations, reference)[0, 1]),
+                'median_rel_error': float(np.median(
+                    np.abs(activations - reference) / reference))})
+    return results
+
+
+def bench_step_allocations(resolutions=LAUNCH_RESOLUTIONS, frames=None,
+                           backends=FLOW_BACKENDS, warmup=5):
+    """Memory allocated by OpticFlow.step once warmed up, traced with
+    tracemalloc (Python 3.9+). Allocations inside OpenCV are not visible,
+    NumPy arrays and the Python objects of the cv2 bindings are.
+
+    Args:
+        frames (np.ndarray, optional): recorded (N, H, W) frames. Defaults
+                                       to synthetic frames at each
+                                       resolution.
+    """
+    import tracemalloc
+
+    sequences = ([frames] if frames is not None else
+                 [synthetic_frames(w, h) for w, h in resolutions])
+    results = []
+    for seq in sequences:
+        h, w = seq.shape[1:]
+        for name, params in backends:
+            flow = OpticFlow(Camera(CameraInfo(h, w)),
+                             backend=make_backend(name, **params))
+            for i in range(warmup):
+                flow.step(seq[i], i)
+
+            steps = len(seq) - warmup
+            peaks = [0] * steps
+            tracemalloc.start()
+            start, _ = tracemalloc.get_traced_memory()
+            for i in range(steps):
+                before, _ = tracemalloc.get_traced_memory()
+                tracemalloc.reset_peak()
+                flow.step(seq[warmup + i], warmup + i)
+                _, peak = tracemalloc.get_traced_memory()
+                peaks[i] = peak - before
+            end, _ = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+
+            label = name + ('-' + params['preset'] if 'preset' in params
+                            else '')
+            results.append({
+                'resolution': '{}x{}'.format(w, h),
+                'backend': label,
+                'steps': steps,
+                'peak_bytes_per_step': max(peaks),
+                'retained_bytes': end - start})
+    return results
+
+
+def bench_warm_start(resolutions=LAUNCH_RESOLUTIONS, frames=None,
+                     backends=[('farneback', {}), ('dis', {'preset': 'fast'})]):
+    """Cold against warm-started OpticFlow: milliseconds per frame and
+    agreement of the centre camera activations.
+
+    Args:
+        frames (np.ndarray, optional): recorded (N, H, W) frames. Defaults
+                                       to synthetic frames at each
+                                       resolution.
+    """
+    sequences = ([frames] if frames is not None else
+                 [synthetic_frames(w, h, num_frames=40)
+                  for w, h in resolutions])
+    results = []
+    for seq in sequences:
+        h, w = seq.shape[1:]
+        mf = get_matched_filter(w, h, (9, 9))
+        for name, params in backends:
+            runs = {}
+            for warm in (False, True):
+                flow = OpticFlow(Camera(CameraInfo(h, w)),
+                                 backend=make_backend(name, **params),
+                                 warm_start=warm)
+                activations, times = [], []
+                for i, frame in enumerate(seq):
+                    start = time.time()
+                    out = flow.step(frame, 0.1 * i)
+                    times.append(time.time() - start)
+                    if out is not None:
+                        activations.append(get_activation(out, mf))
+                runs[warm] = (np.array(activations),
+                              1000 * float(np.median(times[3:])))
+            cold, warm = runs[False], runs[True]
+            results.append({
+                'resolution': '{}x{}'.format(w, h),
+                'backend': name,
+                'cold_ms': cold[1],
+                'warm_ms': warm[1],
+                'median_rel_error': float(np.median(
+                    np.abs(warm[0] - cold[0]) / cold[0]))})
+    return results
+
+
+def hover_frames(seq, num_frames=20, noise=2.0, seed=0):
+    """A hover after the flight: the last frame of a sequence repeated
+    with sensor noise
+    """
+    rng = np.random.RandomState(seed)
+    hover = [np.clip(seq[-1] + rng.normal(0, noise, seq[-1].shape), 0, 255)
+             .astype(np.uint8) for _ in range(num_frames)]
+    return np.concatenate([seq, hover])
+
+
+def bench_gating(resolutions=LAUNCH_RESOLUTIONS, frames=None,
+                 threshold=1.0, level=3):
+    """OpticFlow with and without frame-change gating on a flight followed
+    by a hover: milliseconds per frame, steps gated and the cost of the
+    gate itself.
+
+    Args:
+        frames (np.ndarray, optional): recorded (N, H, W) frames, the hover
+                                       is appended. Defaults to synthetic
+                                       frames at each resolution.
+    """
+    sequences = ([frames] if frames is not None else
+                 [synthetic_frames(w, h, num_frames=20)
+                  for w, h in resolutions])
+    results = []
+    for seq in sequences:
+        seq = hover_frames(seq)
+        h, w = seq.shape[1:]
+        row = {'resolution': '{}x{}'.format(w, h)}
+        for gated in (False, True):
+            flow = OpticFlow(Camera(CameraInfo(h, w)),
+                             gate_threshold=threshold if gated else 0.0,
+                             gate_level=level)
+            start = time.time()
+            for i, frame in enumerate(seq):
+                flow.step(frame, 0.1 * i)
+            key = 'gated_ms' if gated else 'ungated_ms'
+            row[key] = 1000 * (time.time() - start) / len(seq)
+        row['gated_steps'] = flow.gated_steps
+        row['flow_steps'] = flow.warm_steps + flow.cold_steps
+        gate = FrameGate(h, w, threshold, level)
+        frames_iter = iter(np.tile(seq, (20, 1, 1)))
+        row.update({'gate_' + k: v for k, v in time_call(
+            lambda: gate.changed(next(frames_iter)), 5, 100).items()})
+        results.append(row)
+    return results
+
+
+def bench_cascade(resolutions=LAUNCH_RESOLUTIONS, frames=None,
+                  levels=(1, 2, 3)):
+    """Coarse to fine cascade against the full resolution flow:
+    milliseconds per coarse step and per refinement, and the agreement of
+    the centre camera activations of the coarse and refined flows with the
+    full resolution ones.
+
+    Args:
+        frames (np.ndarray, optional): recorded (N, H, W) frames. Defaults
+                                       to synthetic frames at each
+                                       resolution.
+    """
+    sequences = ([frames] if frames is not None else
+                 [synthetic_frames(w, h, num_frames=30)
+                  for w, h in resolutions])
+    results = []
+    for seq in sequences:
+        h, w = seq.shape[1:]
+        mf = get_matched_filter(w, h, (9, 9))
+        for level in levels:
+            full = OpticFlow(Camera(CameraInfo(h, w)))
+            cascade = OpticFlow(Camera(CameraInfo(h, w)), cascade_level=level)
+            times = {'full': [], 'coarse': [], 'refine': []}
+            errors = {'coarse': [], 'refined': []}
+            for i, frame in enumerate(seq):
+                start = time.time()
+                reference = full.step(frame, 0.1 * i)
+                times['full'].append(time.time() - start)
+                start = time.time()
+                coarse = cascade.step(frame, 0.1 * i)
+                times['coarse'].append(time.time() - start)
+                if reference is None:
+                    continue
+                expected = get_activation(reference, mf)
+                errors['coarse'].append(
+                    abs(get_activation(coarse, mf) - expected) / expected)
+                start = time.time()
+                refined = cascade.refine()
+                times['refine'].append(time.time() - start)
+                errors['refined'].append(
+                    abs(get_activation(refined, mf) - expected) / expected)
+            row = {'resolution': '{}x{}'.format(w, h), 'level': level}
+            for name, values in times.items():
+                row[name + '_ms'] = 1000 * float(np.median(values[3:]))
+            for name, values in errors.items():
+                row[name + '_rel_error'] = float(np.median(values))
+            results.append(row)
+    return results
+
+
+def bench_gradient(resolutions=LAUNCH_RESOLUTIONS, frames=None,
+                   params=({'iterations': 1}, {}, {'levels': 0})):
+    """The gradient (matched filter subspace) backend against the dense
+    Farneback flow: milliseconds per frame and agreement of the
+    activations of the filter of each camera (axes -45, 0 and 45).
+
+    Args:
+        frames (np.ndarray, optional): recorded (N, H, W) frames. Defaults
+                                       to synthetic frames at each
+                                       resolution.
+    """
+    sequences = ([frames] if frames is not None else
+                 [synthetic_frames(w, h, num_frames=30)
+                  for w, h in resolutions])
+    results = []
+    for seq in sequences:
+        h, w = seq.shape[1:]
+        mfs = [get_matched_filter(w, h, (9, 9), axis=[0, 0, angle])
+               for angle in FILTER_ANGLES]
+        runs = []
+        for name, backend_params in ([('farneback', {})] +
+                                     [('gradient', p) for p in params]):
+            flow = OpticFlow(Camera(CameraInfo(h, w)),
+                             backend=make_backend(name, **backend_params))
+            activations, times = [], []
+            for i, frame in enumerate(seq):
+                start = time.time()
+                out = flow.step(frame, 0.1 * i)
+                times.append(time.time() - start)
+                if out is not None:
+                    activations.append([get_activation(out, mf)
+                                        for mf in mfs])
+            runs.append((name, backend_params, np.array(activations),
+                         1000 * float(np.median(times[3:]))))
+        reference = runs[0][2]
+        for name, backend_params, activations, ms in runs:
+            row = {'resolution': '{}x{}'.format(w, h), 'backend': name,
+                   'params': json.dumps(backend_params, sort_keys=True),
+                   'ms_per_frame': ms}
+            errors = np.median(np.abs(activations - reference) / reference,
+                               axis=0)
+            for angle, error in zip(FILTER_ANGLES, errors):
+                row['rel_error_{}'.format(angle)] = float(error)
+            results.append(row)
+    return results
+
+
+def bench_roi(resolutions=LAUNCH_RESOLUTIONS, frames=None,
+              backends=[('farneback', {}), ('dis', {'preset': 'fast'})],
+              thresholds=(0.9, 0.99), margin=8):
+    """Flow computed in the region where each camera's filter weighs at
+    least a fraction of its maximum (see filter_support), against the
+    whole frame: fraction of the frame in the roi, milliseconds per frame
+    and agreement of the activations of the camera filter.
+
+    Args:
+        frames (np.ndarray, optional): recorded (N, H, W) frames. Defaults
+                                       to synthetic frames at each
+                                       resolution.
+    """
+    sequences = ([frames] if frames is not None else
+                 [synthetic_frames(w, h, num_frames=30)
+                  for w, h in resolutions])
+    results = []
+    for seq in sequences:
+        h, w = seq.shape[1:]
+        for angle in FILTER_ANGLES:
+            mf = get_matched_filter(w, h, (9, 9), axis=[0, 0, angle])
+            rois = [None] + [filter_support(mf, t) for t in thresholds]
+            for name, params in backends:
+                runs = []
+                for roi in rois:
+                    flow = OpticFlow(Camera(CameraInfo(h, w)),
+                                     backend=make_backend(name, **params),
+                                     roi=roi, roi_margin=margin)
+                    activations, times = [], []
+                    for i, frame in enumerate(seq):
+                        start = time.time()
+                        out = flow.step(frame, 0.1 * i)
+                        times.append(time.time() - start)
+                        if out is not None:
+                            activations.append(get_activation(out, mf))
+                    runs.append((flow.roi_fraction, np.array(activations),
+                                 1000 * float(np.median(times[3:]))))
+                reference = runs[0][1]
+                for threshold, (fraction, activations, ms) in zip(
+                        [0.0] + list(thresholds), runs):
+                    results.append({
+                        'resolution': '{}x{}'.format(w, h),
+                        'axis': angle,
+                        'backend': name,
+                        'threshold': threshold,
+                        'roi_fraction': fraction,
+                        'ms_per_frame': ms,
+                        'median_rel_error': float(np.median(
+                            np.abs(activations - reference) / reference))})
+    return results
+
+
+def bench_quality(resolutions=LAUNCH_RESOLUTIONS, frames=None,
+                  backends=('farneback', 'dis', 'lk', 'gradient')):
+    """Quality ladders of the backends (see QualityController):
+    milliseconds per frame of each rung and agreement of the activations of
+    the filter of each camera (axes -45, 0 and 45) with the best rung.
+
+    Args:
+        frames (np.ndarray, optional): recorded (N, H, W) frames. Defaults
+                                       to synthetic frames at each
+                                       resolution.
+    """
+    sequences = ([frames] if frames is not None else
+                 [synthetic_frames(w, h, num_frames=30)
+                  for w, h in resolutions])
+    results = []
+    for seq in sequences:
+        h, w = seq.shape[1:]
+        mfs = [get_matched_filter(w, h, (9, 9), axis=[0, 0, angle])
+               for angle in FILTER_ANGLES]
+        for name in backends:
+            rungs = len(OpticFlow(Camera(CameraInfo(h, w)),
+                                  backend=make_backend(name),
+                                  adaptive=True).ladder)
+            runs = []
+            for quality in range(rungs):
+                flow = OpticFlow(Camera(CameraInfo(h, w)),
+                                 backend=make_backend(name), adaptive=True)
+                flow.set_quality(quality)
+                activations, times = [], []
+                for i, frame in enumerate(seq):
+                    start = time.time()
+                    out = flow.step(frame, 0.1 * i)
+                    times.append(time.time() - start)
+                    if out is not None:
+                        activations.append([get_activation(out, mf)
+                                            for mf in mfs])
+                runs.append((np.array(activations),
+                             1000 * float(np.median(times[3:]))))
+            reference = runs[0][0]
+            for quality, (activations, ms) in enumerate(runs):
+                row = {'resolution': '{}x{}'.format(w, h), 'backend': name,
+                       'quality': quality, 'ms_per_frame': ms}
+                errors = np.median(np.abs(activations - reference) /
+                                   np.abs(reference), axis=0)
+                for angle, error in zip(FILTER_ANGLES, errors):
+                    row['rel_error_{}'.format(angle)] = float(error)
+                results.append(row)
+    return results
+
+
+def bench_quality_roi(resolutions=LAUNCH_RESOLUTIONS, frames=None,
+                      backends=('farneback', 'dis', 'lk', 'gradient')):
+    """Flow outside the roi of a camera whose quality goes down to the last
+    rung (half resolution) and back up to the best one: the largest flow
+    outside the left third of the frame, which must stay 0.
+
+    Args:
+        frames (np.ndarray, optional): recorded (N, H, W) frames. Defaults
+                                       to synthetic frames at each
+                                       resolution.
+    """
+    sequences = ([frames] if frames is not None else
+                 [synthetic_frames(w, h, num_frames=30)
+                  for w, h in resolutions])
+    results = []
+    for seq in sequences:
+        h, w = seq.shape[1:]
+        roi = (0, 0, w // 3, h)
+        third = len(seq) // 3
+        for name in backends:
+            for cascade_level in (0, 1):
+                flow = OpticFlow(Camera(CameraInfo(h, w)),
+                                 backend=make_backend(name), roi=roi,
+                                 adaptive=True, cascade_level=cascade_level)
+                outside = 0.0
+                for i, frame in enumerate(seq):
+                    down = third <= i < 2 * third
+                    flow.set_quality(len(flow.ladder) - 1 if down else 0)
+                    out = flow.step(frame, 0.1 * i)
+                    if out is not None and cascade_level:
+                        out = flow.refine()
+                    if out is not None:
+                        outside = max(outside,
+                                      float(np.abs(out[:, roi[2]:]).max()))
+                results.append({'resolution': '{}x{}'.format(w, h),
+                                 'backend': name,
+                                 'cascade_level': cascade_level,
+                                 'max_flow_outside_roi': outside})
+    return results
+
+
+def bench_workers(resolutions=LAUNCH_RESOLUTIONS, frames=None,
+                  modes=('serial', 'threads', 'processes'),
+                  backends=[('farneback', {}), ('dis', {'preset': 'fast'})],
+                  num_cams=3):
+    """Latency of one frame-set (the flows of all the cameras, joined)
+    with each flow worker mode. Every camera gets the same frames.
+
+    Args:
+        frames (np.ndarray, optional): recorded (N, H, W) frames. Defaults
+                                       to synthetic frames at each
+                                       resolution.
+    """
+    sequences = ([frames] if frames is not None else
+                 [synthetic_frames(w, h, num_frames=40)
+                  for w, h in resolutions])
+    results = []
+    for seq in sequences:
+        h, w = seq.shape[1:]
+        for name, params in backends:
+            for mode in modes:
+                modules = {cam: OpticFlow(Camera(CameraInfo(h, w)),
+                                          backend=make_backend(name, **params))
+                           for cam in range(num_cams)}
+                workers = make_flow_workers(modules, mode)
+                times = []
+                for i, frame in enumerate(seq):
+                    start = time.time()
+                    workers.step({cam: (frame, 0.1 * i) for cam in modules})
+                    times.append(time.time() - start)
+                workers.close()
+                results.append({
+                    'resolution': '{}x{}'.format(w, h),
+                    'backend': name,
+                    'workers': mode,
+                    'ms_per_frame_set': 1000 * float(np.median(times[2:])),
+                    'p95_ms': 1000 * float(np.percentile(times[2:], 95))})
+    # Leave OpenCV with its default number of threads
+    cv2.setNumThreads(-1)
+    return results
+
+
+def image_messages(frames, encoding='mono8', padding=0):
+    """The frames as sensor_msgs/Image stand-ins, with `padding` bytes
+    at the end of each row
+    """
+    messages = []
+    for frame in frames:
+        if encoding == 'bgr8':
+            frame = cv2.cvtColor(frame, cv2.COLOR_GRAY2BGR)
+        h, w = frame.shape[:2]
+        rows = frame.reshape(h, -1)
+        padded = np.zeros((h, rows.shape[1] + padding), dtype=np.uint8)
+        padded[:, :rows.shape[1]] = rows
+        messages.append(ImageMsg(h, w, padded.shape[1], encoding,
+                                 padded.tobytes()))
+    return messages
+
+
+def bench_ingest(resolutions=LAUNCH_RESOLUTIONS, frames=None,
+                 cases=[('mono8', 0), ('mono8', 16), ('bgr8', 0)]):
+    """Bytes copied per frame from the image message to the FrameRing of
+    OpticFlow, and milliseconds per frame of the ingestion and ring push.
+
+    Args:
+        frames (np.ndarray, optional): recorded (N, H, W) frames. Defaults
+                                       to synthetic frames at each
+                                       resolution.
+    """
+    sequences = ([frames] if frames is not None else
+                 [synthetic_frames(w, h) for w, h in resolutions])
+    results = []
+    for seq in sequences:
+        h, w = seq.shape[1:]
+        for encoding, padding in cases:
+            messages = image_messages(seq, encoding, padding)
+            ingest = ImageIngest()
+            ring = FrameRing(h, w)
+            start = time.time()
+            for i, msg in enumerate(messages):
+                ring.push(ingest(msg), i)
+            elapsed = time.time() - start
+            results.append({
+                'resolution': '{}x{}'.format(w, h),
+                'encoding': encoding,
+                'row_padding': padding,
+                'bytes_copied_per_frame': ((ingest.bytes_copied +
+                                            ring.bytes_copied) /
+                                           len(messages)),
+                'ms_per_frame': 1000 * elapsed / len(messages)})
+    return results
+
+
+class RawCameraInfo(object):
+    """Pinhole CameraInfo stand-in without distortion
+    """
+    def __init__(self, width, height, focal):
+        self.width, self.height = width, height
+        cx, cy = (width - 1) / 2, (height - 1) / 2
+        self.K = [focal, 0, cx, 0, focal, cy, 0, 0, 1]
+        self.D = [0.0] * 5
+        self.R = [1, 0, 0, 0, 1, 0, 0, 0, 1]
+        self.P = [focal, 0, cx, 0, 0, focal, cy, 0, 0, 0, 1, 0]
+
+
+def bench_preprocess(resolutions=LAUNCH_RESOLUTIONS, raw=(640, 360),
+                     repeat=20, number=10):
+    """Milliseconds per frame of the in-node preprocessing, from a raw BGR
+    frame to a grey one at each launch resolution.
+    """
+    raw_w, raw_h = raw
+    info = RawCameraInfo(raw_w, raw_h, focal=raw_w / 2)
+    image = cv2.cvtColor(synthetic_frames(raw_w, raw_h, num_frames=1)[0],
+                         cv2.COLOR_GRAY2BGR)
+    results = []
+    for w, h in resolutions:
+        for interpolation, rectify in ((0, False), (3, False), (1, True)):
+            preprocessor = Preprocessor(info, use_scale=False, width=w,
+                                        height=h, interpolation=interpolation,
+                                        rectify=rectify)
+            row = {'resolution': '{}x{}'.format(w, h),
+                   'interpolation': interpolation,
+                   'rectify': rectify}
+            row.update(time_call(lambda: preprocessor(image), repeat, number))
+            results.append(row)
+    return results
+
+
+def bench_timing(repeat=5, number=100000):
+    """Microseconds per timed stage (start then stop) with timing on and
+    off, against an empty call.
+    """
+    timers = [('none', None), ('null', NullTimer()),
+              ('histogram', StageTimer(['stage']))]
+    results = []
+    for label, timer in timers:
+        if timer is None:
+            fn = lambda: None
+        else:
+            fn = lambda timer=timer: timer.stop('stage', timer.start())
+        best = time_call(fn, repeat, number)['best_ms']
+        results.append({'timer': label, 'us_per_stage': 1000 * best})
+    return results
+
+
+def bench_optic_flow_step(resolutions=LAUNCH_RESOLUTIONS, frames=None,
+                          backends=FLOW_BACKENDS):
+    """Milliseconds per OpticFlow.step (ring push and flow) for each
+    backend and resolution.
+
+    Args:
+        frames (np.ndarray, optional): recorded (N, H, W) frames. Defaults
+                                       to synthetic frames at each
+                                       resolution.
+    """
+    sequences = ([frames] if frames is not None else
+                 [synthetic_frames(w, h) for w, h in resolutions])
+    results = []
+    for seq in sequences:
+        h, w = seq.shape[1:]
+        for name, params in backends:
+            flow = OpticFlow(Camera(CameraInfo(h, w)),
+                             backend=make_backend(name, **params))
+            times = []
+            for i, frame in enumerate(seq):
+                start = time.time()
+                flow.step(frame, 0.1 * i)
+                times.append(time.time() - start)
+            label = name + ('-' + params['preset'] if 'preset' in params
+                            else '')
+            results.append({
+                'resolution': '{}x{}'.format(w, h),
+                'backend': label,
+                'ms_per_step': 1000 * float(np.median(times[2:]))})
+    return results
+
+
+class quiet(object):
+    """Silence stdout (the behaviours print every step)
+    """
+    def __enter__(self):
+        self._stdout = sys.stdout
+        sys.stdout = open(os.devnull, 'w')
+
+    def __exit__(self, *args):
+        sys.stdout.close()
+        sys.stdout = self._stdout
+
+
+def bench_behaviours(resolutions=LAUNCH_RESOLUTIONS, repeat=5, number=20):
+    """Milliseconds per AvoidanceBehaviour.step (activations and
+    decision) of the tunnel centering and saccade behaviours.
+    """
+    behaviours = [('tunnel-centering', TunnelCenteringBehaviour),
+                  ('saccade', SaccadeBehaviour)]
+    results = []
+    for w, h in resolutions:
+        flows = synthetic_flows(w, h)
+        camera = Camera(CameraInfo(h, w))
+        for name, behaviour_class in behaviours:
+            behaviour = behaviour_class(camera)
+            behaviour.start()
+            with quiet():
+                timing = time_call(lambda: behaviour.step(flows), repeat,
+                                   number)
+            row = {'resolution': '{}x{}'.format(w, h), 'behaviour': name}
+            row.update(timing)
+            results.append(row)
+    return results
+
+
+def bench_decision_maker(repeat=5, number=200, history=10):
+    """Milliseconds per ActivationDecisionMaker.step, once initialised,
+    on a slowly increasing activation.
+    """
+    rng = np.random.RandomState(0)
+    results = []
+    for check_outliers in (False, True):
+        maker = ActivationDecisionMaker(vel=2, check_outliers=check_outliers)
+        maker.start()
+        activations = deque(np.linspace(0.0, 0.1, history), maxlen=history)
+        for i in range(maker.min_init):
+            maker.step(activations, 0.0)
+        values = iter(np.linspace(0.1, 1.0, repeat * number + 1) +
+                      0.01 * rng.rand(repeat * number + 1))
+        row = {'check_outliers': check_outliers}
+        row.update(time_call(lambda: maker.step(activations, next(values)),
+                             repeat, number))
+        results.append(row)
+    return results
+
+
+def report(results):
+    """Print a list of result dictionaries as a table.
+    """
+    keys = list(results[0].keys())
+    print('  '.join('{:>22}'.format(k) for k in keys))
+    for r in results:
+        print('  '.join('{:>22.4g}'.format(r[k]) if isinstance(r[k], float)
+                        else '{:>22}'.format(str(r[k])) for k in keys))
+
+
+def is_metric(key):
+    """Whether a result column is a cost (time or memory, lower is better)
+    """
+    return (key.endswith('_ms') or 'ms_per' in key or 'us_per' in key
+            or 'bytes' in key)
+
+
+def row_id(row):
+    """The columns that identify a result row (resolution, backend...)
+    """
+    return tuple(sorted((k, v) for k, v in row.items()
+                        if not is_metric(k) and not isinstance(v, float)))
+
+
+def find_regressions(results, baseline, max_regression):
+    """Costs that grew by more than max_regression (a fraction) against
+    the baseline. Means are not compared, they are the noisiest timings.
+
+    Args:
+        results (dict): benchmark -> result rows
+        baseline (dict): benchmark -> result rows of an earlier run
+        max_regression (float): allowed relative increase
+
+    Returns:
+        list: (benchmark, row id, column, baseline, new) of each regression
+    """
+    regressions = []
+    for name, rows in results.items():
+        base_rows = {row_id(row): row for row in baseline.get(name, [])}
+        for row in rows:
+            base = base_rows.get(row_id(row))
+            if base is None:
+                continue
+            for key, value in row.items():
+                if (not is_metric(key) or key.startswith('mean')
+                        or not base.get(key)):
+                    continue
+                if value > base[key] * (1 + max_regression):
+                    regressions.append((name, row_id(row), key, base[key],
+                                        value))
+    return regressions
+
+
+def save_results(path, results):
+    """Write the results, and what they were run on, to a JSON file
+    """
+    run = {
+        'meta': {
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'opencv': cv2.__version__,
+            'machine': platform.machine(),
+            'processor': platform.processor(),
+        },
+        'results': results,
+    }
+    with open(path, 'w') as f:
+        json.dump(run, f, indent=2, sort_keys=True, default=float)
+
+
+def load_results(path):
+    with open(path) as f:
+        return json.load(f)['results']
+
+
+BENCHMARKS = {
+    'filters': bench_filters,
+    'activation': bench_activation,
+    'sectors': bench_sectors,
+    'flow_backends': bench_flow_backends,
+    'step_allocations': bench_step_allocations,
+    'warm_start': bench_warm_start,
+    'gating': bench_gating,
+    'cascade': bench_cascade,
+    'gradient': bench_gradient,
+    'roi': bench_roi,
+    'quality': bench_quality,
+    'quality_roi': bench_quality_roi,
+    'workers': bench_workers,
+    'ingest': bench_ingest,
+    'preprocess': bench_preprocess,
+    'timing': bench_timing,
+    'optic_flow_step': bench_optic_flow_step,
+    'behaviours': bench_behaviours,
+    'decision_maker': bench_decision_maker,
+}
+
+# Benchmarks that can run on recorded frames
+FRAME_BENCHMARKS = ['flow_backends', 'step_allocations', 'warm_start',
+                    'gating', 'cascade', 'gradient', 'roi',
+                    'quality', 'quality_roi', 'workers', 'ingest',
+                    'optic_flow_step']
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Benchmark the avoidance pipeline')
+    parser.add_argument('benchmarks', nargs='*', default=sorted(BENCHMARKS),
+                        help="""Benchmarks to run.
+                        Default: all""")
+    parser.add_argument('--frames', type=str, default='',
+                        help="""Recorded frames (.npy or a directory of
+                        images) for the optic flow benchmarks""")
+    parser.add_argument('--json', type=str, default='',
+                        help='Save the results to this JSON file')
+    parser.add_argument('--baseline', type=str, default='',
+                        help="""Results (JSON) of an earlier run, exit with
+                        an error if a cost regressed""")
+    parser.add_argument('--max_regression', type=float, default=0.25,
+                        help="""Allowed relative increase of a cost against
+                        the baseline. Default: 0.25""")
+    args = parser.parse_args()
+
+    results = {}
+    for name in args.benchmarks:
+        kwargs = {}
+        if args.frames and name in FRAME_BENCHMARKS:
+            kwargs['frames'] = load_frames(args.frames)
+        print('\n' + name)
+        results[name] = BENCHMARKS[name](**kwargs)
+        report(results[name])
+
+    if args.json:
+        save_results(args.json, results)
+
+    if args.baseline:
+        # Through JSON, so that the row ids match the baseline's
+        results = json.loads(json.dumps(results, default=float))
+        regressions = find_regressions(results, load_results(args.baseline),
+                                       args.max_regression)
+        for name, ids, key, base, new in regressions:
+            print('REGRESSION {} {} {}: {:.4g} -> {:.4g}'.format(
+                name, ', '.join('{}={}'.format(k, v) for k, v in ids), key,
+                base, new))
+        if regressions:
+            sys.exit(1)
+        print('\nNo regressions above {:.0%}'.format(args.max_regression))
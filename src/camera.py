@@ -1,13 +1,24 @@
 #!/usr/bin/env python
 from __future__ import division
 import numpy as np
-from sensor_msgs.msg import CameraInfo
 
 
 class Camera():
-    def __init__(self, cam_info=None):
-        self.h = cam_info.height
-        self.w = cam_info.width
+    def __init__(self, cam_info=None, width=None, height=None):
+        """Camera model
+
+        Args:
+            cam_info (CameraInfo, optional): camera info (message), for
+                                             the image size
+            width (int, optional): image width, without a cam_info
+            height (int, optional): image height, without a cam_info
+        """
+        if cam_info is not None:
+            width, height = cam_info.width, cam_info.height
+        if width is None or height is None:
+            raise ValueError('Camera needs a cam_info or a width and height')
+        self.h = height
+        self.w = width
 
         # self.fovx_deg = 120
         # self.fovy_deg = 60
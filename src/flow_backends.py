@@ -0,0 +1,394 @@
+#!/usr/bin/env python2
+from __future__ import division
+import numpy as np
+import cv2
+
+
+class FlowBackend(object):
+    """Base class of the dense optic flow backends used by OpticFlow.
+    """
+    name = None
+    # Whether compute can start from an initial flow estimate
+    supports_initial_flow = False
+
+    def compute(self, prev_image, next_image, flow=None, initial=False):
+        """Compute the optic flow between two frames
+
+        Args:
+            prev_image (np.ndarray): previous black and white frame
+            next_image (np.ndarray): new black and white frame
+            flow (np.ndarray, optional): preallocated (H, W, 2) float32
+                                         output, written in place
+            initial (bool, optional): flow holds an initial estimate
+                                      (warm start). Defaults to False.
+
+        Returns:
+            np.ndarray: (H, W, 2) float32 flow in pixels
+        """
+        raise NotImplementedError
+
+    def scaled(self, level):
+        """A backend for the frames downsampled by 2**level, with its
+        window sizes scaled down (e.g. the coarse flow of a cascade)
+
+        Args:
+            level (int): downsampling octaves
+
+        Returns:
+            FlowBackend: a new backend
+        """
+        raise NotImplementedError
+
+    def cheaper(self):
+        """Progressively cheaper (and less accurate) variants of this
+        backend, for the quality controller
+
+        Returns:
+            list: new backends, from the best to the cheapest
+        """
+        return []
+
+
+class FarnebackBackend(FlowBackend):
+    """Dense Farneback flow (the original OpticFlow implementation)
+
+    When warm-started from an initial flow the coarse pyramid levels are
+    not needed, so warm_levels and warm_iterations are used instead.
+    """
+    name = 'farneback'
+    supports_initial_flow = True
+
+    def __init__(self, pyr_scale=0.5, levels=3, winsize=50, iterations=3,
+                 poly_n=5, poly_sigma=1.1, flags=0,
+                 warm_levels=1, warm_iterations=1):
+        self.pyr_scale = pyr_scale
+        self.levels = levels
+        self.winsize = winsize
+        self.iterations = iterations
+        self.poly_n = poly_n
+        self.poly_sigma = poly_sigma
+        self.flags = flags
+        self.warm_levels = warm_levels
+        self.warm_iterations = warm_iterations
+
+    def compute(self, prev_image, next_image, flow=None, initial=False):
+        if initial:
+            levels, iterations = self.warm_levels, self.warm_iterations
+            flags = self.flags | cv2.OPTFLOW_USE_INITIAL_FLOW
+        else:
+            levels, iterations = self.levels, self.iterations
+            flags = self.flags
+        return cv2.calcOpticalFlowFarneback(
+            prev_image,
+            next_image,
+            flow,
+            pyr_scale=self.pyr_scale,
+            levels=levels,
+            winsize=self.winsize,
+            iterations=iterations,
+            poly_n=self.poly_n,
+            poly_sigma=self.poly_sigma,
+            flags=flags
+        )
+
+    def _variant(self, levels, winsize, iterations):
+        return FarnebackBackend(
+            pyr_scale=self.pyr_scale,
+            levels=levels,
+            winsize=winsize,
+            iterations=iterations,
+            poly_n=self.poly_n,
+            poly_sigma=self.poly_sigma,
+            flags=self.flags,
+            warm_levels=min(self.warm_levels, levels),
+            warm_iterations=min(self.warm_iterations, iterations))
+
+    def scaled(self, level):
+        return self._variant(max(1, self.levels - level),
+                             max(5, self.winsize >> level), self.iterations)
+
+    def cheaper(self):
+        # fewer iterations, then fewer levels and smaller windows
+        steps = [(self.levels, self.winsize, max(1, self.iterations - 1)),
+                 (max(1, self.levels - 1), max(5, self.winsize * 3 // 4), 1),
+                 (1, max(5, self.winsize // 2), 1)]
+        variants, last = [], (self.levels, self.winsize, self.iterations)
+        for step in steps:
+            if step != last:
+                variants.append(self._variant(*step))
+                last = step
+        return variants
+
+
+class DISBackend(FlowBackend):
+    """OpenCV Dense Inverse Search flow
+
+    Args:
+        preset (str): 'ultrafast', 'fast' or 'medium'. Defaults to 'fast'.
+    """
+    name = 'dis'
+    supports_initial_flow = True
+    PRESETS = ('ultrafast', 'fast', 'medium')
+
+    def __init__(self, preset='fast'):
+        if preset not in self.PRESETS:
+            raise ValueError('Unknown DIS preset {}, use one of {}'.format(
+                preset, ', '.join(self.PRESETS)))
+        self.preset = preset
+        self._dis = DISBackend._create(self.PRESETS.index(preset))
+
+    @staticmethod
+    def _create(preset):
+        # DIS is in the main modules from OpenCV 4, in contrib before
+        if hasattr(cv2, 'DISOpticalFlow_create'):
+            return cv2.DISOpticalFlow_create(preset)
+        return cv2.optflow.createOptFlow_DIS(preset)
+
+    def compute(self, prev_image, next_image, flow=None, initial=False):
+        if flow is not None and not initial:
+            # DIS uses a given flow as its initial estimate
+            flow.fill(0)
+        return self._dis.calc(prev_image, next_image, flow)
+
+    def scaled(self, level):
+        # The presets set the patch size, the coarse flow just needs its
+        # own instance
+        return DISBackend(self.preset)
+
+    def cheaper(self):
+        return [DISBackend(preset) for preset in
+                reversed(self.PRESETS[:self.PRESETS.index(self.preset)])]
+
+
+class SparseLKBackend(FlowBackend):
+    """Pyramidal Lucas-Kanade on a regular grid of points, interpolated
+    (bilinearly) onto the full image grid.
+    Points that are not tracked get a zero flow.
+
+    Args:
+        grid_step (int): pixels between grid points. Defaults to 8.
+        winsize (int): Lucas-Kanade window size. Defaults to 15.
+        levels (int): pyramid levels above the base. Defaults to 3.
+        iterations (int): maximum iterations per level. Defaults to 10.
+    """
+    name = 'lk'
+
+    def __init__(self, grid_step=8, winsize=15, levels=3, iterations=10):
+        self.grid_step = grid_step
+        self.winsize = winsize
+        self.levels = levels
+        self.iterations = iterations
+        self.criteria = (cv2.TERM_CRITERIA_EPS | cv2.TERM_CRITERIA_COUNT,
+                         iterations, 0.03)
+        self._shape = None
+
+    def scaled(self, level):
+        return SparseLKBackend(grid_step=max(2, self.grid_step >> level),
+                               winsize=max(5, self.winsize >> level),
+                               levels=max(0, self.levels - level),
+                               iterations=self.iterations)
+
+    def cheaper(self):
+        # sparser grid, then fewer levels (the iterations mostly stop on
+        # the epsilon before the maximum)
+        return [SparseLKBackend(grid_step=2 * self.grid_step,
+                                winsize=self.winsize, levels=self.levels,
+                                iterations=self.iterations),
+                SparseLKBackend(grid_step=2 * self.grid_step,
+                                winsize=self.winsize,
+                                levels=max(0, self.levels - 1),
+                                iterations=self.iterations)]
+
+    def _make_grid(self, shape):
+        """Grid points placed at the sample positions that cv2.resize
+        uses, so that resizing the grid flow interpolates it exactly.
+        """
+        height, width = shape
+        self._grid_w = max(width // self.grid_step, 2)
+        self._grid_h = max(height // self.grid_step, 2)
+        xs = (np.arange(self._grid_w) + 0.5) * width / self._grid_w - 0.5
+        ys = (np.arange(self._grid_h) + 0.5) * height / self._grid_h - 0.5
+        grid = np.dstack(np.meshgrid(xs, ys)).astype(np.float32)
+        self._points = grid.reshape(-1, 1, 2)
+        self._shape = shape
+
+    def compute(self, prev_image, next_image, flow=None, initial=False):
+        if self._shape != prev_image.shape:
+            self._make_grid(prev_image.shape)
+
+        points, status, _ = cv2.calcOpticalFlowPyrLK(
+            prev_image, next_image, self._points, None,
+            winSize=(self.winsize, self.winsize),
+            maxLevel=self.levels,
+            criteria=self.criteria)
+
+        grid_flow = (points - self._points).reshape(self._grid_h,
+                                                    self._grid_w, 2)
+        grid_flow[status.reshape(self._grid_h, self._grid_w) == 0] = 0
+        height, width = self._shape
+        return cv2.resize(grid_flow, (width, height), dst=flow,
+                          interpolation=cv2.INTER_LINEAR)
+
+
+class GradientBackend(FlowBackend):
+    """Global Lucas-Kanade constrained to a few translational matched
+    filters: the flow is modelled as a weighted sum of the filters, and
+    the weights are the least-squares solution of the brightness constancy
+    equations of all the pixels,
+
+        sum_k c_k (Ix B_k,x + Iy B_k,y) = -It
+
+    so each step is a few gradient images and a small normal equation
+    instead of a dense flow. The flow returned is sum_k c_k B_k. The
+    filters are for translations along the axes of the camera, so the
+    matched filter of any axis in the horizontal plane is in their span
+    and its activation on this flow is the projection of the image
+    motion onto it.
+
+    The weights are solved coarse to fine on a Gaussian pyramid, warping
+    the new frame by the current flow (Gauss-Newton) on each iteration.
+
+    The activations differ from those of the dense Farneback flow (median
+    relative error, benchmark.py gradient): 1% on the side filters and
+    11% on the centre filter at 240x135, 2-3% and 9% at 235x150, but 4-7%
+    and 53% at 135x40. The centre camera is not usable at that
+    resolution, keep it on a dense backend there (camera_backends).
+
+    Args:
+        fov (tuple): FOV of the filters in degrees, that of the
+                     behaviour's filters (AvoidancePipeline passes its
+                     filter_fov). Defaults to (9, 9), the 45 degree
+                     camera split in 5.
+        axes (list): axes (roll, pitch, yaw in degrees) of the filters.
+                     Defaults to forward, lateral and vertical.
+        levels (int): pyramid levels above the base. Defaults to 2.
+        iterations (int): Gauss-Newton iterations per level. Defaults to 2.
+        regularisation (float): ridge term, relative to the mean of the
+                                normal matrix diagonal. Defaults to 1e-6.
+    """
+    name = 'gradient'
+
+    def __init__(self, fov=(9, 9), axes=([0, 0, 0], [0, 0, 90], [0, 90, 0]),
+                 levels=2, iterations=2, regularisation=1e-6):
+        self.fov = tuple(fov)
+        self.axes = [list(axis) for axis in axes]
+        self.levels = levels
+        self.iterations = iterations
+        self.regularisation = regularisation
+        self._shape = None
+        # weights of the last flow
+        self.weights = np.zeros(len(self.axes))
+
+    def _make_basis(self, shape):
+        """The filters, and on each pyramid level the filters in that
+        level's pixels, the pixel grid for the warps and the image sizes
+        """
+        from matchedFilters import get_matched_filter
+        height, width = shape
+        self._basis = np.array([
+            get_matched_filter(width, height, self.fov, axis=axis,
+                               dtype=np.float32)
+            for axis in self.axes])
+        self._level_basis, self._grids = [], []
+        for level in range(self.levels + 1):
+            h = (height + (1 << level) - 1) >> level
+            w = (width + (1 << level) - 1) >> level
+            basis = np.array([cv2.resize(b, (w, h),
+                                         interpolation=cv2.INTER_AREA)
+                              for b in self._basis]) * 0.5 ** level
+            self._level_basis.append(basis.reshape(len(self.axes), -1, 2))
+            xs, ys = np.meshgrid(np.arange(w, dtype=np.float32),
+                                 np.arange(h, dtype=np.float32))
+            self._grids.append((xs, ys))
+        self._shape = shape
+
+    @staticmethod
+    def _pyramid(image, levels):
+        pyramid = [image.astype(np.float32)]
+        for _ in range(levels):
+            pyramid.append(cv2.pyrDown(pyramid[-1]))
+        return pyramid
+
+    def _solve_level(self, level, prev_image, next_image, weights):
+        """Gauss-Newton iterations of the weights on one pyramid level
+        """
+        basis = self._level_basis[level]
+        xs, ys = self._grids[level]
+        h, w = prev_image.shape
+        # Brightness gradients of the previous frame, per pixel
+        ix = cv2.Scharr(prev_image, cv2.CV_32F, 1, 0, scale=1 / 32.0)
+        iy = cv2.Scharr(prev_image, cv2.CV_32F, 0, 1, scale=1 / 32.0)
+        # (K, N) change of brightness per unit weight of each filter
+        responses = (basis[:, :, 0] * ix.reshape(1, -1) +
+                     basis[:, :, 1] * iy.reshape(1, -1))
+        normal = np.dot(responses, responses.T)
+        normal += (self.regularisation * np.trace(normal) / len(normal) *
+                   np.eye(len(normal)))
+        for _ in range(self.iterations):
+            flow = np.dot(weights.astype(np.float32),
+                          basis.reshape(len(basis), -1)).reshape(h, w, 2)
+            warped = cv2.remap(next_image, xs + flow[:, :, 0],
+                               ys + flow[:, :, 1], cv2.INTER_LINEAR,
+                               borderMode=cv2.BORDER_REPLICATE)
+            warped -= prev_image
+            weights = weights - np.linalg.solve(
+                normal, np.dot(responses, warped.reshape(-1)))
+        return weights
+
+    def compute(self, prev_image, next_image, flow=None, initial=False):
+        if self._shape != prev_image.shape:
+            self._make_basis(prev_image.shape)
+        prev_pyramid = self._pyramid(prev_image, self.levels)
+        next_pyramid = self._pyramid(next_image, self.levels)
+        weights = np.zeros(len(self.axes))
+        for level in range(self.levels, -1, -1):
+            weights = self._solve_level(level, prev_pyramid[level],
+                                        next_pyramid[level], weights)
+        self.weights = weights
+        height, width = self._shape
+        if flow is None:
+            flow = np.empty((height, width, 2), dtype=np.float32)
+        np.dot(weights.astype(np.float32),
+               self._basis.reshape(len(self.axes), -1),
+               out=flow.reshape(-1))
+        return flow
+
+    def scaled(self, level):
+        return GradientBackend(fov=self.fov, axes=self.axes,
+                               levels=max(0, self.levels - level),
+                               iterations=self.iterations,
+                               regularisation=self.regularisation)
+
+    def cheaper(self):
+        if self.iterations == 1 and self.levels == 0:
+            return []
+        return [GradientBackend(fov=self.fov, axes=self.axes, levels=0,
+                                iterations=1,
+                                regularisation=self.regularisation)]
+
+
+BACKENDS = {
+    FarnebackBackend.name: FarnebackBackend,
+    DISBackend.name: DISBackend,
+    SparseLKBackend.name: SparseLKBackend,
+    GradientBackend.name: GradientBackend,
+}
+
+
+def make_backend(name='farneback', **params):
+    """Create an optic flow backend by name
+
+    Args:
+        name (str): farneback, dis, lk or gradient. Defaults to
+                    'farneback'.
+        params: keyword arguments of the backend
+
+    Returns:
+        FlowBackend: the backend
+    """
+    try:
+        backend = BACKENDS[name]
+    except KeyError:
+        raise ValueError('Unknown optic flow backend {}, use one of {}'.format(
+            name, ', '.join(sorted(BACKENDS))))
+    return backend(**params)
@@ -0,0 +1,296 @@
+#!/usr/bin/env python2
+from __future__ import division
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+import numpy as np
+import cv2
+
+
+class FlowWorkers(object):
+    """Runs the optic flow modules of a set of cameras, one after the other
+    on the calling thread (the serial path).
+
+    Args:
+        modules (dict): camera -> OpticFlow
+        cv_threads (int, optional): OpenCV threads per worker, None leaves
+                                    the OpenCV default. Defaults to None.
+    """
+    name = 'serial'
+
+    def __init__(self, modules, cv_threads=None):
+        self.modules = modules
+        self.cv_threads = cv_threads
+        if cv_threads is not None:
+            cv2.setNumThreads(cv_threads)
+
+    @staticmethod
+    def _step(module, image, this_time):
+        flow = module.step(image, this_time)
+        return flow if module.initialised else None
+
+    def step(self, frames):
+        """Compute the flow of every camera with a new frame, and wait for
+        all of them (one frame-set).
+
+        Args:
+            frames (dict): camera -> (image, time) of the new frames
+
+        Returns:
+            dict: camera -> flow, None if the module is not initialised
+        """
+        return {cam: self._step(self.modules[cam], image, this_time)
+                for cam, (image, this_time) in frames.items()}
+
+    def refine(self, cams):
+        """Compute the full resolution flow of the last frames of some
+        cameras, after a cascade step (see OpticFlow.refine)
+
+        Args:
+            cams (list): the cameras
+
+        Returns:
+            dict: camera -> flow
+        """
+        return {cam: self.modules[cam].refine() for cam in cams}
+
+    def reset(self):
+        """Cold start the next flow of every camera
+        """
+        for module in self.modules.values():
+            module.reset()
+
+    def set_quality(self, qualities):
+        """Select the quality rungs of the next flows (see
+        OpticFlow.set_quality)
+
+        Args:
+            qualities (dict): camera -> rung
+        """
+        for cam, quality in qualities.items():
+            self.modules[cam].set_quality(quality)
+
+    def bytes_copied(self):
+        """Bytes of the frames copied (or colour converted) on their way
+        into each camera's FrameRing
+
+        Returns:
+            dict: camera -> bytes copied per frame
+        """
+        return {cam: (module.frames.bytes_copied / module.frames.pushes
+                      if module.frames.pushes else 0.0)
+                for cam, module in self.modules.items()}
+
+    @staticmethod
+    def _step_stats(module):
+        return {'gated': module.gated,
+                'gated_steps': module.gated_steps,
+                'flow_steps': module.warm_steps + module.cold_steps,
+                'refined_steps': module.refined_steps,
+                'roi_fraction': module.roi_fraction,
+                'quality': module.quality}
+
+    def step_stats(self):
+        """Whether the last step was gated, steps whose frame was static
+        (see FrameGate), steps that computed the flow, cascade steps refined to full resolution, the
+        fraction of the frame in the flow roi and the quality rung, of each
+        camera
+
+        Returns:
+            dict: camera -> {'gated', 'gated_steps', 'flow_steps',
+                  'refined_steps', 'roi_fraction', 'quality'}
+        """
+        return {cam: self._step_stats(module)
+                for cam, module in self.modules.items()}
+
+    def close(self):
+        pass
+
+
+class ThreadFlowWorkers(FlowWorkers):
+    """One thread per camera. OpenCV releases the GIL, so the flows of the
+    cameras are computed concurrently.
+
+    cv_threads is set process-wide (OpenCV has no per-thread setting), so
+    with three cameras use about a third of the cores each.
+    """
+    name = 'threads'
+
+    def __init__(self, modules, cv_threads=1):
+        super(ThreadFlowWorkers, self).__init__(modules, cv_threads)
+        self.pool = ThreadPool(len(modules))
+
+    def step(self, frames):
+        pending = {cam: self.pool.apply_async(
+                       self._step, (self.modules[cam], image, this_time))
+                   for cam, (image, this_time) in frames.items()}
+        return {cam: result.get() for cam, result in pending.items()}
+
+    def refine(self, cams):
+        pending = {cam: self.pool.apply_async(self.modules[cam].refine)
+                   for cam in cams}
+        return {cam: result.get() for cam, result in pending.items()}
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+
+
+# Message to a camera's process to refine its last flow
+REFINE = 'refine'
+
+
+def _process_worker(conn, module, frame, flow, cv_threads):
+    """Loop of a camera's process: step the module on the shared frame (or
+    refine its last flow), copy the flow to the shared flow buffer and
+    reply whether it is valid.
+
+    Step messages are (time, reset, quality), quality None keeping the
+    current rung.
+    """
+    if cv_threads is not None:
+        cv2.setNumThreads(cv_threads)
+    while True:
+        message = conn.recv()
+        if message is None:
+            break
+        if message == REFINE:
+            result = module.refine()
+        else:
+            this_time, reset, quality = message
+            if reset:
+                module.reset()
+            if quality is not None:
+                module.set_quality(quality)
+            result = module.step(frame, this_time)
+        if module.initialised:
+            np.copyto(flow, result)
+        conn.send((module.initialised, module.frames.bytes_copied,
+                   FlowWorkers._step_stats(module)))
+    conn.close()
+
+
+class ProcessFlowWorkers(FlowWorkers):
+    """One process per camera, each owning its OpticFlow module.
+
+    Frames and flows are passed in shared memory, only the timestamps go
+    through the pipes. The flows returned are views of the shared buffers,
+    overwritten by the next step.
+
+    The processes are forked (the modules are not picklable), so create
+    the workers before the process starts other threads (e.g. the ROS
+    subscribers and timers): a fork only copies the calling thread, and
+    locks held by the others stay locked in the children.
+    """
+    name = 'processes'
+
+    def __init__(self, modules, cv_threads=1):
+        super(ProcessFlowWorkers, self).__init__(modules)
+        self.cv_threads = cv_threads
+        # The modules (and their OpenCV objects) are not picklable
+        context = (multiprocessing.get_context('fork')
+                   if hasattr(multiprocessing, 'get_context')
+                   else multiprocessing)
+        self._frames, self._flows, self._conns = {}, {}, {}
+        self._processes = []
+        self._reset = {cam: False for cam in modules}
+        self._quality = {cam: None for cam in modules}
+        # copies into the shared frames, and reported by the processes
+        self._frames_in = {cam: 0 for cam in modules}
+        self._copied = {cam: 0 for cam in modules}
+        self._ring_copied = {cam: 0 for cam in modules}
+        self._stats = {cam: self._step_stats(module)
+                       for cam, module in modules.items()}
+        for cam, module in modules.items():
+            h, w = module.cam.h, module.cam.w
+            self._frames[cam] = np.frombuffer(
+                context.RawArray('B', h * w), dtype=np.uint8).reshape(h, w)
+            self._flows[cam] = np.frombuffer(
+                context.RawArray('f', h * w * 2),
+                dtype=np.float32).reshape(h, w, 2)
+            self._conns[cam], child = context.Pipe()
+            process = context.Process(
+                target=_process_worker,
+                args=(child, module, self._frames[cam], self._flows[cam],
+                      cv_threads))
+            process.daemon = True
+            process.start()
+            self._processes.append(process)
+
+    def step(self, frames):
+        for cam, (image, this_time) in frames.items():
+            if image.ndim == 3:
+                cv2.cvtColor(image, cv2.COLOR_BGR2GRAY, dst=self._frames[cam])
+            else:
+                np.copyto(self._frames[cam], image)
+            self._frames_in[cam] += 1
+            self._copied[cam] += self._frames[cam].nbytes
+            self._conns[cam].send((this_time, self._reset[cam],
+                                   self._quality[cam]))
+            self._reset[cam] = False
+            self._quality[cam] = None
+        return self._receive(frames)
+
+    def _receive(self, cams):
+        flows = {}
+        for cam in cams:
+            initialised, self._ring_copied[cam], self._stats[cam] = \
+                self._conns[cam].recv()
+            flows[cam] = self._flows[cam] if initialised else None
+        return flows
+
+    def refine(self, cams):
+        for cam in cams:
+            self._conns[cam].send(REFINE)
+        return self._receive(cams)
+
+    def reset(self):
+        # Sent with the next frame of each camera
+        for cam in self._reset:
+            self._reset[cam] = True
+
+    def set_quality(self, qualities):
+        # Sent with the next frame of each camera
+        self._quality.update(qualities)
+
+    def bytes_copied(self):
+        return {cam: ((self._copied[cam] + self._ring_copied[cam]) /
+                      self._frames_in[cam] if self._frames_in[cam] else 0.0)
+                for cam in self._frames_in}
+
+    def step_stats(self):
+        return dict(self._stats)
+
+    def close(self):
+        for conn in self._conns.values():
+            conn.send(None)
+        for process in self._processes:
+            process.join(1.0)
+
+
+WORKERS = {
+    FlowWorkers.name: FlowWorkers,
+    ThreadFlowWorkers.name: ThreadFlowWorkers,
+    ProcessFlowWorkers.name: ProcessFlowWorkers,
+}
+
+
+def make_flow_workers(modules, mode='serial', cv_threads=None):
+    """Create the workers that run the optic flow modules
+
+    Args:
+        modules (dict): camera -> OpticFlow
+        mode (str): serial, threads or processes. Defaults to 'serial'.
+        cv_threads (int, optional): OpenCV threads per worker. Defaults to
+                                    None (1 for threads and processes).
+
+    Returns:
+        FlowWorkers: the workers
+    """
+    try:
+        workers = WORKERS[mode]
+    except KeyError:
+        raise ValueError('Unknown flow worker mode {}, use one of {}'.format(
+            mode, ', '.join(sorted(WORKERS))))
+    if cv_threads is None and workers is not FlowWorkers:
+        cv_threads = 1
+    return workers(modules, cv_threads=cv_threads)
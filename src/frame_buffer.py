@@ -0,0 +1,131 @@
+#!/usr/bin/env python2
+from __future__ import division
+import threading
+import time
+from collections import deque
+
+
+class FrameBuffer(object):
+    """Bounded buffer of the frames of one camera, between the subscriber
+    callback and the optic flow.
+
+    Policies, when a frame arrives and the buffer is full:
+        latest: replace the buffered frame, size is always 1
+        keep_n: drop the oldest of the `size` buffered frames
+        block: wait until the consumer takes a frame. This stalls the
+               subscriber thread, so rospy drops frames at its own queue.
+               After max_block seconds, or once the buffer is closed, the
+               new frame is dropped instead.
+
+    Counts the frames received, dropped and processed, the buffer depth
+    and the age of the frames when they are taken.
+
+    Args:
+        policy (str): latest, keep_n or block. Defaults to 'latest'.
+        size (int): frames kept by keep_n and block. Defaults to 1.
+        clock (callable): current time, in the clock of the frame stamps.
+                          Defaults to time.time.
+        max_block (float): longest wait of the block policy, in seconds.
+                           Defaults to 1.0.
+    """
+    POLICIES = ('latest', 'keep_n', 'block')
+
+    def __init__(self, policy='latest', size=1, clock=time.time,
+                 max_block=1.0):
+        if policy not in self.POLICIES:
+            raise ValueError('Unknown frame buffer policy {}, use one of {}'
+                             .format(policy, ', '.join(self.POLICIES)))
+        if size < 1:
+            raise ValueError('Frame buffer size must be at least 1')
+        self.policy = policy
+        self.size = 1 if policy == 'latest' else size
+        self.clock = clock
+        self.max_block = max_block
+        self.closed = False
+        self._frames = deque()
+        self._not_full = threading.Condition()
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.received = 0
+        self.dropped = 0
+        self.processed = 0
+        self.max_depth = 0
+        self._age_sum = 0.0
+        self.max_age = 0.0
+
+    def put(self, frame, stamp):
+        """Add a frame
+
+        Args:
+            frame: the frame (any object)
+            stamp (float): capture time of the frame in seconds
+        """
+        with self._not_full:
+            self.received += 1
+            if self.closed:
+                self.dropped += 1
+                return
+            if self.policy == 'block':
+                deadline = time.time() + self.max_block
+                while len(self._frames) >= self.size:
+                    remaining = deadline - time.time()
+                    if self.closed or remaining <= 0:
+                        self.dropped += 1
+                        return
+                    self._not_full.wait(remaining)
+            elif len(self._frames) >= self.size:
+                self._frames.popleft()
+                self.dropped += 1
+            self._frames.append((frame, stamp))
+            self.max_depth = max(self.max_depth, len(self._frames))
+
+    def close(self):
+        """Release the producers blocked in put, and drop the frames put
+        from now on
+        """
+        with self._not_full:
+            self.closed = True
+            self._not_full.notify_all()
+
+    def get(self):
+        """Take the oldest buffered frame
+
+        Returns:
+            tuple: (frame, stamp), or None if the buffer is empty
+        """
+        with self._not_full:
+            if not self._frames:
+                return None
+            frame, stamp = self._frames.popleft()
+            self._not_full.notify()
+            self.processed += 1
+            age = self.clock() - stamp
+            self._age_sum += age
+            self.max_age = max(self.max_age, age)
+        return frame, stamp
+
+    def empty(self):
+        return not self._frames
+
+    def __len__(self):
+        return len(self._frames)
+
+    def stats(self):
+        """Counters since the last reset_stats
+
+        Returns:
+            dict: received, dropped and processed frames, current and
+                  maximum depth, mean and maximum frame age in seconds
+        """
+        with self._not_full:
+            return {
+                'received': self.received,
+                'dropped': self.dropped,
+                'processed': self.processed,
+                'depth': len(self._frames),
+                'max_depth': self.max_depth,
+                'mean_age_s': (self._age_sum / self.processed
+                               if self.processed else 0.0),
+                'max_age_s': self.max_age,
+            }
@@ -0,0 +1,211 @@
+#!/usr/bin/env python2
+from __future__ import division
+import time
+from collections import deque
+
+
+class FrameSynchronizer(object):
+    """Groups the frames of several cameras into frame-sets by timestamp,
+    oldest first, so that each set is processed once and the cameras of a
+    set were captured at the same time.
+
+    Policies:
+        exact: the stamps of a set are equal
+        approximate: the stamps of a set are within `tolerance` seconds of
+                     the oldest one
+
+    A set is incomplete when a camera has no frame for it: either that
+    camera already has a later frame (it skipped the stamp) or no frame
+    arrived within `max_wait` seconds. Incomplete sets are:
+        drop: discarded
+        reuse: returned without the missing cameras (the caller reuses
+               their last result)
+        wait: only discarded when the camera skipped the stamp, never
+              timed out
+
+    Args:
+        cameras (list): the camera names
+        policy (str): exact or approximate. Defaults to 'approximate'.
+        tolerance (float): approximate stamp tolerance in seconds.
+                           Defaults to 0.01.
+        incomplete (str): drop, reuse or wait. Defaults to 'reuse'.
+        max_wait (float): seconds to wait for a missing camera. Defaults
+                          to 0.05.
+        queue_size (int): unmatched frames kept per camera. Defaults to 5.
+        clock (callable): current time, in the clock of the frame stamps.
+                          Defaults to time.time.
+        latest (bool): pop the newest set that is ready, dropping the
+                       older ones, as the latest FrameBuffer policy.
+                       Defaults to False (every set, oldest first).
+    """
+    POLICIES = ('exact', 'approximate')
+    INCOMPLETE_POLICIES = ('drop', 'reuse', 'wait')
+
+    def __init__(self, cameras, policy='approximate', tolerance=0.01,
+                 incomplete='reuse', max_wait=0.05, queue_size=5,
+                 clock=time.time, latest=False):
+        if policy not in self.POLICIES:
+            raise ValueError('Unknown synchronizer policy {}, use one of {}'
+                             .format(policy, ', '.join(self.POLICIES)))
+        if incomplete not in self.INCOMPLETE_POLICIES:
+            raise ValueError('Unknown incomplete set policy {}, use one of {}'
+                             .format(incomplete,
+                                     ', '.join(self.INCOMPLETE_POLICIES)))
+        self.cameras = list(cameras)
+        self.policy = policy
+        self.tolerance = tolerance if policy == 'approximate' else 0.0
+        self.incomplete = incomplete
+        self.max_wait = max_wait
+        self.clock = clock
+        self.latest = latest
+        self._pending = {cam: deque(maxlen=queue_size) for cam in cameras}
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.sets = 0
+        self.partial_sets = 0
+        self.dropped_sets = 0
+        # sets dropped for a newer one (latest)
+        self.skipped_sets = 0
+        # frames pushed out of a full camera queue
+        self.overflowed = 0
+        self.max_skew = 0.0
+        # age of the sets returned by pop, when they are returned
+        self.popped = 0
+        self._age_sum = 0.0
+        self.max_age = 0.0
+
+    def add(self, cam, frame, stamp):
+        """Queue the frame of a camera
+
+        Args:
+            cam (str): the camera
+            frame: the frame (any object)
+            stamp (float): capture time of the frame in seconds
+        """
+        pending = self._pending[cam]
+        if len(pending) == pending.maxlen:
+            self.overflowed += 1
+        pending.append((frame, stamp))
+
+    def add_from(self, buffers):
+        """Queue all the frames waiting in the cameras' FrameBuffers
+
+        Args:
+            buffers (dict): camera -> FrameBuffer
+        """
+        for cam in self.cameras:
+            item = buffers[cam].get()
+            while item is not None:
+                self.add(cam, *item)
+                item = buffers[cam].get()
+
+    def _match(self, anchor):
+        """Cameras whose oldest frame belongs to the set at anchor
+        """
+        return [cam for cam in self.cameras
+                if self._pending[cam]
+                and self._pending[cam][0][1] - anchor <= self.tolerance]
+
+    def _known_incomplete(self, anchor, missing):
+        skipped = all(self._pending[cam] for cam in missing)
+        if skipped or self.incomplete == 'wait':
+            return skipped
+        return self.clock() - anchor > self.max_wait
+
+    def _oldest_set(self):
+        """Present and missing cameras of the oldest set, and whether it
+        can be decided on (complete or known incomplete)
+        """
+        anchor = min(pending[0][1] for pending in self._pending.values()
+                     if pending)
+        present = self._match(anchor)
+        missing = [cam for cam in self.cameras if cam not in present]
+        decided = not missing or self._known_incomplete(anchor, missing)
+        return present, missing, decided
+
+    def ready(self):
+        """Whether pop has a set to return or to drop
+        """
+        return any(self._pending.values()) and self._oldest_set()[2]
+
+    def next_deadline(self):
+        """When the oldest set times out waiting for its missing cameras,
+        and so becomes ready
+
+        Returns:
+            float: the time, in the clock of the frame stamps, or None if
+                   no set is waiting on a timeout (none pending, the
+                   oldest is ready, or the wait policy)
+        """
+        if self.incomplete == 'wait' or not any(self._pending.values()):
+            return None
+        if self._oldest_set()[2]:
+            return None
+        anchor = min(pending[0][1] for pending in self._pending.values()
+                     if pending)
+        return anchor + self.max_wait
+
+    def pop(self):
+        """The oldest frame-set that is ready, or the newest one with
+        latest
+
+        Returns:
+            dict: camera -> (frame, stamp), without the missing cameras
+                  of an incomplete set (reuse policy), or None if no set
+                  is ready
+        """
+        frame_set = self._pop_oldest()
+        while self.latest and frame_set and self.ready():
+            newer = self._pop_oldest()
+            if not newer:
+                break
+            self.skipped_sets += 1
+            frame_set = newer
+        if frame_set:
+            age = self.clock() - min(stamp for _, stamp in frame_set.values())
+            self.popped += 1
+            self._age_sum += age
+            self.max_age = max(self.max_age, age)
+        return frame_set
+
+    def _pop_oldest(self):
+        """The oldest frame-set that is ready, dropping the incomplete
+        sets of the drop and wait policies
+        """
+        while any(self._pending.values()):
+            present, missing, decided = self._oldest_set()
+            if not decided:
+                return None
+
+            frame_set = {cam: self._pending[cam].popleft() for cam in present}
+            if not missing:
+                self.sets += 1
+                stamps = [stamp for _, stamp in frame_set.values()]
+                self.max_skew = max(self.max_skew, max(stamps) - min(stamps))
+                return frame_set
+            if self.incomplete == 'reuse':
+                self.partial_sets += 1
+                return frame_set
+            self.dropped_sets += 1
+        return None
+
+    def stats(self):
+        """Counters since the last reset_stats
+
+        Returns:
+            dict: complete, partial, dropped and skipped (latest) sets,
+                  overflowed frames, the largest stamp difference within a
+                  set and the mean and maximum age of the sets returned,
+                  in seconds
+        """
+        return {
+            'sets': self.sets,
+            'partial_sets': self.partial_sets,
+            'dropped_sets': self.dropped_sets,
+            'skipped_sets': self.skipped_sets,
+            'overflowed': self.overflowed,
+            'max_skew_s': self.max_skew,
+            'mean_age_s': self._age_sum / self.popped if self.popped else 0.0,
+            'max_age_s': self.max_age,
+        }
@@ -0,0 +1,92 @@
+#!/usr/bin/env python2
+from __future__ import division
+import numpy as np
+
+# 8 bit encodings wrapped without copying, and their channels
+ENCODING_CHANNELS = {
+    'mono8': 1,
+    '8UC1': 1,
+    'bgr8': 3,
+    'rgb8': 3,
+    '8UC3': 3,
+}
+
+
+def image_to_array(msg):
+    """Wrap the data of a sensor_msgs/Image in a read-only array, without
+    copying. Rows are `msg.step` bytes apart, so padded rows give a
+    non-contiguous view.
+
+    Args:
+        msg (Image): the image message
+
+    Returns:
+        np.ndarray: (H, W) or (H, W, 3) uint8 view of msg.data
+
+    Raises:
+        ValueError: if the encoding cannot be wrapped
+    """
+    channels = ENCODING_CHANNELS.get(msg.encoding)
+    if channels is None:
+        raise ValueError('Cannot wrap {} images'.format(msg.encoding))
+    if msg.step < msg.width * channels:
+        raise ValueError('Image step {} is too small for width {}'.format(
+            msg.step, msg.width))
+    if channels == 1:
+        shape, strides = (msg.height, msg.width), (msg.step, 1)
+    else:
+        shape = (msg.height, msg.width, channels)
+        strides = (msg.step, channels, 1)
+    image = np.ndarray(shape, dtype=np.uint8, buffer=msg.data,
+                       strides=strides)
+    # msg.data may be a bytearray, the view must not change under the flow
+    image.flags.writeable = False
+    return image
+
+
+class ImageIngest(object):
+    """Converts image messages to arrays: a view of the message data when
+    the encoding allows it, otherwise a copy with cv_bridge.
+
+    Args:
+        bridge (CvBridge, optional): used for the other encodings.
+                                     Defaults to None (they raise).
+    """
+    def __init__(self, bridge=None):
+        self.bridge = bridge
+        self.frames = 0
+        self.copied_frames = 0
+        self.bytes_copied = 0
+
+    def __call__(self, msg):
+        """The image of a message
+
+        Args:
+            msg (Image): the image message
+
+        Returns:
+            np.ndarray: the image
+        """
+        self.frames += 1
+        try:
+            return image_to_array(msg)
+        except ValueError:
+            if self.bridge is None:
+                raise
+        image = self.bridge.imgmsg_to_cv2(msg)
+        self.copied_frames += 1
+        self.bytes_copied += image.nbytes
+        return image
+
+    def stats(self):
+        """Frames converted, and how many of them were copied
+
+        Returns:
+            dict: frames, copied frames and bytes copied per frame
+        """
+        return {
+            'frames': self.frames,
+            'copied_frames': self.copied_frames,
+            'bytes_copied_per_frame': (self.bytes_copied / self.frames
+                                       if self.frames else 0.0),
+        }
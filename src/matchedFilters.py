@@ -2,6 +2,170 @@
 from __future__ import division
 import numpy as np
 import io
+import os
+import struct
+import zipfile
+from collections import OrderedDict
+
+
+# Axis of the filter of each camera (C45, C0, CN45)
+FILTER_ANGLES = [-45, 0, 45]
+# Yaw offset of the two filters of each camera in dual mode
+DUAL_OFFSET = 10
+# Format version of the exported filter banks
+BANK_VERSION = 1
+
+
+def rotation_matrix(orientation):
+    """ Generate the rotation matrix for the given orientation.
+    :param orientation (list): roll, pitch, yaw in degrees
+    """
+    roll, pitch, yaw = orientation
+
+    # Get the angles in radians for each direction
+    rx = np.deg2rad(roll)
+    ry = np.deg2rad(pitch)
+    rz = np.deg2rad(yaw)
+
+    # Roll rotation matrix
+    Rx = np.array([[1, 0, 0],
+                   [0, np.cos(rx), -np.sin(rx)],
+                   [0, np.sin(rx), np.cos(rx)]])
+    # Pitch rotation matrix
+    Ry = np.array([[np.cos(ry), 0, np.sin(ry)],
+                   [0, 1, 0],
+                   [-np.sin(ry), 0, np.cos(ry)]])
+    # Yaw rotation matrix
+    Rz = np.array([[np.cos(rz), -np.sin(rz), 0],
+                   [np.sin(rz), np.cos(rz), 0],
+                   [0, 0, 1]])
+
+    return np.matmul(np.matmul(Rx, Ry), Rz)
+
+
+def camera_rays(cam_w, cam_h, fovx, fovy):
+    """ Ray table of a camera: the (unrotated) viewing direction of
+    every pixel, with x as the direction of viewing.
+    :param cam_w (int): camera width in pixels
+    :param cam_h (int): camera height in pixels
+    :param fovx (float): horizontal fov in radians
+    :param fovy (float): vertical fov in radians
+    :returns: array of shape (cam_h, cam_w, 3)
+    """
+    vertical_views = (((np.arange(cam_h, dtype=float) -
+                        cam_h / 2.0) / float(cam_h)) * fovy)
+    horizontal_views = (((np.arange(cam_w, dtype=float) -
+                          cam_w / 2.0) / float(cam_w)) * fovx)
+
+    D = np.ones([cam_h, cam_w, 3])
+    D[:, :, 1], D[:, :, 2] = np.meshgrid(np.tan(horizontal_views),
+                                         np.tan(vertical_views))
+    return D
+
+
+def rotate_rays(D, rotations):
+    """ Rotate every ray of a ray table in one batched operation.
+    :param D (numpy array): ray table of shape (cam_h, cam_w, 3)
+    :param rotations (numpy array): a (3, 3) rotation matrix or
+           a stack of N of them, shape (N, 3, 3)
+    :returns: array of shape (cam_h, cam_w, 3) or (N, cam_h, cam_w, 3)
+    """
+    h, w, _ = D.shape
+    # One matrix product over the flattened table: (h * w, 3) x (..., 3, 3)
+    rays = np.matmul(D.reshape(-1, 3), np.swapaxes(rotations, -1, -2))
+    return rays.reshape(rotations.shape[:-2] + (h, w, 3))
+
+
+def translational_filters(D, axes):
+    """ Translational matched filters for (stacks of) viewing directions
+    and axes, using the formulae in
+    "Franz & Krapp - Wide-field, motion-sensitive neurons
+    and matched filters for optic  flow fields."
+    :param D (numpy array): rays of shape (..., cam_h, cam_w, 3)
+    :param axes (numpy array): axes of shape (..., 3)
+    :returns: array of shape (..., cam_h, cam_w, 2)
+    """
+    D = D / np.sqrt(np.einsum('...i,...i->...', D, D))[..., np.newaxis]
+    axes = np.asarray(axes, dtype=float)[..., np.newaxis, np.newaxis, :]
+    # -((D x a) x D) expanded for unit D: D (D . a) - a
+    projection = np.einsum('...i,...i->...', D, axes)[..., np.newaxis]
+    return D[..., 1:] * projection - axes[..., 1:]
+
+
+def matched_filter_bank(cam_w, cam_h, fov, orientations, axes):
+    """ Generate a whole bank of N matched filters in one call.
+    :param cam_w (int): camera width in pixels
+    :param cam_h (int): camera height in pixels
+    :param fov (list): fov x and fov y in degrees
+    :param orientations (list): N orientations (roll, pitch, yaw)
+    :param axes (list): N axes (roll, pitch, yaw)
+    :returns: array of shape (N, cam_h, cam_w, 2)
+    """
+    fovx, fovy = MatchedFilter._get_fov(fov)
+    rotations = np.array([rotation_matrix(list(map(float, o)))
+                          for o in orientations])
+    axes = np.array([np.matmul(rotation_matrix(list(map(float, a))),
+                               np.array([1, 0, 0]))
+                     for a in axes])
+
+    # Rotations keep the rays unit length, so normalise the table once
+    D = camera_rays(cam_w, cam_h, fovx, fovy).reshape(-1, 3)
+    D /= np.sqrt(np.einsum('ij,ij->i', D, D))[:, np.newaxis]
+
+    # (R D) . a == D . (R^T a), so the projections of all the filters
+    # come out of a single (h * w, 3) x (3, N) product
+    n = len(axes)
+    projection = np.dot(D, np.einsum('nji,nj->in', rotations, axes))
+    # Only the last two components of the rotated rays are needed
+    rays = np.dot(D, rotations[:, 1:, :].reshape(2 * n, 3).T)
+    mf = (rays.reshape(-1, n, 2) * projection[:, :, np.newaxis] -
+          axes[np.newaxis, :, 1:])
+    return np.ascontiguousarray(
+        mf.transpose(1, 0, 2)).reshape(n, cam_h, cam_w, 2)
+
+
+def separable_factors(mf, rank=1):
+    """ Factorise each component of a matched filter into a sum of `rank`
+    separable (outer product) terms with an SVD.
+    :param mf (numpy array): matched filter of shape (cam_h, cam_w, 2)
+    :param rank (int): number of separable terms per component
+           default: 1
+    :returns: U of shape (2, cam_h, rank) with the singular values folded
+              in, V of shape (2, cam_w, rank), and the relative (Frobenius)
+              error of the approximation against the exact filter
+    """
+    cam_h, cam_w, _ = mf.shape
+    U = np.empty((2, cam_h, rank))
+    V = np.empty((2, cam_w, rank))
+    for d in range(2):
+        u, sv, vt = np.linalg.svd(mf[:, :, d], full_matrices=False)
+        U[d] = u[:, :rank] * sv[:rank]
+        V[d] = vt[:rank].T
+
+    approximation = np.einsum('dhr,dwr->hwd', U, V)
+    error = np.linalg.norm(mf - approximation) / np.linalg.norm(mf)
+    return U, V, error
+
+
+def filter_support(mf, threshold=0.5):
+    """ Bounding box of the pixels where a matched filter weighs the flow
+    most: the weight (filter magnitude) is at least `threshold` times the
+    largest weight.
+    :param mf (numpy array): matched filter of shape (cam_h, cam_w, 2),
+           or a list of filters (e.g. the two of the dual mode) whose
+           supports are joined
+    :param threshold (float): fraction of the largest weight
+           default: 0.5
+    :returns: (x, y, w, h) of the box
+    """
+    weights = np.max([np.hypot(f[:, :, 0], f[:, :, 1])
+                      for f in np.reshape(mf, (-1,) + np.shape(mf)[-3:])],
+                     axis=0)
+    rows, cols = np.nonzero(weights >= threshold * weights.max())
+    return (int(cols.min()), int(rows.min()),
+            int(cols.max() - cols.min() + 1),
+            int(rows.max() - rows.min() + 1))
+
 
 class MatchedFilter():
     """ Class to generate matched filters.
@@ -71,21 +235,10 @@ class MatchedFilter():
     def _get_viewing_directions(self):
         """ Compute the camera viewing directions.
         """
-        # Get the vertical and horizontal views for the camera
-        vertical_views = (((np.arange(self.cam_h, dtype=float) -
-                            self.cam_h / 2.0) / float(self.cam_h)) *
-                          self.fovy)
-        horizontal_views = (((np.arange(self.cam_w, dtype=float) -
-                              self.cam_w / 2.0) / float(self.cam_w)) *
-                            self.fovx)
-
-        # Initialise D such that
-        # - the first two dimensions are the horizontal and vertical views
-        # - the last dimension is a 3D vector pointing towards the camers's view.
-        D = np.ones([self.cam_h, self.cam_w, 3])
-        D[:, :, 1], D[:, :, 2] = np.meshgrid(np.tan(horizontal_views),
-                                             np.tan(vertical_views))
-        
+        # The first two dimensions are the vertical and horizontal views,
+        # the last one is a 3D vector pointing towards the camera's view.
+        D = camera_rays(self.cam_w, self.cam_h, self.fovx, self.fovy)
+
         # Rotate to appropiate orientation of the camera
         D = self._rotate_viewing_directions(D)
         return D
@@ -93,53 +246,22 @@ class MatchedFilter():
     def _rotate_viewing_directions(self, D):
         """ Rotate each vector in the viewing directions
         to the appropiate orientation.
-        :param D (numpy array): array of size (cam_w, cam_h, 3)
+        :param D (numpy array): array of size (cam_h, cam_w, 3)
         """
-        for ii in range(self.cam_h):
-            for jj in range(self.cam_w):
-                # For each vector, transorm with the rotation matrix
-                D[ii, jj, :] = np.matmul(self.origin_rotation_matrix, D[ii, jj, :])
-                
-        return D
+        return rotate_rays(D, self.origin_rotation_matrix)
 
     def _rotation_matrix(self, orientation):
         """ Generate the rotation matrix for the appropiate orientation.
         :param orientation (list): roll, pitch, yaw
         """
-        roll, pitch, yaw = orientation
-
-        # Get the angles in radians for each direction
-        rx = np.deg2rad(roll)
-        ry = np.deg2rad(pitch)
-        rz = np.deg2rad(yaw)
-
-        # Roll rotation matrix
-        Rx = np.array([[1, 0, 0],
-                       [0, np.cos(rx), -np.sin(rx)],
-                       [0, np.sin(rx), np.cos(rx)]])
-        # Pitch rotation matrix
-        Ry = np.array([[np.cos(ry), 0, np.sin(ry)],
-                       [0, 1, 0],
-                       [-np.sin(ry), 0, np.cos(ry)]])
-        # Yaw rotation matrix
-        Rz = np.array([[np.cos(rz), -np.sin(rz), 0],
-                       [np.sin(rz), np.cos(rz), 0],
-                       [0, 0, 1]])
-
-        rot_mat = np.matmul(np.matmul(Rx, Ry), Rz)
-        return rot_mat
+        return rotation_matrix(orientation)
             
     def generate_filter(self):
         """ Generate the translational matched filter using the formulae in
         "Franz & Krapp - Wide-field, motion-sensitive neurons
         and matched filters for optic  flow fields."
         """
-        sin_theta = np.linalg.norm(self.D[:, :, 1:], axis=2) + 1e-14
-        sin_theta = np.repeat(sin_theta[:, :, np.newaxis], 2, axis=2)
-        mag_temp = np.linalg.norm(self.D, axis=2)
-        D = self.D / np.expand_dims(mag_temp, axis=2)
-        mf = -np.cross(np.cross(D, self.axis), D)[:, :, 1:] #/ sin_theta
-        return mf
+        return translational_filters(self.D, self.axis)
 
     def plot(self, show=False):
         """
@@ -220,6 +342,288 @@ class MatchedFilter():
         return np.array_str(self.matched_filter)
 
 
+class MatchedFilterCache(object):
+    """ Bounded LRU cache of matched filter arrays.
+    The filters only depend on the camera shape, FOV, orientation and axis,
+    so they can be generated once and shared between behaviours.
+    The cached arrays are read-only.
+
+    :param maxsize (int): maximum number of filters kept before evicting
+           the least recently used one
+           default: 32
+    """
+
+    def __init__(self, maxsize=32):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self.bank_loads = 0
+        self._filters = OrderedDict()
+        # path of the file -> FilterBank, one per file
+        self._banks = OrderedDict()
+
+    @staticmethod
+    def bank_key(path):
+        """ Normalised path of a bank file.
+        """
+        return os.path.realpath(os.path.abspath(path))
+
+    def add_bank(self, bank):
+        """ Serve misses from a precomputed FilterBank before generating.
+        A bank of a file already added is not added again.
+        :param bank (FilterBank): the loaded bank
+        :return: the bank serving that file
+        """
+        return self._banks.setdefault(self.bank_key(bank.path), bank)
+
+    def find_bank(self, path):
+        """ Return the bank added for a file or None.
+        """
+        return self._banks.get(self.bank_key(path))
+
+    @staticmethod
+    def key(cam_w, cam_h, fov, orientation, axis, dtype):
+        """ Build the cache key of a filter.
+        """
+        return (int(cam_w), int(cam_h),
+                tuple(map(float, fov)),
+                tuple(map(float, orientation)),
+                tuple(map(float, axis)),
+                np.dtype(dtype).str)
+
+    def get(self, cam_w, cam_h, fov,
+            orientation=[0.0, 0.0, 0.0],
+            axis=[0.0, 0.0, 0.0],
+            dtype=np.float64):
+        """ Return the matched filter array, generating it on a miss.
+        Same parameters as MatchedFilter, plus
+        :param dtype (numpy dtype): dtype of the returned filter
+               default: np.float64
+        """
+        key = self.key(cam_w, cam_h, fov, orientation, axis, dtype)
+        try:
+            mf = self._filters.pop(key)
+            self.hits += 1
+        except KeyError:
+            self.misses += 1
+            mf = self._from_banks(key)
+            if mf is None:
+                mf = np.asarray(MatchedFilter(cam_w, cam_h, fov,
+                                              orientation=orientation,
+                                              axis=axis).matched_filter,
+                                dtype=dtype)
+                mf.setflags(write=False)
+            if len(self._filters) >= self.maxsize:
+                self._filters.popitem(last=False)
+        # (Re)insert as the most recently used
+        self._filters[key] = mf
+        return mf
+
+    def get_stack(self, cam_w, cam_h, specs, dtype=np.float64):
+        """ Return the filters of several specs as one read-only
+        (N, H, W, 2) view of a loaded bank, without copying. Only banks
+        storing them consecutively, in this order, can serve them.
+        :param specs (list): (fov, orientation, axis) of each filter
+        :param dtype (numpy dtype): dtype of the filters
+        :return: the view, or None if no bank stores them so
+        """
+        keys = [self.key(cam_w, cam_h, fov, orientation, axis, dtype)
+                for fov, orientation, axis in specs]
+        for bank in self._banks.values():
+            stack = bank.get_stack(keys)
+            if stack is not None:
+                self.bank_loads += len(keys)
+                return stack
+        return None
+
+    def _from_banks(self, key):
+        """ Look a filter up in the loaded banks.
+        """
+        for bank in self._banks.values():
+            mf = bank.get_by_key(key)
+            if mf is not None:
+                self.bank_loads += 1
+                return mf
+        return None
+
+    def info(self):
+        """ Return the hit and miss counters and the current size.
+        Misses served from a precomputed bank are counted in bank_loads.
+        """
+        return {'hits': self.hits, 'misses': self.misses,
+                'bank_loads': self.bank_loads,
+                'size': len(self._filters), 'maxsize': self.maxsize}
+
+    def clear(self):
+        """ Empty the cache and reset the counters.
+        """
+        self._filters.clear()
+        self.hits = 0
+        self.misses = 0
+        self.bank_loads = 0
+
+
+# Shared by every behaviour in the process
+filter_cache = MatchedFilterCache()
+
+
+def get_matched_filter(cam_w, cam_h, fov,
+                       orientation=[0.0, 0.0, 0.0],
+                       axis=[0.0, 0.0, 0.0],
+                       dtype=np.float64):
+    """ Return a matched filter from the shared cache.
+    See MatchedFilterCache.get for the parameters.
+    """
+    return filter_cache.get(cam_w, cam_h, fov, orientation=orientation,
+                            axis=axis, dtype=dtype)
+
+
+def avoidance_filter_specs(camera_fov=45, num_filters=[5],
+                           axes=FILTER_ANGLES, dual_offset=DUAL_OFFSET):
+    """ Every (fov, orientation, axis) combination used by the avoidance
+    behaviours: one FOV crop per number of filters, the filter of each
+    camera, and the two offset variants of the dual mode.
+    They are ordered camera by camera, so that the filters of a behaviour
+    are a (C, K, H, W, 2) block of the exported bank (see
+    MatchedFilterCache.get_stack).
+    :param camera_fov (float): horizontal fov of the camera in degrees
+           default: 45
+    :param num_filters (list): number of filters the fov is split in
+           default: [5]
+    :param axes (list): yaw of the axis of each camera filter
+    :param dual_offset (float): yaw offset of the dual filters
+    """
+    specs = []
+    for n in num_filters:
+        fov = int(camera_fov / n)
+        for yaws in ((0,), (dual_offset, -dual_offset)):
+            for angle in axes:
+                for yaw in yaws:
+                    specs.append(((fov, fov), (0, 0, yaw), (0, 0, angle)))
+    return specs
+
+
+def export_filter_bank(path, cam_w, cam_h, specs, dtype=np.float32):
+    """ Compute a bank of filters and save it to an uncompressed .npz file
+    that can be memory-mapped with load_filter_bank.
+    :param path (str): output file
+    :param cam_w (int): camera width in pixels
+    :param cam_h (int): camera height in pixels
+    :param specs (list): (fov, orientation, axis) of each filter
+    :param dtype (numpy dtype): dtype of the stored filters, the
+           activation engine uses np.float32
+           default: np.float32
+    """
+    keys = np.array([list(fov) + list(o) + list(a) for fov, o, a in specs],
+                    dtype=np.float64)
+    filters = np.empty((len(specs), cam_h, cam_w, 2), dtype=dtype)
+
+    # One bank call per FOV crop
+    fovs = sorted(set(tuple(fov) for fov, _, _ in specs))
+    for fov in fovs:
+        idx = [i for i, spec in enumerate(specs) if tuple(spec[0]) == fov]
+        filters[idx] = matched_filter_bank(cam_w, cam_h, fov,
+                                           [specs[i][1] for i in idx],
+                                           [specs[i][2] for i in idx])
+
+    # np.savez stores the members uncompressed, so they can be mapped
+    np.savez(path, version=np.array(BANK_VERSION), keys=keys,
+             filters=filters)
+
+
+def _npz_memmap(path, name):
+    """ Memory-map an uncompressed member of a .npz file.
+    """
+    with zipfile.ZipFile(path) as zf:
+        info = zf.getinfo(name + '.npy')
+    if info.compress_type != zipfile.ZIP_STORED:
+        raise ValueError('{} is compressed in {}, it cannot be mapped'.format(
+            name, path))
+
+    with open(path, 'rb') as f:
+        # Skip the zip local file header to get to the .npy data
+        f.seek(info.header_offset)
+        name_len, extra_len = struct.unpack('<HH', f.read(30)[26:30])
+        f.seek(info.header_offset + 30 + name_len + extra_len)
+        major, _ = np.lib.format.read_magic(f)
+        if major == 1:
+            shape, fortran, dtype = np.lib.format.read_array_header_1_0(f)
+        else:
+            shape, fortran, dtype = np.lib.format.read_array_header_2_0(f)
+        offset = f.tell()
+
+    return np.memmap(path, dtype=dtype, mode='r', offset=offset, shape=shape,
+                     order='F' if fortran else 'C')
+
+
+class FilterBank(object):
+    """ Precomputed matched filters memory-mapped from a file written by
+    export_filter_bank, so that several nodes share the page-cached bank.
+
+    :param path (str): the .npz bank file
+    """
+
+    def __init__(self, path):
+        with np.load(path) as data:
+            version = int(data['version'])
+            keys = data['keys']
+        if version != BANK_VERSION:
+            raise ValueError('Filter bank {} has version {}, expected {}'.format(
+                path, version, BANK_VERSION))
+
+        self.path = path
+        self.filters = _npz_memmap(path, 'filters')
+        _, self.cam_h, self.cam_w, _ = self.filters.shape
+        self._index = {}
+        for i, k in enumerate(keys):
+            key = MatchedFilterCache.key(self.cam_w, self.cam_h, k[:2], k[2:5],
+                                         k[5:], self.filters.dtype)
+            self._index[key] = i
+
+    def __len__(self):
+        return len(self._index)
+
+    def get_by_key(self, key):
+        """ Return the filter for a MatchedFilterCache key or None.
+        """
+        i = self._index.get(key)
+        if i is None:
+            return None
+        return self.filters[i]
+
+    def get_stack(self, keys):
+        """ Return the filters of consecutive keys as a view, or None if
+        they are not stored consecutively in this order.
+        """
+        first = self._index.get(keys[0])
+        if first is None or any(self._index.get(key) != first + i
+                                for i, key in enumerate(keys)):
+            return None
+        return self.filters[first:first + len(keys)]
+
+    def get(self, cam_w, cam_h, fov,
+            orientation=[0.0, 0.0, 0.0],
+            axis=[0.0, 0.0, 0.0],
+            dtype=np.float64):
+        """ Return a filter of the bank or None if it is not in it.
+        """
+        return self.get_by_key(MatchedFilterCache.key(
+            cam_w, cam_h, fov, orientation, axis, dtype))
+
+
+def load_filter_bank(path, cache=None):
+    """ Memory-map a filter bank and make the cache serve filters from it.
+    Each file is mapped once per cache, loading it again returns the bank
+    already mapped.
+    :param path (str): the .npz bank file
+    :param cache (MatchedFilterCache): defaults to the shared cache
+    """
+    cache = cache or filter_cache
+    bank = cache.find_bank(path)
+    if bank is None:
+        bank = cache.add_bank(FilterBank(path))
+    return bank
+
     
 if __name__ == '__main__':
     import argparse
@@ -241,9 +645,36 @@ if __name__ == '__main__':
     parser.add_argument('-a', '--axis', nargs='+', default=[0.0, 0.0, 0.0],
                         help="""Prefered axis of orientation
                         Default: [0.0, 0.0, 0.0]""")
+    parser.add_argument('--export', type=str, default='',
+                        help="""Export the avoidance filter bank to this
+                        .npz file instead of plotting""")
+    parser.add_argument('--camera_fov', type=float, default=45,
+                        help="""Horizontal fov of the camera for the bank
+                        Default: 45""")
+    parser.add_argument('--num_filters', type=int, nargs='+', default=[5],
+                        help="""FOV splits (crops) to include in the bank
+                        Default: 5""")
+    parser.add_argument('--rank', type=int, default=0,
+                        help="""Report the error of the separable
+                        approximation with this rank""")
+    parser.add_argument('--dtype', type=str, default='float32',
+                        help="""dtype of the exported filters
+                        Default: float32""")
     args = parser.parse_args()
 
-    mf = MatchedFilter(args.width, args.height, args.fov, 
-                       orientation=args.orientation,
-                       axis=args.axis)
-    mf.plot(show=True)
+    if args.export:
+        specs = avoidance_filter_specs(args.camera_fov, args.num_filters)
+        export_filter_bank(args.export, args.width, args.height, specs,
+                           dtype=np.dtype(args.dtype))
+        print('Saved {} filters of {}x{} (version {}) to {}'.format(
+            len(specs), args.width, args.height, BANK_VERSION, args.export))
+
+    else:
+        mf = MatchedFilter(args.width, args.height, args.fov, 
+                           orientation=args.orientation,
+                           axis=args.axis)
+        if args.rank:
+            _, _, error = separable_factors(mf.matched_filter, args.rank)
+            print('Rank {} approximation error: {:.3e}'.format(args.rank,
+                                                              error))
+        mf.plot(show=True)
@@ -93,13 +93,15 @@ class ActivationDecisionMaker(object):
         return sum(decisions) >= self.min_decisions
     
 
-    def step(self, activations, activatione):
+    def step(self, activations, activation, distance=np.nan):
         """Perform a checking step
 
         Args:
+            activations (deque): previous activations, the new one is
+                                 appended
             activation (new activation): new activation
-            distance (bool, optional): Distance (only for reporting). 
-                                       Defaults to False.
+            distance (float, optional): Distance (only for reporting). 
+                                        Defaults to nan.
 
         Returns:
             bool: decision
@@ -1,31 +1,257 @@
 #!/usr/bin/env python2
 from __future__ import division
 import numpy as np
-from sensor_msgs.msg import CameraInfo
 from camera import Camera
+from flow_backends import FarnebackBackend
 from warnings import warn
-import rospy
 import cv2
 import numpy as np
 import os
 import time
 
 
+class FrameRing(object):
+    """Preallocated ring of contiguous black and white frames and their
+    (float64) timestamps. New frames overwrite the oldest slot, so
+    nothing is copied around or allocated once the ring exists.
+
+    Read-only contiguous frames (e.g. views of image message data, see
+    image_ingest) cannot change under the ring, so they are kept by
+    reference instead of copied. Colour frames are converted into a slot.
+    """
+    def __init__(self, height, width, size=2):
+        """Initialise the ring
+
+        Args:
+            height (int): frame height
+            width (int): frame width
+            size (int, optional): number of frames kept. Defaults to 2.
+        """
+        self.size = size
+        self.frames = np.zeros((size, height, width), dtype=np.uint8)
+        self.times = np.zeros(size, dtype=np.float64)
+        # Fixed views, so that callers can write a frame in place
+        self._slots = [self.frames[i] for i in range(size)]
+        # The frame of each slot, its buffer or an adopted frame
+        self._current = list(self._slots)
+        self.bytes_copied = 0
+        self.pushes = 0
+        # Slot of the newest frame
+        self.head = 0
+
+    def next_slot(self):
+        """The buffer the next frame will be stored in, to write
+        an incoming frame straight into the ring.
+        """
+        return self._slots[(self.head + 1) % self.size]
+
+    def push(self, image, this_time):
+        """Store a new frame, overwriting the oldest one
+
+        Args:
+            image (np.ndarray): the black and white or BGR frame, or the
+                                buffer from next_slot if it has already
+                                been written to
+            this_time (float): timestamp of the frame
+        """
+        slot = (self.head + 1) % self.size
+        buffer = self._slots[slot]
+        if image is buffer:
+            current = buffer
+        elif image.ndim == 3:
+            current = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY, dst=buffer)
+            self.bytes_copied += buffer.nbytes
+        elif not image.flags.writeable and image.flags.c_contiguous:
+            current = image
+        else:
+            np.copyto(buffer, image)
+            current = buffer
+            self.bytes_copied += buffer.nbytes
+        self._current[slot] = current
+        self.pushes += 1
+        self.times[slot] = this_time
+        self.head = slot
+
+    def frame(self, age=0):
+        """Frame pushed `age` steps ago (0 is the newest)
+        """
+        return self._current[(self.head - age) % self.size]
+
+    def time(self, age=0):
+        """Timestamp of the frame pushed `age` steps ago
+        """
+        return self.times[(self.head - age) % self.size]
+
+
+class FrameGate(object):
+    """Decides whether a frame changed enough since the keyframe, the last
+    frame that was worth a dense flow, from the mean absolute difference
+    of the two frames downsampled by 2**level (area averaging, so that
+    noise is smoothed out). A hovering vehicle, or a republished frame,
+    gives a difference close to 0. Comparing with the keyframe rather than
+    the previous frame, slow motion below the threshold between
+    consecutive frames (a slow approach to a wall) still opens the gate
+    once it adds up.
+    """
+    def __init__(self, height, width, threshold, level=3):
+        """Initialise the gate
+
+        Args:
+            height (int): frame height
+            width (int): frame width
+            threshold (float): mean absolute difference, in grey levels,
+                               below which the frame is static
+            level (int, optional): downsampling octaves. Defaults to 3.
+        """
+        self.threshold = threshold
+        self.size = (max(1, width >> level), max(1, height >> level))
+        self._small = np.zeros(self.size[::-1], dtype=np.uint8)
+        self._key = np.zeros(self.size[::-1], dtype=np.uint8)
+        self._has_key = False
+        # difference of the last frame with the keyframe
+        self.energy = 0.0
+
+    def changed(self, image):
+        """Downsample a new frame and compare it with the keyframe, which
+        it replaces if it changed
+
+        Args:
+            image (np.ndarray): the black and white frame
+
+        Returns:
+            bool: False if the frame is static (below the threshold), True
+                  otherwise and for the first frame
+        """
+        cv2.resize(image, self.size, dst=self._small,
+                   interpolation=cv2.INTER_AREA)
+        if self._has_key:
+            self.energy = (cv2.norm(self._small, self._key, cv2.NORM_L1) /
+                           self._small.size)
+            if self.energy < self.threshold:
+                return False
+        self._has_key = True
+        self._small, self._key = self._key, self._small
+        return True
+
+
 class OpticFlow(object):
     """ Class to generate optic flow
     """
-    def __init__(self, camera_instance):
+    GATE_MODES = ('hold', 'zero')
+    # Smallest roi side, DIS crashes on thinner images
+    MIN_ROI_SIZE = 32
+
+    def __init__(self, camera_instance, backend=None, warm_start=False,
+                 max_dt_ratio=1.5, gate_threshold=0.0,
+                 gate_level=3, gate_mode='hold', cascade_level=0, roi=None,
+                 roi_margin=0, adaptive=False):
         """Initialise the optic flow class
 
         Args:
             camera_instance (Camera): the camera object
+            backend (FlowBackend, optional): optic flow algorithm.
+                                             Defaults to Farneback.
+            warm_start (bool, optional): start each flow from the previous
+                                         one scaled by the frame interval
+                                         ratio. Defaults to False.
+            max_dt_ratio (float, optional): frame interval change above
+                                            which a frame is considered
+                                            dropped and the flow is cold
+                                            started. Defaults to 1.5.
+            gate_threshold (float, optional): mean absolute difference
+                                              (grey levels) of the
+                                              downsampled frames below
+                                              which the flow is not
+                                              computed, see FrameGate.
+                                              Defaults to 0 (no gating).
+            gate_level (int, optional): downsampling octaves of the gate.
+                                        Defaults to 3.
+            gate_mode (str, optional): flow of the static frames, hold
+                                       (the last flow) or zero. Defaults
+                                       to 'hold'.
+            cascade_level (int, optional): compute the flow on the frames
+                                           downsampled by 2**cascade_level,
+                                           upsampled to full resolution,
+                                           and at full resolution only
+                                           when refine is called. Defaults
+                                           to 0 (always full resolution).
+            roi (tuple, optional): (x, y, w, h) region of the frame the
+                                   full resolution flow is computed in,
+                                   zero outside it (or the upsampled
+                                   coarse flow of a cascade). Defaults to
+                                   None (the whole frame).
+            roi_margin (int, optional): pixels added around the roi, so
+                                        that the flow window of its border
+                                        pixels sees the image. Defaults to
+                                        0.
+            adaptive (bool, optional): build the quality ladder, the
+                                       backend then its cheaper variants
+                                       and last the cheapest one on the
+                                       frames downsampled by 2, selected
+                                       with set_quality (see
+                                       QualityController). With a
+                                       cascade, the coarse step of a rung
+                                       is its backend scaled by
+                                       cascade_level. Defaults to False.
         """
         self.cam = camera_instance
+        self.backend = backend or FarnebackBackend()
         self.flow = None
-        # we have a 3 dimensional image array for our black and white images
-        self._bw_image_array = np.zeros((self.cam.h, self.cam.w, 2), 
-                                        dtype=np.uint8)
-        self._time_array = np.zeros((2), dtype=np.float32)
+
+        self.warm_start = warm_start and self.backend.supports_initial_flow
+        self.max_dt_ratio = max_dt_ratio
+        # interval of the frames of the last flow, 0 when there is no
+        # flow to warm start from
+        self._last_dt = 0.0
+        self.warm_steps = 0
+        self.cold_steps = 0
+        # region of the full resolution flow, with its margin
+        self.roi = self._crop(roi, roi_margin)
+        # ring of the last two black and white frames and their times
+        # (not cropped to the roi)
+        self.frames = FrameRing(self.cam.h, self.cam.w)
+        # the backends write the flow in place
+        self._flow = np.zeros((self.cam.h, self.cam.w, 2), dtype=np.float32)
+        if self.roi is not None:
+            x, y, w, h = self.roi
+            self._roi_slice = (slice(y, y + h), slice(x, x + w))
+            # contiguous copies of the roi (as some backends need)
+            self.roi_frames = FrameRing(h, w)
+            self._roi_flow = np.zeros((h, w, 2), dtype=np.float32)
+
+        if gate_mode not in self.GATE_MODES:
+            raise ValueError('Unknown gate mode {}, use one of {}'.format(
+                gate_mode, ', '.join(self.GATE_MODES)))
+        self.gate = (FrameGate(self.cam.h, self.cam.w, gate_threshold,
+                               gate_level)
+                     if gate_threshold > 0 else None)
+        self.gate_mode = gate_mode
+        self.gated_steps = 0
+        # whether the last step was gated (its flow is held or zero)
+        self.gated = False
+
+        # quality ladder, (backend, downsampling octaves) from the best
+        self.quality = 0
+        self.ladder = [(self.backend, 0)]
+        if adaptive:
+            cheaper = self.backend.cheaper()
+            self.ladder += [(backend, 0) for backend in cheaper]
+            self.ladder.append(((cheaper or [self.backend])[-1].scaled(1), 1))
+
+        # coarse step of each rung of the cascade, the rung's backend on
+        # frames downsampled by cascade_level octaves more
+        self.cascade_level = cascade_level
+        self.refined_steps = 0
+        self.coarse_ladder = [(backend.scaled(cascade_level),
+                               octaves + cascade_level)
+                              for backend, octaves in self.ladder
+                              ] if cascade_level else []
+
+        # octaves -> ring of the downsampled frames, their flow and the
+        # scale of their pixels, for the rungs that need them
+        self._downsampled = {
+            octaves: self._downsampled_buffers(octaves)
+            for _, octaves in self.ladder + self.coarse_ladder if octaves}
 
         self.initialised = False
         self.__flow_iterations = 0
@@ -33,6 +259,166 @@ class OpticFlow(object):
         self.viewing_directions = None
 
 
+    def _downsampled_buffers(self, octaves):
+        """Ring of the frames downsampled by 2**octaves, their flow and the
+        scale of their pixels to the full resolution ones
+        """
+        h = max(1, self.cam.h >> octaves)
+        w = max(1, self.cam.w >> octaves)
+        scale = np.array([self.cam.w / w, self.cam.h / h], dtype=np.float32)
+        return (FrameRing(h, w), np.zeros((h, w, 2), dtype=np.float32),
+                scale)
+
+    @staticmethod
+    def _push_downsampled(frames, image, this_time):
+        slot = frames.next_slot()
+        cv2.resize(image, slot.shape[::-1], dst=slot,
+                   interpolation=cv2.INTER_AREA)
+        frames.push(slot, this_time)
+
+    def set_quality(self, quality):
+        """Select a rung of the quality ladder, 0 is the best
+
+        Args:
+            quality (int): the rung, clipped to the ladder
+        """
+        quality = min(max(0, quality), len(self.ladder) - 1)
+        if quality != self.quality:
+            self.quality = quality
+            # the last flow is from other settings
+            self._last_dt = 0.0
+            if self.roi is not None:
+                self._clear_outside_roi()
+
+    def _clear_outside_roi(self):
+        """Zero the flow outside the roi, as the full resolution flow
+        """
+        x, y, w, h = self.roi
+        self._flow[:y] = 0.0
+        self._flow[y + h:] = 0.0
+        self._flow[y:y + h, :x] = 0.0
+        self._flow[y:y + h, x + w:] = 0.0
+
+    def _crop(self, roi, margin):
+        """The roi grown by the margin (and to MIN_ROI_SIZE) and clipped to
+        the frame, None if it is the whole frame
+        """
+        if roi is None:
+            return None
+        x, y, w, h = roi
+        if w <= 0 or h <= 0:
+            raise ValueError('Empty flow roi {}'.format(roi))
+        x0, x1 = self._grow(x, w, margin, self.cam.w)
+        y0, y1 = self._grow(y, h, margin, self.cam.h)
+        if (x1 - x0, y1 - y0) == (self.cam.w, self.cam.h):
+            return None
+        return (x0, y0, x1 - x0, y1 - y0)
+
+    def _grow(self, start, length, margin, size):
+        """Range of one axis of the roi, within [0, size)
+        """
+        start, end = max(0, start - margin), min(size, start + length + margin)
+        length = max(end - start, min(self.MIN_ROI_SIZE, size))
+        # centred on the grown range, shifted back inside the frame
+        start = min(max(0, (start + end - length) // 2), size - length)
+        return start, start + length
+
+    @property
+    def roi_fraction(self):
+        """Fraction of the frame the full resolution flow is computed in
+        """
+        if self.roi is None:
+            return 1.0
+        return self.roi[2] * self.roi[3] / (self.cam.w * self.cam.h)
+
+    def _compute(self, initial):
+        """Full resolution flow of the last two frames, in the roi, with
+        the backend of the current quality
+        """
+        backend, octaves = self.ladder[self.quality]
+        if octaves:
+            return self._downsampled_step(backend, octaves, initial)
+        if self.roi is None:
+            return backend.compute(self.frames.frame(1),
+                                   self.frames.frame(0),
+                                   self._flow, initial=initial)
+        rows, cols = self._roi_slice
+        if initial:
+            # from the flow in the roi (warm start, or coarse flow)
+            np.copyto(self._roi_flow, self._flow[rows, cols])
+        backend.compute(self.roi_frames.frame(1),
+                             self.roi_frames.frame(0),
+                             self._roi_flow, initial=initial)
+        self._flow[rows, cols] = self._roi_flow
+        return self._flow
+
+    def reset(self):
+        """Cold start the next flow (e.g. after a saccade)
+        """
+        self._last_dt = 0.0
+
+    def _warm_start_ratio(self, dt):
+        """Scale to apply to the last flow to use it as the initial
+        estimate, or None to cold start.
+        """
+        if not self.warm_start or self._last_dt <= 0.0 or dt <= 0.0:
+            return None
+        ratio = dt / self._last_dt
+        # A frame drop (or a burst) changes the interval too much
+        if ratio > self.max_dt_ratio or ratio < 1.0 / self.max_dt_ratio:
+            return None
+        return ratio
+
+    def _gated_step(self):
+        """Flow of a static frame, without computing it
+        """
+        self.gated_steps += 1
+        self.gated = True
+        if self.flow is None or self.gate_mode == 'zero':
+            self._flow[...] = 0.0
+            self.flow = self._flow
+            # nothing to warm start from
+            self._last_dt = 0.0
+        return self.flow
+
+    def _downsampled_step(self, backend, octaves, initial):
+        """Flow of the frames downsampled by 2**octaves, upsampled into the
+        full resolution flow buffer
+        """
+        frames, flow, scale = self._downsampled[octaves]
+        backend.compute(frames.frame(1), frames.frame(0), flow,
+                        initial=initial)
+        cv2.resize(flow, (self.cam.w, self.cam.h), dst=self._flow,
+                   interpolation=cv2.INTER_LINEAR)
+        self._flow *= scale
+        if self.roi is not None:
+            self._clear_outside_roi()
+        return self._flow
+
+    def _warm_flow(self):
+        """The flow buffer the next step starts from
+        """
+        ladder = self.coarse_ladder or self.ladder
+        octaves = ladder[self.quality][1]
+        return self._downsampled[octaves][1] if octaves else self._flow
+
+    def refine(self):
+        """Compute the full resolution flow of the last step of a cascade,
+        starting from the upsampled coarse flow when the backend can
+
+        Returns:
+            np.ndarray: the flow, None before the flow is initialised. The
+                        flow of a gated step is returned as it is, the
+                        frames did not change.
+        """
+        if not self.initialised:
+            return None
+        if self.gated:
+            return self.flow
+        self.refined_steps += 1
+        self.flow = self._compute(initial=self.backend.supports_initial_flow)
+        return self.flow
+
     @property
     def __initialised(self):
         """
@@ -51,50 +437,60 @@ class OpticFlow(object):
         """Perform a step of optic flow computation
 
         Args:
-            new_image_bw (Image): a black and white image
+            new_image_bw (Image): a black and white image, or the buffer
+                                  from self.frames.next_slot() already
+                                  written to
             this_time (int): timestamp for this image
         """
         # start each step assuming that the optic flow is valid 
         self.optic_flow_valid = True
 
-        # If incoming image is colour then set to grayscale
+        # If incoming image is colour the ring converts it into a slot
         if not len(new_image_bw.shape) == 2:
-            new_image_bw = cv2.cvtColor(new_image_bw, cv2.COLOR_BGR2GRAY)
             warn('Using colour images, for better performance input grayscale images')
 
-        # roll the image & time buffers and insert the new frame - 
+        # insert the new frame in place of the oldest one - 
         # note the buffer size is 2 so the t-2th frame is
         # discarded by this process
-        self._bw_image_array = np.roll(self._bw_image_array, shift=1, axis=2)
-        self._time_array = np.roll(self._time_array, shift=1, axis=0)
-        self._bw_image_array[:, :, 0] = new_image_bw
-        self._time_array[0] = this_time
+        self.frames.push(new_image_bw, this_time)
+        changed = self.gate is None or self.gate.changed(self.frames.frame())
+        self.gated = False
+        if self.roi is not None:
+            slot = self.roi_frames.next_slot()
+            np.copyto(slot, self.frames.frame()[self._roi_slice])
+            self.roi_frames.push(slot, this_time)
+        for frames, _, _ in self._downsampled.values():
+            self._push_downsampled(frames, self.frames.frame(), this_time)
 
         # We need at least 2 frames for OF
         if self.__initialised:
+
+            self.time_between_frames_s = (self.frames.time(0) - 
+                                          self.frames.time(1))
+
+            if not changed:
+                return self._gated_step()
+
+            ratio = self._warm_start_ratio(self.time_between_frames_s)
+            if ratio is None:
+                self.cold_steps += 1
+            else:
+                # the last flow, scaled to the new frame interval
+                self._warm_flow()[...] *= ratio
+                self.warm_steps += 1
         
-            self.flow = cv2.calcOpticalFlowFarneback(
-                self._bw_image_array[:, :, 1],
-                self._bw_image_array[:, :, 0],
-                None,  # in python 3 this isn't required
-                pyr_scale=0.5,
-                levels=3,
-                winsize=50,
-                # winsize=10,
-                iterations=3,
-                poly_n=5,
-                poly_sigma=1.1,
-                flags=0
-            )
-
-
-            self.time_between_frames_s = (self._time_array[0] - 
-                                          self._time_array[1])
+            if self.cascade_level:
+                self.flow = self._downsampled_step(
+                    *self.coarse_ladder[self.quality],
+                    initial=ratio is not None)
+            else:
+                self.flow = self._compute(initial=ratio is not None)
+            self._last_dt = self.time_between_frames_s
 
             # ensure that time is moving forwards
             if self.time_between_frames_s <= 0.0:
                 warn('this is the same image message time stamp')
                 print('latest timestamp {} is the same as the previous image message time'.
-                      format(self._time_array[0]))
+                      format(self.frames.time(0)))
 
             return self.flow
@@ -1,14 +1,22 @@
 #!/usr/bin/env python2
 from __future__ import division
 import os
+import threading
+import time
 import numpy as np
 from collections import deque
 from sensor_msgs.msg import CameraInfo, Image
 from matchedFilters import MatchedFilter
 from geometry_msgs.msg import TwistStamped
 from geometry_msgs.msg import PoseStamped
+from diagnostic_msgs.msg import DiagnosticArray, DiagnosticStatus, KeyValue
 from pyx4_avoidance.msg import flow as FlowMsg
-from opticFlow import OpticFlow
+from avoidance_pipeline import AvoidancePipeline
+from frame_buffer import FrameBuffer
+from frame_sync import FrameSynchronizer
+from image_ingest import ImageIngest
+from preprocess import Preprocessor
+from timing import make_timer
 from avoidance_functions import get_direction, get_activation
 from obstacleFinder import ActivationDecisionMaker as DecisionMaker
 from pyx4_avoidance.msg import activation as ActivationMsg
@@ -21,13 +29,6 @@ from camera_labels import *
 from camera import Camera
 import rospy
 import sys
-from avoidance_behaviours import TunnelCenteringBehaviour, AvoidanceBehaviour, SaccadeBehaviour
-
-try:
-   from queue import Queue
-except ImportError:
-   import Queue as Queue
-
 
 from cv_bridge import CvBridge, CvBridgeError
 bridge = CvBridge()
@@ -35,6 +36,11 @@ bridge = CvBridge()
 
 NODE_NAME = 'pyx4_avoidance_node'
 
+# Timed with --timing: the age of the frames when received and when their
+# flow starts, the duration of each step, and the age when published
+TIMING_STAGES = ['receipt', 'queue', 'flow', 'activation', 'behaviour',
+                 'publish', 'total']
+
 
 class OpticFlowROS():
    
@@ -46,7 +52,33 @@ class OpticFlowROS():
                 cam_info="/resize_img/camera_info", 
                 wait_for_imtopic_s=100,
                 data_collection=False,
-                save_flow=''):
+                save_flow='',
+                filter_bank='',
+                flow_backend='farneback',
+                flow_backend_params={},
+                camera_backends={},
+                warm_start=False,
+                gate_threshold=0.0,
+                gate_mode='hold',
+                cascade_level=0,
+                cascade_margin=0.5,
+                rois={},
+                roi_threshold=0.0,
+                quality_deadline=0.0,
+                workers='serial',
+                cv_threads=None,
+                frame_policy='latest',
+                frame_buffer_size=1,
+                frame_max_block=1.0,
+                sync_policy='approximate',
+                sync_tolerance=0.01,
+                sync_incomplete='reuse',
+                preprocess=False,
+                resize_params={},
+                rectify=False,
+                diagnostics_period=1.0,
+                timing=False,
+                timing_period=5.0):
       
       self.node_name = node_name
 
@@ -65,11 +97,38 @@ class OpticFlowROS():
          CN45: cam_n45_topic
       }
 
+      # Bounded, so that decisions are made on fresh frames
+      frame_policy = rospy.get_param('~frame_policy', frame_policy)
+      frame_buffer_size = rospy.get_param('~frame_buffer_size', frame_buffer_size)
+      frame_max_block = rospy.get_param('~frame_max_block', frame_max_block)
+      # Grey, rectify and resize the raw images here instead of image_proc
+      self.preprocessors = {}
+      if rospy.get_param('~preprocess', preprocess):
+         self._init_preprocessing(rospy.get_param('~resize', resize_params),
+                                  rospy.get_param('~rectify', rectify),
+                                  wait_for_imtopic_s)
+
       self.image_queues = {
-         C0: Queue(),
-         C45: Queue(),
-         CN45: Queue(),
+         cam: FrameBuffer(frame_policy, frame_buffer_size, clock=rospy.get_time,
+                          max_block=frame_max_block)
+         for cam in (C0, C45, CN45)
       }
+      # Release the subscriber threads blocked on a full buffer
+      rospy.on_shutdown(self._close_queues)
+      self._last_dropped = {cam: 0 for cam in self.image_queues}
+
+      # Frame-sets of the three cameras, grouped by header stamp
+      sync_policy = rospy.get_param('~sync_policy', sync_policy)
+      sync_tolerance = rospy.get_param('~sync_tolerance', sync_tolerance)
+      sync_incomplete = rospy.get_param('~sync_incomplete', sync_incomplete)
+      rospy.loginfo('frame sync: {} (tolerance {} s), incomplete sets: {}'.format(
+         sync_policy, sync_tolerance, sync_incomplete))
+      # With latest frames, the newest set only (older ones are stale)
+      self.frame_sync = FrameSynchronizer([C45, C0, CN45], policy=sync_policy,
+                                          tolerance=sync_tolerance,
+                                          incomplete=sync_incomplete,
+                                          clock=rospy.get_time,
+                                          latest=frame_policy == 'latest')
 
       self.image_times = {
          C0: 0.0,
@@ -77,45 +136,117 @@ class OpticFlowROS():
          CN45: 0.0
       }
 
-      self.initial_times = {
-         C0: 0.0,
-         C45: 0.0,
-         CN45: 0.0
-      }
-
       self.this_images = {
          C0: None,
          C45: None,
          CN45: None
       }
 
+      # Signalled by the camera callbacks, main sleeps on it
+      self._new_frame = threading.Condition()
+      self.idle_time_s = 0.0
+      self.busy_time_s = 0.0
+      self.wakeups = 0
+
+      # Latency of each stage, from the image stamps to the decision
+      self.timer = make_timer(rospy.get_param('~timing', timing), TIMING_STAGES,
+                              clock=rospy.get_time)
+      self._set_stamp = 0.0
+
+      # Image messages to arrays, zero-copy for 8 bit encodings
+      self.ingest = ImageIngest(bridge)
+
       self.vel = np.zeros(3)
       self.target_vel = target_vel
             
-      self.subscribers(wait_for_imtopic_s)
-      self.publishers()
-      
-      self.OF_modules = {
-         C0: OpticFlow(camera_instance=self.cam),
-         C45: OpticFlow(camera_instance=self.cam),
-         CN45: OpticFlow(camera_instance=self.cam),
-      }
-
-      self._init_data_collection(data_collection)
+      # Camera model of the (preprocessed) images, the filters depend on it
+      if self.cam is None:
+         self.cam = self._wait_for_camera(wait_for_imtopic_s)
+
+      # Optic flow algorithm, one backend instance per camera
+      flow_backend = rospy.get_param('~flow_backend', flow_backend)
+      flow_backend_params = rospy.get_param('~flow_backend_params', flow_backend_params)
+      rospy.loginfo('optic flow backend: {} {}'.format(flow_backend, flow_backend_params))
+      # Cameras with another backend, camera: [name, params]
+      camera_backends = rospy.get_param('~camera_backends', camera_backends)
+      for cam, (name, params) in sorted(camera_backends.items()):
+         rospy.loginfo('{} optic flow backend: {} {}'.format(cam, name, params))
+      # Start each flow from the previous one
+      warm_start = rospy.get_param('~warm_start', warm_start)
+      # Skip the flow of static frames (hovering, republished frames)
+      gate_threshold = rospy.get_param('~gate_threshold', gate_threshold)
+      gate_level = rospy.get_param('~gate_level', 3)
+      gate_mode = rospy.get_param('~gate_mode', gate_mode)
+      # Coarse flows, at full resolution only close to the threshold
+      cascade_level = rospy.get_param('~cascade_level', cascade_level)
+      cascade_margin = rospy.get_param('~cascade_margin', cascade_margin)
+      # Full resolution flow only in a region of each camera, camera: [x, y, w, h],
+      # or where its filter weighs at least roi_threshold of its maximum
+      rois = rospy.get_param('~rois', rois)
+      roi_threshold = rospy.get_param('~roi_threshold', roi_threshold)
+      roi_margin = rospy.get_param('~roi_margin', 8)
+      # Lower the flow quality to keep the flow of a frame-set under a deadline
+      # in seconds (0: off), the cameras of lower priority first, camera: priority
+      quality_deadline = rospy.get_param('~quality_deadline', quality_deadline)
+      quality_priorities = rospy.get_param('~quality_priorities', {C0: 1})
+
+      # Run the cameras serially, or concurrently in threads or processes
+      workers = rospy.get_param('~workers', workers)
+      cv_threads = rospy.get_param('~cv_threads', cv_threads)
+      rospy.loginfo('optic flow workers: {} ({} OpenCV threads)'.format(workers, cv_threads))
 
       self.cameras = [C45, C0, CN45]
-      self.last_flows = {C0: [], C45: [], CN45: []}
 
       self.avoidance_type = avoidance_type
 
-      if self.avoidance_type == 'tunnel-centering':
-         self.behaviour = TunnelCenteringBehaviour(self.cam)
+      # Precomputed matched filters, memory-mapped by the behaviour
+      filter_bank = rospy.get_param('~filter_bank', filter_bank)
+
+      # Flow, activations and decisions, this node feeds it frame-sets.
+      # Built before the subscribers, publishers and timers start their threads:
+      # the processes workers fork, and a fork can leave their locks held
+      self.pipeline = AvoidancePipeline(
+         self.cam, avoidance_type=avoidance_type, filter_bank=filter_bank,
+         flow_backend=flow_backend, flow_backend_params=flow_backend_params,
+         camera_backends=camera_backends,
+         warm_start=warm_start, gate_threshold=gate_threshold,
+         gate_level=gate_level, gate_mode=gate_mode,
+         cascade_level=cascade_level, cascade_margin=cascade_margin,
+         rois=rois, roi_threshold=roi_threshold, roi_margin=roi_margin,
+         quality_deadline=quality_deadline,
+         quality_priorities=quality_priorities,
+         workers=workers, cv_threads=cv_threads,
+         react=not data_collection, timer=self.timer)
+      rospy.on_shutdown(self.pipeline.close)
+
+      self._init_data_collection(data_collection)
+      self.subscribers(wait_for_imtopic_s)
+      self.publishers()
+
+      diagnostics_period = rospy.get_param('~diagnostics_period', diagnostics_period)
+      if diagnostics_period > 0:
+         rospy.Timer(rospy.Duration(diagnostics_period), self.publish_diagnostics)
 
-      elif self.avoidance_type == 'saccade':
-         self.behaviour = SaccadeBehaviour(self.cam)
+      if self.timer.enabled:
+         self.timing_publisher = rospy.Publisher('~timing', DiagnosticArray, queue_size=1)
+         rospy.Timer(rospy.Duration(rospy.get_param('~timing_period', timing_period)),
+                     self.publish_timing)
+         rospy.on_shutdown(lambda: rospy.loginfo('stage latencies:\n' + self.timer.dump()))
 
-      self.is_ready = False
-      self._central_ready = True
+   def _wait_for_camera(self, wait_for_imtopic_s):
+      """Camera model from the camera info of the centre camera
+
+      Args:
+          wait_for_imtopic_s (int): seconds to wait for the camera info
+      """
+      try:
+         rospy.loginfo('waiting for the camera info {}'.format(self.cam_info))
+         return Camera(rospy.wait_for_message(self.cam_info, CameraInfo,
+                                              timeout=wait_for_imtopic_s))
+      except Exception as e:
+         rospy.logerr("{} Timed out waiting for the camera info {} in node {} ".format(e, self.cam_info, rospy.get_name()))
+         rospy.signal_shutdown('camera info not detected shutting down node')
+         sys.exit(1)
 
    def _init_data_collection(self, data_collection):
       self.start_data_collection = False
@@ -128,6 +259,29 @@ class OpticFlowROS():
          self.distance = 25
          self.current_distance = self.distance
 
+   def _init_preprocessing(self, resize_params, rectify, wait_for_imtopic_s):
+      """Subscribe to the raw camera topics and build each camera's
+      preprocessor from its camera info
+
+      Args:
+          resize_params (dict): image_proc/resize parameters (use_scale,
+                                scale_width, scale_height, width, height,
+                                interpolation)
+          rectify (bool): rectify the images
+          wait_for_imtopic_s (int): seconds to wait for the camera infos
+      """
+      for cam in (C0, C45, CN45):
+         self.cam_topics[cam] = '/{}/image_raw'.format(cam)
+         raw_info = rospy.wait_for_message('/{}/camera_info'.format(cam), CameraInfo,
+                                           timeout=wait_for_imtopic_s)
+         self.preprocessors[cam] = Preprocessor(raw_info, rectify=rectify, **resize_params)
+      self.cam_info = '/{}/camera_info'.format(C0)
+      # The filters are built for the preprocessed images
+      self.cam = Camera(self.preprocessors[C0].camera_info)
+      rospy.loginfo('preprocessing {}x{} images to {}x{} (rectify: {})'.format(
+         raw_info.width, raw_info.height,
+         self.preprocessors[C0].out_w, self.preprocessors[C0].out_h, rectify))
+
    def publishers(self):
       """Initialise publishers
       """
@@ -166,6 +320,8 @@ class OpticFlowROS():
       )
 
       self.draw_publisher = self.image_pub = rospy.Publisher(self.node_name + '/optic_flow_draw', Image)
+
+      self.diagnostics_publisher = rospy.Publisher('/diagnostics', DiagnosticArray, queue_size=10)
    
    
    def subscribers(self, wait_for_imtopic_s):
@@ -184,10 +340,6 @@ class OpticFlowROS():
       self.cam_n45_subs = rospy.Subscriber(
          self.cam_topics[CN45], Image, self.camera_n45_cb, queue_size=5)
       
-      self.cam_info_subs = rospy.Subscriber(
-         self.cam_info, CameraInfo, self.cam_info_cb
-      )
-
       self.vel_subs = rospy.Subscriber(
          '/mavros/local_position/velocity_local', TwistStamped, self.vel_subs_cb
       )
@@ -243,21 +395,11 @@ class OpticFlowROS():
       """
       self.camera_general_cb(CN45, data)
       
-   def cam_info_cb(self, data):
-      """Add the camera_0 instance
-
-      Args:
-         data (CameraInfo): the camera info topic.
-      """
-      if not self.cam:
-         self.cam = Camera(data)
-
    def state_cb(self, data):
       if data.flight_state in ('Teleoperation', 'Waypoint'):
          if self.data_collection:
             self.start_data_collection=True
-         self.behaviour.start()
-         rospy.Timer(rospy.Duration(4), self.ready, oneshot=True)
+         self.pipeline.start(rospy.get_time())
          
          
    
@@ -269,16 +411,22 @@ class OpticFlowROS():
           data (Image): image from the subscriber
       """
       try: 
+         self.timer.age('receipt', data.header.stamp.to_sec())
          
          time_last_image = self.image_times[cam]
-         # Get the image from the data
-         self.this_images[cam] = bridge.imgmsg_to_cv2(data)
+         # Get the image from the data, a view of it when possible
+         self.this_images[cam] = self.ingest(data)
+         if self.preprocessors:
+            self.this_images[cam] = self.preprocessors[cam](self.this_images[cam])
          # Update time
          self.image_times[cam] = data.header.stamp.to_sec()
          
          if time_last_image != self.image_times[cam]:
-            # Add the image to the queue
-            self.image_queues[cam].put([self.this_images[cam], self.image_times[cam]])
+            # Add the image to the queue (this blocks with the block
+            # policy, so not while holding the lock) and wake up main
+            self.image_queues[cam].put(self.this_images[cam], self.image_times[cam])
+            with self._new_frame:
+               self._new_frame.notify()
             
       # If there is a CvBridge error, print it      
       except CvBridgeError as err:
@@ -306,39 +454,37 @@ class OpticFlowROS():
       self.avoidance_direction_msg.header.stamp = rospy.Time.now()
       self.avoidance_direction_publisher.publish(self.avoidance_direction_msg)
 
-   def publish_tunnel_data(self, activations):
+   def publish_tunnel_data(self, activations, quality):
       if self.start_data_collection:
          self.avoidance_data_tunnel_msg.vel=float(self.target_vel)
          self.avoidance_data_tunnel_msg.distance=self.current_distance
          self.avoidance_data_tunnel_msg.activation_0=list(activations[0])
          self.avoidance_data_tunnel_msg.activation_1=list(activations[1])
          self.avoidance_data_tunnel_msg.activation_2=list(activations[2])
+         self.avoidance_data_tunnel_msg.quality=list(quality)
          self.avoidance_data_tunnel_publisher.publish(self.avoidance_data_tunnel_msg)
             
    def get_flows(self, draw_image=False):
-      flows = []
-      for i, cam in enumerate(self.cameras):
+      # The next frame-set, computed together by the workers
+      self.frame_sync.add_from(self.image_queues)
+      frame_set = self.frame_sync.pop()
 
-         if self.image_queues[cam].empty():
-            if len(self.last_flows[cam]) == 0:
-               return False
-            
-            flow = self.last_flows[cam]
-            
-         else:
-            this_image, this_image_time = self.image_queues[cam].get()
-            
-            # if we don't subtract the initial camera time 
-            # the frame difference can be 0.0 due to precision errors
-            if not self.initial_times[cam]:
-               self.initial_times[cam] = this_image_time                  
-            this_image_time = this_image_time - self.initial_times[cam]
-            flow = self.OF_modules[cam].step(this_image, this_image_time)
+      # Nothing new, do not step the behaviour on stale flows
+      if not frame_set:
+         return False
 
-            if not self.OF_modules[cam].initialised:
-               return False
+      self._set_stamp = min(stamp for _, stamp in frame_set.values())
+      self.timer.age('queue', self._set_stamp)
 
-            self.last_flows[cam] = flow
+      result = self.pipeline.step(frame_set)
+      if result is None:
+         return False
+
+      for i, cam in enumerate(self.cameras):
+         # Missing from an incomplete set reuse the last flow (reuse policy)
+         if cam in frame_set:
+            this_image = frame_set[cam][0]
+            flow = result.flows[i]
 
             if draw_image == i and draw_image:
                draw = plotter_flow.draw_flow(flow, this_image, save=round(self.current_distance, 2))
@@ -353,50 +499,140 @@ class OpticFlowROS():
                   plotter_flow.save_flow(flow, this_image, 
                                        int(self.current_distance), 
                                        self.save_flow, just_img=False)
-               
-         flows.append(flow)
-      return flows
+      return result
 
-   def ready(self, t):
-      self.is_ready = True
+   def publish_timing(self, event=None):
+      """Publish the latency percentiles of each stage on ~timing
+      """
+      array = DiagnosticArray()
+      array.header.stamp = rospy.Time.now()
+      for stage, summary in self.timer.summary().items():
+         array.status.append(DiagnosticStatus(
+            level=DiagnosticStatus.OK,
+            name='{}: {} latency'.format(self.node_name, stage),
+            message='p95 {:.3g} ms'.format(summary['p95_ms']),
+            values=[KeyValue(key=key, value='{:.4g}'.format(value))
+                    for key, value in summary.items()]))
+      self.timing_publisher.publish(array)
+
+   def publish_diagnostics(self, event=None):
+      """Publish the frame buffer counters of each camera, with a warning
+      level if frames were dropped since the last time
+      """
+      array = DiagnosticArray()
+      array.header.stamp = rospy.Time.now()
+      bytes_copied = self.pipeline.flow_workers.bytes_copied()
+      step_stats = self.pipeline.flow_workers.step_stats()
+      for cam, queue in sorted(self.image_queues.items()):
+         stats = queue.stats()
+         stats['ring_bytes_copied_per_frame'] = bytes_copied[cam]
+         stats.update(step_stats[cam])
+         dropped = stats['dropped'] - self._last_dropped[cam]
+         self._last_dropped[cam] = stats['dropped']
+         status = DiagnosticStatus(
+            level=DiagnosticStatus.WARN if dropped else DiagnosticStatus.OK,
+            name='{}: {} frames'.format(self.node_name, cam),
+            message='{} frames dropped'.format(dropped) if dropped else 'OK',
+            hardware_id=cam,
+            values=[KeyValue(key=key, value=str(value))
+                    for key, value in sorted(stats.items())])
+         array.status.append(status)
+      ingest_stats = self.ingest.stats()
+      array.status.append(DiagnosticStatus(
+         level=DiagnosticStatus.OK,
+         name='{}: image ingest'.format(self.node_name),
+         message='OK',
+         values=[KeyValue(key=key, value=str(value))
+                 for key, value in sorted(ingest_stats.items())]))
+      sync_stats = self.frame_sync.stats()
+      array.status.append(DiagnosticStatus(
+         level=DiagnosticStatus.OK,
+         name='{}: frame sync'.format(self.node_name),
+         message='OK',
+         values=[KeyValue(key=key, value=str(value))
+                 for key, value in sorted(sync_stats.items())]))
+      array.status.append(DiagnosticStatus(
+         level=DiagnosticStatus.OK,
+         name='{}: main loop'.format(self.node_name),
+         message='OK',
+         values=[KeyValue(key=key, value=str(value))
+                 for key, value in sorted(self.idle_stats().items())]))
+      self.diagnostics_publisher.publish(array)
+
+   def _close_queues(self):
+      for queue in self.image_queues.values():
+         queue.close()
+
+   def _frames_pending(self):
+      # A set is also ready when a missing camera has timed out
+      return (any(not queue.empty() for queue in self.image_queues.values())
+              or self.frame_sync.ready())
+
+   def wait_for_frames(self, timeout=0.1):
+      """Sleep until a camera callback queues a new frame, or a frame-set
+      times out waiting for a camera
 
-   def central_ready(self, t):
-      self._central_ready = True
+      Args:
+          timeout (float, optional): seconds between shutdown checks.
+                                     Defaults to 0.1.
+
+      Returns:
+          bool: whether there are new frames
+      """
+      start = time.time()
+      with self._new_frame:
+         while not self._frames_pending() and not rospy.is_shutdown():
+            # Wake up when the pending set times out, not at the next check
+            wait = timeout
+            deadline = self.frame_sync.next_deadline()
+            if deadline is not None:
+               wait = min(wait, max(deadline - rospy.get_time(), 0.001))
+            self._new_frame.wait(wait)
+      self.idle_time_s += time.time() - start
+      self.wakeups += 1
+      return self._frames_pending()
+
+   def idle_stats(self):
+      """Time main spent waiting for frames and processing them
+
+      Returns:
+          dict: idle and busy seconds, idle fraction and wakeups
+      """
+      total = self.idle_time_s + self.busy_time_s
+      return {
+         'idle_s': self.idle_time_s,
+         'busy_s': self.busy_time_s,
+         'idle_fraction': self.idle_time_s / total if total else 0.0,
+         'wakeups': self.wakeups,
+      }
 
        
    def main(self):
             
       while not rospy.is_shutdown():
+
+         if not self.wait_for_frames():
+            continue
+         start = time.time()
             
-         flows = self.get_flows(draw_image=False)
-         if not self._central_ready:
-            flows[1] *= 0
+         result = self.get_flows(draw_image=False)
          
-         if flows and self.is_ready:
-            activations, direction = self.behaviour.step(flows)
-            if activations:
-               self.publish_tunnel_data(activations)               
-            if direction and not self.data_collection:
-               self.publish_direction(direction, 'relative')
-               self.behaviour.reset()
-               self.is_ready = False
-               print('Direction: ' + str(direction))
-               if abs(direction) > 45:
-                  self._central_ready = False
-                  duration = 3
-                  rospy.Timer(rospy.Duration(5), self.central_ready, oneshot=True)
-                  
-               else: 
-                  if self.avoidance_type == 'saccade':
-                     duration = 2
-                  else:
-                     duration = 1
-               rospy.Timer(rospy.Duration(duration), self.ready, oneshot=True)
-            
+         if result and result.activations:
+            publish_start = self.timer.start()
+            self.publish_tunnel_data(result.activations, result.quality)               
+            if result.direction and not self.data_collection:
+               self.publish_direction(result.direction, 'relative')
+               print('Direction: ' + str(result.direction))
+            self.timer.stop('publish', publish_start)
+            self.timer.age('total', self._set_stamp)
 
          if self.data_collection and self.current_distance < 2:
             os.system("rosnode kill --all")
 
+         self.busy_time_s += time.time() - start
+
+      rospy.loginfo('optic flow main loop: {}'.format(self.idle_stats()))
+
       
 if __name__ == '__main__':
    rospy.init_node(NODE_NAME, anonymous=True, log_level=rospy.DEBUG)
@@ -407,10 +643,70 @@ if __name__ == '__main__':
    parser.add_argument('--data_collection', '-d', action='store_true')    
    parser.add_argument('--save_flow', type=str, default='')    
    parser.add_argument('--velocity', '-v', type=float, default=2.0)
+   # Generated with: matchedFilters.py --export <file>
+   parser.add_argument('--filter_bank', type=str, default='')
+   # Optic flow algorithm: farneback, dis, lk or gradient
+   parser.add_argument('--flow_backend', type=str, default='farneback')
+   # Backend of some cameras, e.g. --camera_backend cam_45=gradient
+   parser.add_argument('--camera_backend', type=str, action='append', default=[])
+   parser.add_argument('--dis_preset', type=str, default='fast',
+                       help='ultrafast, fast or medium')
+   parser.add_argument('--warm_start', action='store_true')
+   # Mean grey level difference of the downsampled frames below which
+   # the flow is not computed (0: always), and the flow then (hold or zero)
+   parser.add_argument('--gate_threshold', type=float, default=0.0)
+   parser.add_argument('--gate_mode', type=str, default='hold')
+   # Coarse to fine cascade: flow downsampling octaves (0: off), and the
+   # margin below the threshold from which a camera is refined
+   parser.add_argument('--cascade_level', type=int, default=0)
+   parser.add_argument('--cascade_margin', type=float, default=0.5)
+   # Flow only where the filters weigh at least this fraction of their maximum
+   parser.add_argument('--roi_threshold', type=float, default=0.0)
+   # Flow time of a frame-set in seconds kept by lowering the flow quality (0: off)
+   parser.add_argument('--quality_deadline', type=float, default=0.0)
+   # Per camera optic flow workers: serial, threads or processes
+   parser.add_argument('--workers', type=str, default='serial')
+   parser.add_argument('--cv_threads', type=int, default=None,
+                       help='OpenCV threads per worker')
+   # Frames buffered per camera: latest, keep_n or block
+   parser.add_argument('--frame_policy', type=str, default='latest')
+   parser.add_argument('--frame_buffer_size', type=int, default=1)
+   # Longest wait of the block policy for a free slot, in seconds
+   parser.add_argument('--frame_max_block', type=float, default=1.0)
+   # Frame-sets: exact or approximate stamps, incomplete sets drop, reuse or wait
+   parser.add_argument('--sync_policy', type=str, default='approximate')
+   parser.add_argument('--sync_tolerance', type=float, default=0.01)
+   parser.add_argument('--sync_incomplete', type=str, default='reuse')
+   # Preprocess the raw images in this node (see the ~resize and ~rectify params)
+   parser.add_argument('--preprocess', action='store_true')
+   # Per stage latency histograms, published on ~timing
+   parser.add_argument('--timing', action='store_true')
    
    args = parser.parse_args(rospy.myargv(argv=sys.argv)[1:])
+
+   backend_params = {'preset': args.dis_preset} if args.flow_backend == 'dis' else {}
+   camera_backends = dict((cam, (name, {})) for cam, name in
+                          (spec.split('=') for spec in args.camera_backend))
   
-   OF = OpticFlowROS(NODE_NAME, target_vel=args.velocity, data_collection=args.data_collection, save_flow=args.save_flow, avoidance_type='tunnel-centering')
+   OF = OpticFlowROS(NODE_NAME, target_vel=args.velocity, data_collection=args.data_collection, save_flow=args.save_flow, avoidance_type='tunnel-centering', filter_bank=args.filter_bank,
+                     flow_backend=args.flow_backend, flow_backend_params=backend_params,
+                     camera_backends=camera_backends,
+                     warm_start=args.warm_start,
+                     gate_threshold=args.gate_threshold,
+                     gate_mode=args.gate_mode,
+                     cascade_level=args.cascade_level,
+                     cascade_margin=args.cascade_margin,
+                     roi_threshold=args.roi_threshold,
+                     quality_deadline=args.quality_deadline,
+                     workers=args.workers, cv_threads=args.cv_threads,
+                     frame_policy=args.frame_policy,
+                     frame_buffer_size=args.frame_buffer_size,
+                     frame_max_block=args.frame_max_block,
+                     sync_policy=args.sync_policy,
+                     sync_tolerance=args.sync_tolerance,
+                     sync_incomplete=args.sync_incomplete,
+                     preprocess=args.preprocess,
+                     timing=args.timing)
    OF.main()
       
         
@@ -41,10 +41,8 @@ class OpticFlow():
         rot_mat = self.rotation_matrix_from_rpy_degs(yaw=yaw,
                                                      pitch=pitch,
                                                      roll=roll)
-        for ii in range(self.cam.h):
-            for jj in range(self.cam.w):
-                D[ii, jj, :] = np.matmul(D[ii, jj, :], rot_mat)
-        return D
+        # Row vector times rotation matrix for every pixel at once
+        return np.matmul(D, rot_mat)
 
     def _get_anticipated_viewing_directions(self):
         vertical_views = (((np.arange(self.cam.h, dtype=float) -
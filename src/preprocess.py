@@ -0,0 +1,123 @@
+#!/usr/bin/env python2
+from __future__ import division
+import copy
+import numpy as np
+import cv2
+
+
+def output_size(cam_info, use_scale=True, scale_width=1.0, scale_height=1.0,
+                width=-1, height=-1):
+    """Output size from the image_proc/resize parameters
+
+    Args:
+        cam_info (CameraInfo): the input camera info
+        use_scale (bool): scale the input size, or use width and height
+        scale_width (float): width scale
+        scale_height (float): height scale
+        width (int): output width, -1 keeps the input width
+        height (int): output height, -1 keeps the input height
+
+    Returns:
+        tuple: (width, height)
+    """
+    if use_scale:
+        return (int(cam_info.width * scale_width),
+                int(cam_info.height * scale_height))
+    return (width if width > 0 else cam_info.width,
+            height if height > 0 else cam_info.height)
+
+
+class Preprocessor(object):
+    """Grey conversion, rectification and resizing of the raw camera
+    images inside the avoidance node, in place of the image_proc and
+    image_proc/resize nodelets.
+
+    With rectification one cv2.remap does both the rectification and the
+    resize, the tables are built once from the CameraInfo for the output
+    size. Without it the image is resized with cv2.resize.
+
+    Args:
+        cam_info (CameraInfo): raw camera info
+        use_scale, scale_width, scale_height, width, height: output size,
+            as the image_proc/resize parameters (see output_size)
+        interpolation (int): image_proc/resize interpolation, 0 nearest,
+                             1 linear, 2 cubic, 3 area, 4 lanczos.
+                             Area is not available to remap, which uses
+                             linear instead. Defaults to 0.
+        rectify (bool): rectify the images. Defaults to False.
+    """
+    def __init__(self, cam_info, use_scale=True, scale_width=1.0,
+                 scale_height=1.0, width=-1, height=-1, interpolation=0,
+                 rectify=False):
+        self.in_w, self.in_h = cam_info.width, cam_info.height
+        self.out_w, self.out_h = output_size(cam_info, use_scale, scale_width,
+                                             scale_height, width, height)
+        self.interpolation = interpolation
+        self.rectify = rectify
+        # scale of the output pixel grid
+        self.sx = self.out_w / self.in_w
+        self.sy = self.out_h / self.in_h
+        self._grey = np.empty((self.in_h, self.in_w), dtype=np.uint8)
+        self.camera_info = self._output_camera_info(cam_info)
+        if rectify:
+            self._map1, self._map2 = cv2.initUndistortRectifyMap(
+                np.array(cam_info.K, dtype=np.float64).reshape(3, 3),
+                np.array(cam_info.D, dtype=np.float64),
+                np.array(cam_info.R, dtype=np.float64).reshape(3, 3),
+                np.array(self.camera_info.P, dtype=np.float64).reshape(3, 4),
+                (self.out_w, self.out_h), cv2.CV_16SC2)
+            self._remap_interpolation = (cv2.INTER_LINEAR
+                                         if interpolation == cv2.INTER_AREA
+                                         else interpolation)
+
+    def _scale_matrix(self, matrix):
+        """Camera matrix (3x3 or 3x4, row-major) for the output grid
+        """
+        matrix = np.array(matrix, dtype=np.float64).reshape(3, -1)
+        matrix[0] *= self.sx
+        matrix[1] *= self.sy
+        # pixel centres are at +0.5
+        matrix[0, 2] += 0.5 * self.sx - 0.5
+        matrix[1, 2] += 0.5 * self.sy - 0.5
+        return matrix
+
+    def _output_camera_info(self, cam_info):
+        """Camera info of the output images (what image_proc/resize
+        publishes, and rectified if enabled)
+        """
+        info = copy.deepcopy(cam_info)
+        info.width, info.height = self.out_w, self.out_h
+        if self.rectify:
+            projection = self._scale_matrix(cam_info.P)
+            info.P = projection.ravel().tolist()
+            info.K = projection[:, :3].ravel().tolist()
+            info.D = [0.0] * len(cam_info.D)
+            info.R = np.eye(3).ravel().tolist()
+        else:
+            info.K = self._scale_matrix(cam_info.K).ravel().tolist()
+            info.P = self._scale_matrix(cam_info.P).ravel().tolist()
+        return info
+
+    def __call__(self, image):
+        """Preprocess a raw image
+
+        Args:
+            image (np.ndarray): (H, W) grey or (H, W, 3) BGR raw image
+
+        Returns:
+            np.ndarray: a new read-only (out_h, out_w) uint8 image, so that
+                        the FrameRing can keep it without copying
+        """
+        if image.ndim == 3:
+            image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY, dst=self._grey)
+        out = np.empty((self.out_h, self.out_w), dtype=np.uint8)
+        if self.rectify:
+            cv2.remap(image, self._map1, self._map2, self._remap_interpolation,
+                      dst=out)
+        elif (self.out_w, self.out_h) == (self.in_w, self.in_h):
+            np.copyto(out, image)
+        else:
+            cv2.resize(image, (self.out_w, self.out_h), dst=out,
+                       interpolation=self.interpolation)
+        out.flags.writeable = False
+        return out
@@ -0,0 +1,97 @@
+#!/usr/bin/env python2
+from __future__ import division
+
+
+class QualityController(object):
+    """Keeps the flow time of the frame-sets under a deadline by moving the
+    cameras along their quality ladders (see OpticFlow.set_quality), the
+    cameras of lowest priority first.
+
+    The flow times are smoothed with an exponential moving average. Above
+    the deadline, the camera of lowest priority that is not at its last
+    rung is degraded by one rung (the best one first among equal
+    priorities). Below headroom * deadline for `patience` frame-sets, the
+    degraded camera of highest priority is upgraded by one rung. After a
+    change the average restarts, and the first `settle` frame-sets are not
+    used (their flow is a cold start).
+
+    Args:
+        rungs (dict): camera -> number of quality rungs
+        deadline (float): flow time of a frame-set, in seconds
+        priorities (dict): camera -> priority, the higher the later the
+                           camera is degraded. Defaults to 0.
+        smoothing (float): weight of a new time in the average. Defaults
+                           to 0.3.
+        headroom (float): fraction of the deadline below which the quality
+                          is raised. Defaults to 0.7.
+        patience (int): frame-sets below the headroom before raising the
+                        quality. Defaults to 30.
+        settle (int): frame-sets ignored after a change. Defaults to 2.
+    """
+    def __init__(self, rungs, deadline, priorities={}, smoothing=0.3,
+                 headroom=0.7, patience=30, settle=2):
+        if deadline <= 0:
+            raise ValueError('The quality deadline must be positive, got {}'
+                             .format(deadline))
+        self.rungs = dict(rungs)
+        self.deadline = deadline
+        self.priorities = {cam: priorities.get(cam, 0) for cam in rungs}
+        self.smoothing = smoothing
+        self.headroom = headroom
+        self.patience = patience
+        self.settle = settle
+        self.levels = {cam: 0 for cam in rungs}
+        self.changes = 0
+        self._restart()
+
+    def _restart(self):
+        self.average = None
+        self._below = 0
+        self._settling = 0
+
+    def reset(self):
+        """Back to the best quality of every camera
+        """
+        self.levels = {cam: 0 for cam in self.rungs}
+        self._restart()
+
+    def update(self, seconds):
+        """Add the flow time of a frame-set
+
+        Args:
+            seconds (float): the flow time
+
+        Returns:
+            dict: camera -> new rung, of the camera changed (empty if none)
+        """
+        if self._settling:
+            self._settling -= 1
+            return {}
+        if self.average is None:
+            self.average = seconds
+        else:
+            self.average += self.smoothing * (seconds - self.average)
+
+        if self.average > self.deadline:
+            self._below = 0
+            cams = [cam for cam, level in self.levels.items()
+                    if level < self.rungs[cam] - 1]
+            if cams:
+                return self._change(min(cams, key=lambda cam: (
+                    self.priorities[cam], self.levels[cam])), 1)
+        elif self.average < self.headroom * self.deadline:
+            self._below += 1
+            cams = [cam for cam, level in self.levels.items() if level > 0]
+            if cams and self._below >= self.patience:
+                return self._change(max(cams, key=lambda cam: (
+                    self.priorities[cam], -self.levels[cam])), -1)
+        else:
+            self._below = 0
+        return {}
+
+    def _change(self, cam, step):
+        self.levels[cam] += step
+        self.changes += 1
+        self._restart()
+        self._settling = self.settle
+        return {cam: self.levels[cam]}
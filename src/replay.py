@@ -0,0 +1,377 @@
+#!/usr/bin/env python2
+"""Replay recorded flights through the avoidance pipeline, as fast as
+possible and without a ROS master. The activations and decisions are
+saved in a columnar file (one array per column), one file per bag.
+
+    python replay.py bags/*.bag --output replays --jobs 4
+"""
+from __future__ import division
+import csv
+import multiprocessing
+import os
+import time
+from collections import OrderedDict
+import numpy as np
+from camera import Camera
+from camera_labels import *
+from avoidance_pipeline import AvoidancePipeline
+from frame_sync import FrameSynchronizer
+from image_ingest import ImageIngest
+
+# Topics of opticFlowROS
+CAM_TOPICS = {
+    C0: '/resize_img/image',
+    C45: '/resize_img_45/image',
+    CN45: '/resize_img_n45/image',
+}
+POSE_TOPIC = '/mavros/local_position/pose'
+STATE_TOPIC = '/pyx4_node/pyx4_state'
+# flight states in which the node starts the behaviour
+START_STATES = ('Teleoperation', 'Waypoint')
+
+COLUMNS = ['stamp', 'x', 'y', 'z', 'activation_0', 'activation_1',
+           'activation_2', 'direction', 'quality_0', 'quality_1', 'quality_2']
+
+
+class ReplayRecorder(object):
+    """Collects a row per processed frame-set, as columns
+    """
+    def __init__(self):
+        self.columns = OrderedDict((name, []) for name in COLUMNS)
+
+    def add(self, stamp, position, result):
+        """Record the activations (the newest of each camera), the
+        direction (NaN without a decision) and the flow quality rungs of a
+        pipeline result
+        """
+        row = [stamp] + list(position)
+        row += [acts[-1] for acts in result.activations]
+        row.append(np.nan if result.direction is None else result.direction)
+        row += result.quality
+        for name, value in zip(COLUMNS, row):
+            self.columns[name].append(value)
+
+    def arrays(self):
+        return OrderedDict((name, np.array(values, dtype=np.float64))
+                           for name, values in self.columns.items())
+
+
+def replay_messages(messages, camera, cam_topics=CAM_TOPICS,
+                    pose_topic=POSE_TOPIC, state_topic=STATE_TOPIC,
+                    start_on_state=True, sync_policy='approximate',
+                    sync_tolerance=0.01, sync_incomplete='reuse',
+                    bridge=None, **pipeline_params):
+    """Run recorded messages through an AvoidancePipeline
+
+    Frames are synchronised on their header stamps, the synchroniser's
+    clock is the time of the last message read, so a replay gives the same
+    frame-sets every time.
+
+    Args:
+        messages (iterable): (topic, message, time) in recording order, as
+                             rosbag.Bag.read_messages
+        camera (Camera): the camera model of the images
+        cam_topics (dict): camera -> image topic
+        pose_topic (str): PoseStamped topic of the vehicle position
+        state_topic (str): pyx4 state topic
+        start_on_state (bool): start the behaviour on the first
+                               Teleoperation or Waypoint state, as the
+                               node. False starts it with the first frame.
+                               Defaults to True.
+        sync_policy, sync_tolerance, sync_incomplete: see FrameSynchronizer
+        bridge (CvBridge, optional): for the encodings that cannot be
+                                     wrapped without a copy
+        **pipeline_params: AvoidancePipeline parameters
+
+    Returns:
+        tuple: the columns (dict name -> np.ndarray) and the stats (dict)
+    """
+    topic_cams = {topic: cam for cam, topic in cam_topics.items()}
+    clock = [0.0]
+    sync = FrameSynchronizer([C45, C0, CN45], policy=sync_policy,
+                             tolerance=sync_tolerance,
+                             incomplete=sync_incomplete,
+                             clock=lambda: clock[0])
+    ingest = ImageIngest(bridge)
+    pipeline = AvoidancePipeline(camera, **pipeline_params)
+    recorder = ReplayRecorder()
+    position = (np.nan, np.nan, np.nan)
+    # newest image header stamp, the clock of pipeline.step
+    newest_stamp = None
+    # start on the next frame: without start_on_state, or on a state
+    # message that came before any frame
+    start_next = not start_on_state
+    decisions = 0
+    start = time.time()
+    try:
+        for topic, msg, t in messages:
+            clock[0] = t.to_sec()
+            if topic == pose_topic:
+                p = msg.pose.position
+                position = (p.x, p.y, p.z)
+                continue
+            if topic == state_topic:
+                if start_on_state and msg.flight_state in START_STATES:
+                    if newest_stamp is None:
+                        start_next = True
+                    else:
+                        pipeline.start(newest_stamp)
+                continue
+            cam = topic_cams.get(topic)
+            if cam is None:
+                continue
+            stamp = msg.header.stamp.to_sec()
+            newest_stamp = max(stamp, newest_stamp or stamp)
+            if start_next:
+                pipeline.start(stamp)
+                start_next = False
+            sync.add(cam, ingest(msg), stamp)
+
+            frame_set = sync.pop()
+            while frame_set:
+                result = pipeline.step(frame_set)
+                if result and result.activations:
+                    recorder.add(max(s for _, s in frame_set.values()),
+                                 position, result)
+                    # as the node, which publishes non-zero directions
+                    decisions += bool(result.direction)
+                frame_set = sync.pop()
+        step_stats = pipeline.flow_workers.step_stats()
+        controller = pipeline.quality_controller
+    finally:
+        pipeline.close()
+    elapsed = time.time() - start
+
+    stats = {
+        'frames': ingest.frames,
+        'rows': len(recorder.columns['stamp']),
+        'decisions': decisions,
+        'seconds': elapsed,
+        'fps': ingest.frames / elapsed if elapsed else 0.0,
+    }
+    stats.update(sync.stats())
+    for key in ('gated_steps', 'refined_steps'):
+        stats[key] = sum(cam_stats[key] for cam_stats in step_stats.values())
+    stats['quality_changes'] = controller.changes if controller else 0
+    return recorder.arrays(), stats
+
+
+def camera_from_bag(bag, cam_topics=CAM_TOPICS):
+    """Camera model from the first image of the centre camera
+    """
+    for _, msg, _ in bag.read_messages(topics=[cam_topics[C0]]):
+        return Camera(width=msg.width, height=msg.height)
+    raise ValueError('No {} images in the bag'.format(cam_topics[C0]))
+
+
+def replay_bag(path, cam_topics=CAM_TOPICS, pose_topic=POSE_TOPIC,
+               state_topic=STATE_TOPIC, start_on_state=True, **params):
+    """Replay a bag file, see replay_messages
+
+    Starts the behaviour with the first frame if the bag has no state
+    messages.
+
+    Args:
+        path (str): the bag file
+
+    Returns:
+        tuple: the columns and the stats
+    """
+    import rosbag
+    try:
+        from cv_bridge import CvBridge
+        bridge = CvBridge()
+    except ImportError:
+        bridge = None
+
+    with rosbag.Bag(path) as bag:
+        camera = camera_from_bag(bag, cam_topics)
+        if start_on_state and not bag.get_message_count(state_topic):
+            start_on_state = False
+        topics = list(cam_topics.values()) + [pose_topic, state_topic]
+        return replay_messages(bag.read_messages(topics=topics), camera,
+                               cam_topics=cam_topics, pose_topic=pose_topic,
+                               state_topic=state_topic,
+                               start_on_state=start_on_state, bridge=bridge,
+                               **params)
+
+
+def save_columns(path, columns):
+    """Save the columns to .npz (one array per column) or .csv
+    """
+    if path.endswith('.csv'):
+        with open(path, 'w') as f:
+            writer = csv.writer(f)
+            writer.writerow(list(columns))
+            writer.writerows(zip(*columns.values()))
+    else:
+        np.savez(path, **columns)
+
+
+def load_columns(path):
+    """Columns saved by save_columns
+    """
+    if path.endswith('.csv'):
+        data = np.genfromtxt(path, delimiter=',', names=True)
+        return OrderedDict((name, data[name]) for name in data.dtype.names)
+    with np.load(path) as data:
+        return OrderedDict((name, data[name]) for name in data.files)
+
+
+def compare_columns(columns, reference):
+    """Accuracy of a replay against a reference replay of the same bag
+    (e.g. another backend against the dense flow), on their common stamps.
+    Replay both with react=False, so that the pauses after the decisions
+    do not change which frames are processed.
+
+    Args:
+        columns (dict): the replay's columns
+        reference (dict): the reference's columns
+
+    Returns:
+        dict: common rows, median relative error of each camera's
+              activation, and the fraction of the rows whose direction
+              (or lack of decision) agrees
+    """
+    _, rows, ref_rows = np.intersect1d(columns['stamp'], reference['stamp'],
+                                       return_indices=True)
+    report = OrderedDict([('rows', len(rows))])
+    for i in range(3):
+        name = 'activation_{}'.format(i)
+        values, expected = columns[name][rows], reference[name][ref_rows]
+        valid = expected != 0
+        report[name + '_rel_error'] = (float(np.median(
+            np.abs(values[valid] - expected[valid]) / np.abs(expected[valid])))
+            if valid.any() else np.nan)
+    directions = columns['direction'][rows]
+    ref_directions = reference['direction'][ref_rows]
+    agree = ((np.nan_to_num(directions) != 0) ==
+             (np.nan_to_num(ref_directions) != 0))
+    report['decision_agreement'] = float(agree.mean()) if len(rows) else np.nan
+    return report
+
+
+def _replay_job(job):
+    path, output, params = job
+    columns, stats = replay_bag(path, **params)
+    save_columns(output, columns)
+    return path, output, stats
+
+
+def replay_bags(paths, output_dir, file_format='npz', jobs=1, **params):
+    """Replay several bags, in parallel processes with jobs > 1
+
+    Args:
+        paths (list): the bag files
+        output_dir (str): directory of the outputs, named as the bags
+        file_format (str): npz or csv. Defaults to 'npz'.
+        jobs (int): bags replayed at the same time. Defaults to 1.
+        **params: replay_bag parameters
+
+    Returns:
+        list: (bag, output, stats) of each bag, in order
+    """
+    if not os.path.isdir(output_dir):
+        os.makedirs(output_dir)
+    work = [(path, os.path.join(output_dir, '{}.{}'.format(
+                 os.path.splitext(os.path.basename(path))[0], file_format)),
+             params)
+            for path in paths]
+    if jobs <= 1:
+        return [_replay_job(job) for job in work]
+    pool = multiprocessing.Pool(jobs)
+    try:
+        return pool.map(_replay_job, work, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+
+
+if __name__ == '__main__':
+    import argparse
+    import json
+    parser = argparse.ArgumentParser(
+        description='Replay bags through the avoidance pipeline')
+    parser.add_argument('bags', nargs='+', help='Bag files')
+    parser.add_argument('--output', type=str, default='replays',
+                        help='Output directory. Default: replays')
+    parser.add_argument('--format', type=str, default='npz',
+                        choices=['npz', 'csv'], help='Default: npz')
+    parser.add_argument('--jobs', type=int, default=1,
+                        help='Bags replayed in parallel. Default: 1')
+    parser.add_argument('--avoidance_type', type=str,
+                        default='tunnel-centering',
+                        help='tunnel-centering or saccade')
+    parser.add_argument('--filter_bank', type=str, default='',
+                        help='Precomputed matched filters')
+    parser.add_argument('--flow_backend', type=str, default='farneback')
+    parser.add_argument('--flow_backend_params', type=json.loads,
+                        default={}, help='Backend parameters, as JSON')
+    parser.add_argument('--camera_backends', type=json.loads, default={},
+                        help="""Backends of some cameras, as JSON, e.g.
+                        '{"cam_45": ["gradient", {}]}'""")
+    parser.add_argument('--compare', type=str, default='',
+                        help="""Directory of reference replays (e.g. of the
+                        dense flow, with --no_react) to report the accuracy
+                        against""")
+    parser.add_argument('--warm_start', action='store_true')
+    parser.add_argument('--gate_threshold', type=float, default=0.0,
+                        help="""Frame difference below which the flow is
+                        not computed. Default: 0 (no gating)""")
+    parser.add_argument('--gate_mode', type=str, default='hold',
+                        help='hold or zero. Default: hold')
+    parser.add_argument('--cascade_level', type=int, default=0,
+                        help="""Coarse flow downsampling octaves of the
+                        cascade. Default: 0 (no cascade)""")
+    parser.add_argument('--cascade_margin', type=float, default=0.5,
+                        help="""Refine the cameras whose coarse activation
+                        is above (1 - margin) * threshold. Default: 0.5""")
+    parser.add_argument('--rois', type=json.loads, default={},
+                        help="""Flow region of some cameras, as JSON, e.g.
+                        '{"cam_45": [0, 0, 120, 135]}'""")
+    parser.add_argument('--roi_threshold', type=float, default=0.0,
+                        help="""Flow region of the other cameras, where
+                        their filter weighs at least this fraction of its
+                        maximum. Default: 0 (whole frame)""")
+    parser.add_argument('--quality_deadline', type=float, default=0.0,
+                        help="""Flow time of a frame-set in seconds kept by
+                        lowering the flow quality, the side cameras first.
+                        Default: 0 (full quality)""")
+    parser.add_argument('--workers', type=str, default='serial',
+                        help='serial, threads or processes')
+    parser.add_argument('--sync_policy', type=str, default='approximate')
+    parser.add_argument('--sync_tolerance', type=float, default=0.01)
+    parser.add_argument('--sync_incomplete', type=str, default='reuse')
+    parser.add_argument('--no_react', action='store_true',
+                        help="""Do not pause after the decisions (data
+                        collection)""")
+    parser.add_argument('--start_on_frames', action='store_true',
+                        help="""Start the behaviour with the first frame
+                        instead of the flight state""")
+    args = parser.parse_args()
+
+    results = replay_bags(
+        args.bags, args.output, args.format, args.jobs,
+        start_on_state=not args.start_on_frames,
+        sync_policy=args.sync_policy, sync_tolerance=args.sync_tolerance,
+        sync_incomplete=args.sync_incomplete,
+        avoidance_type=args.avoidance_type, filter_bank=args.filter_bank,
+        flow_backend=args.flow_backend,
+        flow_backend_params=args.flow_backend_params,
+        camera_backends=args.camera_backends,
+        warm_start=args.warm_start, gate_threshold=args.gate_threshold,
+        gate_mode=args.gate_mode, cascade_level=args.cascade_level,
+        cascade_margin=args.cascade_margin, rois=args.rois,
+        roi_threshold=args.roi_threshold,
+        quality_deadline=args.quality_deadline, workers=args.workers,
+        react=not args.no_react)
+    for path, output, stats in results:
+        print('{} -> {}: {frames} frames in {seconds:.1f} s ({fps:.0f} fps), '
+              '{rows} rows, {decisions} decisions'.format(path, output,
+                                                          **stats))
+        if args.compare:
+            reference = os.path.join(args.compare, os.path.basename(output))
+            report = compare_columns(load_columns(output),
+                                     load_columns(reference))
+            print('  against {}: {}'.format(reference, ', '.join(
+                '{} {:.4g}'.format(k, v) for k, v in report.items())))
@@ -0,0 +1,155 @@
+#!/usr/bin/env python2
+from __future__ import division
+import bisect
+import math
+import time
+from collections import OrderedDict
+
+
+class LatencyHistogram(object):
+    """Latencies counted in fixed, logarithmically spaced bins, so that
+    adding a sample never allocates and the percentiles are within one
+    bin width (about 12% with 20 bins per decade).
+
+    Args:
+        low (float): lower edge of the first bin in seconds. Defaults to
+                     1e-5.
+        high (float): upper edge of the last bin in seconds. Defaults to
+                      10.
+        bins_per_decade (int): Defaults to 20.
+    """
+    def __init__(self, low=1e-5, high=10.0, bins_per_decade=20):
+        num_bins = int(round(bins_per_decade * math.log10(high / low)))
+        self.edges = [low * 10 ** (i / bins_per_decade)
+                      for i in range(num_bins + 1)]
+        self.reset()
+
+    def reset(self):
+        # one extra bin on each side for the samples out of range
+        self.counts = [0] * (len(self.edges) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds):
+        self.counts[bisect.bisect_right(self.edges, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def percentile(self, q):
+        """Upper edge of the bin of the q-th percentile (capped by the
+        maximum sample)
+
+        Args:
+            q (float): percentile, 0 to 100
+
+        Returns:
+            float: latency in seconds, 0 if there are no samples
+        """
+        if not self.count:
+            return 0.0
+        rank = q / 100 * self.count
+        cumulative = 0
+        for i, count in enumerate(self.counts):
+            cumulative += count
+            if cumulative >= rank and count:
+                break
+        return min(self.edges[min(i, len(self.edges) - 1)], self.max)
+
+    def summary(self):
+        """Count, mean, p50, p95, p99 and max, in milliseconds
+        """
+        return OrderedDict([
+            ('count', self.count),
+            ('mean_ms', 1000 * self.total / self.count if self.count else 0.0),
+            ('p50_ms', 1000 * self.percentile(50)),
+            ('p95_ms', 1000 * self.percentile(95)),
+            ('p99_ms', 1000 * self.percentile(99)),
+            ('max_ms', 1000 * self.max),
+        ])
+
+
+class StageTimer(object):
+    """A latency histogram per stage of the processing
+
+    Durations are measured with the wall clock (start and stop), ages of
+    stamped data with `clock`, the clock of the stamps.
+
+    Args:
+        stages (list): the stage names, in order
+        clock (callable): current time in the clock of the stamps.
+                          Defaults to time.time.
+    """
+    enabled = True
+
+    def __init__(self, stages, clock=time.time):
+        self.clock = clock
+        self.histograms = OrderedDict(
+            (stage, LatencyHistogram()) for stage in stages)
+
+    def start(self):
+        return time.time()
+
+    def stop(self, stage, start):
+        """Add the time since start (from self.start) to a stage
+        """
+        self.histograms[stage].add(time.time() - start)
+
+    def age(self, stage, stamp):
+        """Add the age of data stamped at `stamp` to a stage
+        """
+        self.histograms[stage].add(self.clock() - stamp)
+
+    def reset(self):
+        for histogram in self.histograms.values():
+            histogram.reset()
+
+    def summary(self):
+        """Summary of each stage (see LatencyHistogram.summary)
+        """
+        return OrderedDict((stage, histogram.summary())
+                           for stage, histogram in self.histograms.items())
+
+    def dump(self):
+        """The summaries as a text table
+        """
+        columns = ['count', 'mean_ms', 'p50_ms', 'p95_ms', 'p99_ms', 'max_ms']
+        lines = ['{:>12}'.format('stage') +
+                 ''.join('{:>10}'.format(c) for c in columns)]
+        for stage, summary in self.summary().items():
+            lines.append('{:>12}'.format(stage) + ''.join(
+                '{:>10.4g}'.format(summary[c]) for c in columns))
+        return '\n'.join(lines)
+
+
+class NullTimer(object):
+    """StageTimer interface that does nothing, so that the instrumentation
+    can stay in the code when timing is off
+    """
+    enabled = False
+
+    def start(self):
+        return 0.0
+
+    def stop(self, stage, start):
+        pass
+
+    def age(self, stage, stamp):
+        pass
+
+    def reset(self):
+        pass
+
+    def summary(self):
+        return OrderedDict()
+
+    def dump(self):
+        return ''
+
+
+def make_timer(enabled, stages, clock=time.time):
+    """A StageTimer, or a NullTimer if timing is disabled
+    """
+    return StageTimer(stages, clock) if enabled else NullTimer()